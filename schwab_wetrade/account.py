@@ -1,11 +1,90 @@
+import os
 import time
 import json
-import asyncio
+import datetime
+import threading
+from zoneinfo import ZoneInfo
 from contextlib import suppress
-# from asgiref.sync import sync_to_async
-from schwab.streaming import UnexpectedResponseCode
 from schwab_wetrade.api import APIClient
-from schwab_wetrade.utils import log_in_background, start_thread 
+from schwab_wetrade.user_session import request_lane
+from schwab_wetrade.utils import log_in_background, call_later
+from schwab_wetrade.order_store import OrderStore
+
+
+FINAL_STATUSES = ('FILLED', 'EXECUTED', 'CANCELED', 'EXPIRED', 'REJECTED', 'REPLACED')
+
+OUT_STATUSES = (('REJECT', 'REJECTED'), ('EXPIR', 'EXPIRED'), ('CANCEL', 'CANCELED'), ('FULL', 'CANCELED')) # OutCancelType fragment: status
+
+def find_value(data, key):
+  '''
+  Returns the first value for key found anywhere in nested dicts and lists, or None
+  '''
+  if isinstance(data, dict):
+    if key in data:
+      return data[key]
+    data = data.values()
+  elif not isinstance(data, list):
+    return None
+  for value in data:
+    found = find_value(value, key)
+    if found != None:
+      return found
+  return None
+
+def decode_number(value):
+  '''
+  Decodes a number from account activity MESSAGE_DATA; fixed point values look like {"lo": "60500000", "signScale": 12} (60.5)
+  '''
+  if isinstance(value, dict):
+    if 'lo' not in value:
+      return 0.0 if 'signScale' in value else None # zero values omit lo
+    value = int(value['lo']) / 1_000_000
+  with suppress(TypeError, ValueError):
+    return float(value)
+  return None
+
+def decode_order_update(update_type, details, order):
+  '''
+  Returns the order changes (status, filled_quantity, fill_price) carried by an account activity message, {} if it
+  carries none, or None if it's ambiguous and the order should be reconciled with the REST API
+
+  Fills also return the execution_id, so a message delivered twice is only applied once
+  '''
+  if update_type in ('OrderCreated', 'ChangeCreated', 'CancelRequested', 'ExecutionRequested', 'ExecutionRequestCreated', 'ExecutionRequestCompleted'):
+    return {}
+  if update_type == 'OrderAccepted':
+    return {'status': 'WORKING'} if order.status in ('', 'PENDING_ACTIVATION', 'QUEUED', 'AWAITING_PARENT_ORDER') else {}
+  if update_type == 'CancelAccepted':
+    return {'status': 'PENDING_CANCEL'} if order.status not in FINAL_STATUSES else {}
+  if update_type == 'ExecutionCreated':
+    leg = details.get('BaseEvent', {}).get('ExecutionCreatedEvent', {}).get('ExecutionLeg')
+    if not isinstance(leg, dict):
+      return None
+    quantity = decode_number(leg.get('Quantity'))
+    price = decode_number(leg.get('Price'))
+    remaining = decode_number(leg.get('LeavesQuantity'))
+    execution_id = leg.get('ExecutionId', leg.get('ExecutionID'))
+    if execution_id == None and leg.get('ExecutionTimeStamp') != None: # identify the execution by its leg, time and size instead
+      execution_id = json.dumps([leg.get('LegId'), leg['ExecutionTimeStamp'], leg.get('Quantity'), leg.get('Price')], sort_keys=True)
+    if quantity == None or price == None or remaining == None or execution_id == None:
+      return None
+    if order.filled_quantity > 0 and not order.fill_price:
+      return None # earlier fills came without prices, so the average can't be updated
+    filled_quantity = order.filled_quantity + quantity
+    if filled_quantity > order.quantity or abs(order.quantity - filled_quantity - remaining) > 1e-6:
+      return None # overfilled, or a fill we missed or already got from the REST API
+    if order.filled_quantity > 0: # average price across partial fills
+      price = (order.fill_price * order.filled_quantity + price * quantity) / filled_quantity
+    return {'status': 'FILLED' if remaining <= 0 else 'WORKING', 'filled_quantity': filled_quantity, 'fill_price': price, 'execution_id': str(execution_id)}
+  if update_type == 'OrderUROutCompleted':
+    out_type = str(find_value(details, 'OutCancelType') or '').upper()
+    for fragment, status in OUT_STATUSES:
+      if fragment in out_type:
+        return {'status': status}
+    if find_value(details, 'ValidationDetail') != None:
+      return {'status': 'REJECTED'}
+  return None # unknown message type or payload
+
 
 class Account:
   '''
@@ -17,6 +96,16 @@ class Account:
     self.account_key = account_key if account_key else self.list_accounts()[0]['hashValue']
     self.monitoring_active = False
     self.subscribed_orders = {}
+    self.subscription_lock = threading.Lock() # the stream thread removes subscriptions while sweeps read them
+    self.orders = OrderStore()
+    self.seen_executions = set() # (order_id, execution_id) of fills applied from the stream
+    self.reconcile_lock = threading.Lock()
+    self.pending_reconciliation = set()
+    self.reconciling = False
+    self.reconcile_timer = None
+    self.reconcile_generation = 0 # a sweep only reschedules itself if the reconciler hasn't been restarted since
+    self.min_reconcile_interval = 10.0
+    self.max_reconcile_interval = 60.0
     if background_monitor == True:
       self.monitor_in_background()
 
@@ -88,87 +177,215 @@ class Account:
     '''
     Provides details for all orders placed in account over specified time range
     '''
-    response, status_code = self.client.get_orders_for_account(account_hash=self.account_key, from_entered_datetime=start_datetime, to_entered_datetime=end_datetime)
-    try:
-      order_history = response['OrdersResponse']
-      return order_history
-    except Exception as e:
-      log_in_background(
-        called_from = 'get_order_history',
-        tags = ['user-message'], 
-        message = time.strftime('%H:%M:%S', time.localtime()) + ': Error getting account order history',
-        e = e,
-        account_key = self.account_key)
+    response, status_code = self.client.get_orders_for_account(parsed_response=True, account_hash=self.account_key, from_entered_datetime=start_datetime, to_entered_datetime=end_datetime)
+    if status_code == 200 and isinstance(response, list):
+      return response
+    log_in_background(
+      called_from = 'get_order_history',
+      tags = ['user-message'], 
+      message = time.strftime('%H:%M:%S', time.localtime()) + ': Error getting account order history',
+      account_key = self.account_key)
 
-  async def _stream_account_updates(self):
-    try:
-      await self.client.login() # should we move this to APIClient.__init__?
-    except UnexpectedResponseCode as e:
-      # print(e)
-      # print('unexpected response, should we retry login?')
-      # await sync_to_async(self.client.session.login)(new_token=False)
-      await asyncio.get_event_loop().run_in_executor(None, self.client.session.login, False)
-      return await self._stream_account_updates()
-    self.client.add_account_activity_handler(handler=self.account_message_handler)
-    await self.client.account_activity_sub()
-    while self.monitoring_active == True:
-      await self.client.handle_message()
-    await self.client.account_activity_unsubs()   
-    await self.client.logout()
-
-  def _monitor_account_updates(self):
+  def bootstrap_orders(self, days=1, snapshot_path=None):
+    '''
+    Fills :attr:`orders` with one order history request; with a snapshot_path, loads the snapshot first and extends the request back to
+    the oldest order that was still open when it was saved, so those orders are refreshed too
+
+    :param float days: (optional) how many days of history to fetch without a snapshot
+    :param str snapshot_path: (optional) a SQLite file written by :meth:`OrderStore.save <schwab_wetrade.order_store.OrderStore.save>`
+    '''
+    now = datetime.datetime.now(datetime.timezone.utc) # schwab-py sends the wall time with a Z suffix
+    start_datetime = now - datetime.timedelta(days=days)
+    if snapshot_path != None and os.path.exists(snapshot_path):
+      self.orders.load(snapshot_path)
+      if self.orders.last_updated != None:
+        # open orders in the snapshot may have changed since, so fetch from the oldest of them
+        placed = [order.placed_at for order in self.orders.open_orders() if order.placed_at != None]
+        since = min(placed + [self.orders.last_updated]) - 60
+        start_datetime = min(start_datetime, datetime.datetime.fromtimestamp(since, datetime.timezone.utc))
+    order_history = self.get_order_history(start_datetime=start_datetime, end_datetime=now + datetime.timedelta(minutes=1))
+    for order_response in order_history or []:
+      self.orders.add_order_response(order_response)
+    return len(self.orders)
+
+  def monitor_in_background(self):
+    '''
+    Monitors account updates using the client's shared stream
+    '''
     if self.monitoring_active == False:
       self.monitoring_active = True
-      loop = asyncio.new_event_loop()
-      asyncio.set_event_loop(loop)
-      loop.run_until_complete(self._stream_account_updates())
-      loop.close()
-      self.monitoring_active = False
+      self.client.stream_hub.subscribe('ACCT_ACTIVITY', [''], self.account_message_handler)
 
-  def monitor_in_background(self):
+  def stop_monitoring(self):
     '''
-    Monitors account updates using asyncio
+    Stops monitoring account updates
     '''
-    start_thread(self._monitor_account_updates)
+    if self.monitoring_active == True:
+      self.monitoring_active = False
+      self.client.stream_hub.unsubscribe('ACCT_ACTIVITY', [''], self.account_message_handler)
 
   def account_message_handler(self, message):
-    # print(json.dumps(message, indent=2)) ##
-    updates = message.get('content', [])
-    if updates != []:
-      updated_orders = set()
-      for update in updates:
-        if 'MESSAGE_TYPE' in update:
-          update_type = update.get('MESSAGE_TYPE', '')
-          update_details = {} if update.get('MESSAGE_DATA', '') == '' else json.loads(update['MESSAGE_DATA'])
-        else: # might not need this if api updates are permanent
-          update_type = update.get('FIELD_2', '')
-          update_details = {} if update.get('FIELD_3', '') == '' else json.loads(update['FIELD_3'])
-        # print(json.dumps(update_details, indent=2)) ##
-        order_id = update_details.get('SchwabOrderID', '')
-        update_msg = ''
-        with suppress(Exception):
-          update_msg = update_details['BaseEvent']['OrderUROutCompletedEvent']['ValidationDetail'][0]['NgOMSRuleDescription']
-        if order_id != '':
-          updated_orders.add(order_id)
-        if update_msg != '':
-          log_in_background(
-            called_from = 'account_message_handler', 
-            tags = ['user-message'], 
-            message = '{}: Order Update- {} (Order # {})'.format(
-              time.strftime('%H:%M:%S', time.localtime()),
-              update_msg,
-              order_id),
-            account_key = self.account_key)
-      for id in updated_orders:
-        if id in self.subscribed_orders:
-          self.subscribed_orders[id].check_status()
+    ambiguous = set()
+    for update in message.get('content', []):
+      if 'MESSAGE_TYPE' in update:
+        update_type = update.get('MESSAGE_TYPE', '')
+        update_details = {} if update.get('MESSAGE_DATA', '') == '' else json.loads(update['MESSAGE_DATA'])
+      else: # might not need this if api updates are permanent
+        update_type = update.get('FIELD_2', '')
+        update_details = {} if update.get('FIELD_3', '') == '' else json.loads(update['FIELD_3'])
+      order_id = str(update_details.get('SchwabOrderID', ''))
+      update_msg = find_value(update_details, 'NgOMSRuleDescription') or ''
+      if update_msg != '':
+        log_in_background(
+          called_from = 'account_message_handler', 
+          tags = ['user-message'], 
+          message = '{}: Order Update- {} (Order # {})'.format(
+            time.strftime('%H:%M:%S', time.localtime()),
+            update_msg,
+            order_id),
+          account_key = self.account_key)
+      order = self.subscribed_orders.get(order_id)
+      if order == None:
+        order = self.orders.get(order_id)
+      if order != None:
+        changes = decode_order_update(update_type, update_details, order)
+        execution_id = None if changes == None else changes.pop('execution_id', None)
+        if execution_id != None:
+          if (order_id, execution_id) in self.seen_executions:
+            changes = {}
+          self.seen_executions.add((order_id, execution_id))
+        if changes == None:
+          ambiguous.add(order_id)
+        elif changes != {} and order_id in self.subscribed_orders:
+          order.apply_update(**changes) # updates self.orders too
+        elif changes != {}:
+          self.orders.update(order_id, **changes)
+    if ambiguous:
+      self.request_reconciliation(ambiguous)
+
+  def request_reconciliation(self, order_ids, delay=.1):
+    '''
+    Queues orders for one batched :meth:`reconcile_orders` call off the stream thread; requests made within delay seconds share the call
+    '''
+    with self.reconcile_lock:
+      start = self.pending_reconciliation == set()
+      self.pending_reconciliation.update(map(str, order_ids))
+    if start:
+      call_later(delay, self._run_pending_reconciliation)
+
+  def _run_pending_reconciliation(self):
+    with self.reconcile_lock:
+      order_ids, self.pending_reconciliation = self.pending_reconciliation, set()
+    self.reconcile_orders(order_ids)
+
+  def reconcile_orders(self, order_ids=None, since=None, status=None):
+    '''
+    Updates subscribed orders from a single get_orders_for_account call, applying only what changed; returns the ids of the orders that changed
+
+    Every order in the response also updates :attr:`orders`
+
+    :param order_ids: (optional) only update these orders (default: every subscribed order)
+    :param datetime since: (optional) only fetch orders entered after this time, naive times are local (default: a minute before the earliest of these orders was placed, or the start of the trading day if any placement time is unknown)
+    :param str status: (optional) only fetch orders with this status (WORKING, FILLED, CANCELED, etc.)
+    '''
+    if order_ids == None:
+      with self.subscription_lock:
+        order_ids = set(self.subscribed_orders)
+    else:
+      order_ids = set(map(str, order_ids))
+    orders = [self.subscribed_orders.get(order_id) or self.orders.get(order_id) for order_id in order_ids]
+    orders = [order for order in orders if order != None]
+    if orders == []:
+      return []
+    kwargs = {}
+    if since == None:
+      placed = [order.placed_at for order in orders if getattr(order, 'placed_at', None) != None]
+      if placed != []:
+        since = datetime.datetime.fromtimestamp(min(placed) - 60, datetime.timezone.utc)
+      if len(placed) < len(orders): # without a bound schwab-py asks for 60 days of orders
+        day_start = datetime.datetime.now(ZoneInfo('US/Eastern')).replace(hour=0, minute=0, second=0, microsecond=0)
+        since = day_start if since == None else min(since, day_start)
+    if since != None:
+      kwargs['from_entered_datetime'] = since.astimezone(datetime.timezone.utc) # schwab-py sends the wall time with a Z suffix
+      kwargs['to_entered_datetime'] = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(minutes=1)
+    if status != None:
+      kwargs['status'] = self.client.Order.Status[status]
+    with request_lane('orders'): # order state, like get_order, goes ahead of quote and history requests
+      response, status_code = self.client.get_orders_for_account(parsed_response=True, account_hash=self.account_key, **kwargs)
+    if status_code != 200:
+      log_in_background(
+        called_from = 'reconcile_orders',
+        tags = ['user-message'], 
+        message = time.strftime('%H:%M:%S', time.localtime()) + ': Error getting account orders to reconcile',
+        account_key = self.account_key)
+      return []
+    changed = []
+    for order_response in response:
+      order_id = str(order_response.get('orderId', ''))
+      order = self.subscribed_orders.get(order_id)
+      if order_id in order_ids and order != None and order.apply_order_response(order_response):
+        changed.append(order_id)
+      elif order == None:
+        stored = self.orders.get(order_id)
+        before = None if stored == None else (stored.status, stored.filled_quantity)
+        stored = self.orders.add_order_response(order_response)
+        if order_id in order_ids and before != (stored.status, stored.filled_quantity):
+          changed.append(order_id)
+    return changed
+
+  def open_order_count(self):
+    with self.subscription_lock:
+      orders = list(self.subscribed_orders.values())
+    return len([order for order in orders if order.status not in FINAL_STATUSES])
+
+  def reconcile_interval(self):
+    '''
+    Seconds until the next reconciliation sweep; sweeps run more often the more orders are open, since each sweep is one request however many orders it covers
+    '''
+    open_orders = self.open_order_count()
+    if open_orders == 0:
+      return self.max_reconcile_interval
+    return max(self.min_reconcile_interval, self.max_reconcile_interval / open_orders)
+
+  def start_reconciler(self):
+    '''
+    Periodically reconciles subscribed orders in case a stream update was missed; started by :meth:`add_order_subscription`
+    '''
+    interval = self.reconcile_interval()
+    with self.reconcile_lock:
+      if self.reconciling == False:
+        self.reconciling = True
+        self.reconcile_generation += 1
+        self.reconcile_timer = call_later(interval, self._sweep, args=[self.reconcile_generation])
+
+  def stop_reconciler(self):
+    with self.reconcile_lock:
+      self.reconciling = False
+      if self.reconcile_timer != None:
+        self.reconcile_timer.cancel()
+        self.reconcile_timer = None
+
+  def _sweep(self, generation):
+    try:
+      if self.open_order_count() > 0:
+        self.reconcile_orders()
+    finally:
+      interval = self.reconcile_interval()
+      with self.reconcile_lock:
+        if self.reconciling == True and generation == self.reconcile_generation:
+          self.reconcile_timer = call_later(interval, self._sweep, args=[generation])
 
   def add_order_subscription(self, order):
-    self.subscribed_orders[order.order_id] = order
+    with self.subscription_lock:
+      self.subscribed_orders[order.order_id] = order
     self.monitor_in_background()
+    self.start_reconciler()
 
   def remove_order_subscription(self, order_id, deactivate_monitoring=False):
-    if order_id in self.subscribed_orders:
-      del self.subscribed_orders[order_id]
-    if len(self.subscribed_orders) == 0 and deactivate_monitoring == True:
-      self.monitoring_active = False
\ No newline at end of file
+    with self.subscription_lock:
+      self.subscribed_orders.pop(order_id, None)
+      empty = len(self.subscribed_orders) == 0
+      if empty:
+        self.stop_reconciler() # under the lock, so a subscription added meanwhile starts it again
+    if empty and deactivate_monitoring == True:
+      self.stop_monitoring()
\ No newline at end of file
@@ -1,10 +1,41 @@
 import time
-from schwab.client import Client
+from schwab.client import Client, AsyncClient
 from schwab.streaming import StreamClient
 from schwab.utils import EnumEnforcer
 from schwab.auth import TokenMetadata
-from schwab_wetrade.user_session import UserSession
-from schwab_wetrade.utils import parse_response_data, log_in_background
+from schwab_wetrade.user_session import UserSession, AsyncUserSession, request_lane, current_lane
+from schwab_wetrade.stream_hub import StreamHub
+from schwab_wetrade.utils import ParsedResponse, log_in_background
+from schwab_wetrade.metrics import get_metrics
+
+
+REQUEST_LANES = { # Client method: TokenBucket lane
+  'place_order': 'orders',
+  'replace_order': 'orders',
+  'cancel_order': 'orders',
+  'get_order': 'orders',
+  'preview_order': 'orders',
+  'get_account': 'account',
+  'get_accounts': 'account',
+  'get_account_numbers': 'account',
+  'get_user_preferences': 'account',
+  'get_quote': 'quotes',
+  'get_quotes': 'quotes',
+  'get_option_chain': 'quotes',
+  'get_option_expiration_chain': 'quotes',
+  'get_movers': 'quotes',
+  'get_market_hours': 'quotes',
+  'get_instruments': 'quotes',
+  'get_instrument_by_cusip': 'quotes',
+  'get_orders_for_account': 'history',
+  'get_orders_for_all_linked_accounts': 'history',
+  'get_transactions': 'history',
+  'get_transaction': 'history'}
+
+def get_request_lane(func_name):
+  if func_name.startswith('get_price_history'):
+    return 'history'
+  return REQUEST_LANES.get(func_name, 'account')
 
 
 class APIClient(Client, StreamClient):
@@ -18,21 +49,92 @@ class APIClient(Client, StreamClient):
       enforce_enums=True,
       token_metadata=metadata)
     StreamClient.__init__(self, client=self)
+    self.stream_hub = StreamHub(self)
+    self.recorder = None
     for method_name in dir(Client):
       if method_name[0] != '_' and method_name[0].isupper() == False and method_name not in dir(EnumEnforcer):
         setattr(self, method_name, self.function_wrapper(method_name))
 
   def function_wrapper(self, func_name):
     func = getattr(super(), func_name)
+    lane = get_request_lane(func_name)
+    metrics = get_metrics()
     def wrap(*args, parsed_response=False, **kwargs):
-      r = func(*args, **kwargs)
+      start = time.perf_counter()
+      with request_lane(current_lane(default=lane)): # a lane set by the caller wins
+        r = func(*args, **kwargs)
+      metrics.observe_request(func_name, r.status_code, time.perf_counter() - start)
+      if self.recorder != None:
+        self.recorder.record_response(func_name, kwargs, r)
+      if parsed_response == True:
+        r = ParsedResponse(r)
+        log_in_background(
+          called_from = func_name, 
+          url = r.url,
+          r = r,
+          account_key = kwargs['account_hash'] if 'account_hash' in kwargs else '',
+          symbol = kwargs['symbol'] if 'symbol' in kwargs else '')
+        return (r.data, r.status_code)
+      return r
+    return wrap
+
+  def start_recording(self, path):
+    '''
+    Records stream messages and API responses to a file that :class:`ReplayClient <schwab_wetrade.replay.ReplayClient>` can replay
+
+    :param str path: the file to append recordings to (gzipped JSON lines)
+    '''
+    from schwab_wetrade.replay import Recorder
+    self.stop_recording()
+    self.recorder = self.stream_hub.recorder = Recorder(path)
+    return self.recorder
+
+  def stop_recording(self):
+    if self.recorder != None:
+      self.recorder.close()
+      self.recorder = self.stream_hub.recorder = None
+
+
+class AsyncAPIClient(AsyncClient):
+  '''
+  An asyncio version of APIClient; every Client method is a coroutine and accepts ``parsed_response``,
+  so many requests can run concurrently on one event loop without a thread per call
+
+  :param AsyncUserSession session: (optional) the session to make requests with
+  '''
+  def __init__(self, session:AsyncUserSession=None):
+    session = AsyncUserSession() if session == None else session
+    api_key = session.config['api_key']
+    metadata = TokenMetadata(session.session.token, int(time.time()), lambda token: None)
+    AsyncClient.__init__(self, 
+      api_key=api_key,
+      session=session,
+      enforce_enums=True,
+      token_metadata=metadata)
+    self.recorder = None
+    for method_name in dir(AsyncClient):
+      if method_name[0] != '_' and method_name[0].isupper() == False and method_name not in dir(EnumEnforcer) and method_name not in ('set_timeout', 'token_age', 'close_async_session'):
+        setattr(self, method_name, self.function_wrapper(method_name))
+
+  def function_wrapper(self, func_name):
+    func = getattr(super(), func_name)
+    lane = get_request_lane(func_name)
+    metrics = get_metrics()
+    async def wrap(*args, parsed_response=False, **kwargs):
+      start = time.perf_counter()
+      with request_lane(current_lane(default=lane)): # a lane set by the caller wins
+        r = await func(*args, **kwargs)
+      metrics.observe_request(func_name, r.status_code, time.perf_counter() - start)
+      if self.recorder != None:
+        self.recorder.record_response(func_name, kwargs, r)
       if parsed_response == True:
+        r = ParsedResponse(r)
         log_in_background(
           called_from = func_name, 
           url = r.url,
           r = r,
           account_key = kwargs['account_hash'] if 'account_hash' in kwargs else '',
           symbol = kwargs['symbol'] if 'symbol' in kwargs else '')
-        return (parse_response_data(r), r.status_code)
+        return (r.data, r.status_code)
       return r
-    return wrap
\ No newline at end of file
+    return wrap
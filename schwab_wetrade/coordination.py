@@ -0,0 +1,137 @@
+import os
+import json
+import mmap
+import struct
+import threading
+from contextlib import contextmanager
+try:
+  import fcntl
+except ModuleNotFoundError: # no flock (Windows); every process coordinates only with itself
+  fcntl = None
+
+
+@contextmanager
+def file_lock(path, shared=False):
+  '''
+  Holds an flock on path (created if missing) for the with block; shared locks let several readers in at once
+  '''
+  fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+  try:
+    if fcntl != None:
+      fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+    yield fd
+  finally:
+    os.close(fd) # closing the descriptor releases the lock
+
+def atomic_write_json(path, content):
+  '''
+  Writes content to a temporary file beside path and renames it into place, so readers never see a partial file
+  '''
+  tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+  try:
+    with open(tmp_path, 'w') as f:
+      json.dump(content, f)
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+  finally:
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+
+
+class LeaderLock:
+  '''
+  A non-blocking flock that makes one process the leader for a task; the lock is released when the leader exits or crashes,
+  so another process can take over
+
+  :param str path: the lock file shared by every process
+  '''
+  def __init__(self, path):
+    self.path = path
+    self.fd = None
+    self.lock = threading.Lock()
+
+  @property
+  def is_leader(self):
+    return self.fd != None or fcntl == None
+
+  def acquire(self):
+    '''
+    Returns True if this process is (or just became) the leader
+    '''
+    with self.lock:
+      if self.is_leader:
+        return True
+      fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+      try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except OSError:
+        os.close(fd)
+        return False
+      self.fd = fd
+      return True
+
+  def release(self):
+    with self.lock:
+      if self.fd != None:
+        os.close(self.fd)
+        self.fd = None
+
+
+class SharedBucketState:
+  '''
+  A lock for :class:`TokenBucket <schwab_wetrade.user_session.TokenBucket>` that loads the bucket's state from a shared
+  memory map when acquired and stores it back when released, holding an flock in between, so every process that shares
+  the same path draws from one request budget
+
+  Works with threading.Condition like the plain lock it replaces
+
+  :param str path: the state file shared by every process
+  :param bucket: the TokenBucket whose state is shared
+  '''
+  FIELDS = ('tokens', 'last_check', 'refill_rate', 'freeze_until', 'last_adjustment')
+  FORMAT = '<d5d' # initialized flag, then FIELDS
+
+  def __init__(self, path, bucket):
+    self.bucket = bucket
+    self.thread_lock = threading.Lock()
+    self.size = struct.calcsize(self.FORMAT)
+    self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    fcntl.flock(self.fd, fcntl.LOCK_EX)
+    try:
+      if os.fstat(self.fd).st_size < self.size:
+        os.ftruncate(self.fd, self.size)
+      self.map = mmap.mmap(self.fd, self.size)
+      if struct.unpack_from(self.FORMAT, self.map)[0] == 0: # first process in sets the starting state
+        self._store()
+      else:
+        self._load()
+    finally:
+      fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+  def _load(self):
+    values = struct.unpack_from(self.FORMAT, self.map)[1:]
+    for field, value in zip(self.FIELDS, values):
+      setattr(self.bucket, field, value)
+
+  def _store(self):
+    struct.pack_into(self.FORMAT, self.map, 0, 1, *(getattr(self.bucket, field) for field in self.FIELDS))
+
+  def acquire(self, blocking=True, timeout=-1):
+    if not self.thread_lock.acquire(blocking, timeout):
+      return False
+    fcntl.flock(self.fd, fcntl.LOCK_EX)
+    self._load()
+    return True
+
+  def release(self):
+    self._store()
+    fcntl.flock(self.fd, fcntl.LOCK_UN)
+    self.thread_lock.release()
+
+  def __enter__(self):
+    self.acquire()
+    return self
+
+  def __exit__(self, *args):
+    self.release()
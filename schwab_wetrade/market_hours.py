@@ -53,7 +53,7 @@ class MarketHours:
           time.strftime('%H:%M:%S', time.localtime()),
           self.date_str))
       return True
-    elif datetime.datetime.now(self.est) < self.close:
+    elif self.now_est() < self.close:
       return False
     else:
       log_in_background(
@@ -72,25 +72,25 @@ class MarketHours:
           time.strftime('%H:%M:%S', time.localtime()),
           self.date_str))
       return False
-    elif datetime.datetime.now(self.est) > self.open:
+    elif self.now_est() > self.open:
       return True
     else:
       return False
     
   def seconds_till_close(self):
     if self.close != None:
-      now = datetime.datetime.now(self.est)
+      now = self.now_est()
       return (self.close - now).total_seconds()
     
   def seconds_till_open(self):
     if self.open != None:
-      now = datetime.datetime.now(self.est)
+      now = self.now_est()
       return (self.open - now).total_seconds()
 
   def wait_for_market_open(self):
     if self.open == None:
       return
-    now = datetime.datetime.now(self.est)
+    now = self.now_est()
     if self.open > now:
       log_in_background(
         called_from = 'wait_for_market_open',
@@ -0,0 +1,206 @@
+import json
+import time
+import threading
+from bisect import bisect_left
+
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30) # seconds
+
+_default_metrics = None
+_default_metrics_lock = threading.Lock()
+
+def get_metrics():
+  '''
+  Returns the Metrics shared by every APIClient, TokenBucket and StreamHub in the process
+  '''
+  global _default_metrics
+  if _default_metrics == None:
+    with _default_metrics_lock:
+      if _default_metrics == None:
+        _default_metrics = Metrics()
+  return _default_metrics
+
+
+class Histogram:
+  '''
+  A cumulative histogram with fixed bucket upper bounds, in the Prometheus style
+
+  :param tuple buckets: (optional) sorted bucket upper bounds
+  '''
+  def __init__(self, buckets=LATENCY_BUCKETS):
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1) # the last count is for values above every bound
+    self.count = 0
+    self.sum = 0.0
+
+  def observe(self, value):
+    self.counts[bisect_left(self.buckets, value)] += 1
+    self.count += 1
+    self.sum += value
+
+  def quantile(self, q):
+    '''
+    Returns the upper bound of the bucket holding the q quantile
+    '''
+    if self.count == 0:
+      return 0.0
+    rank = q * self.count
+    total = 0
+    for bound, count in zip(self.buckets, self.counts):
+      total += count
+      if total >= rank:
+        return bound
+    return float('inf')
+
+  def snapshot(self):
+    return {
+      'count': self.count,
+      'sum': self.sum,
+      'mean': self.sum / self.count if self.count else 0.0,
+      'p50': self.quantile(.5),
+      'p90': self.quantile(.9),
+      'p99': self.quantile(.99),
+      'buckets': dict(zip([*map(str, self.buckets), '+Inf'], self.counts))}
+
+
+class Metrics:
+  '''
+  Collects request, rate limiter and stream metrics for the process; read them with :meth:`snapshot`,
+  :meth:`to_json` or :meth:`to_prometheus`
+
+  Set ``enabled`` to False to stop recording
+  '''
+  def __init__(self, buckets=LATENCY_BUCKETS):
+    self.buckets = buckets
+    self.enabled = True
+    self.lock = threading.Lock()
+    self.requests = {} # method: {'count': int, 'status': {code: int}, 'latency': Histogram}
+    self.limiter_wait = {} # lane: Histogram
+    self.stream_lag = {} # service: Histogram
+    self.handler_time = {} # service: Histogram
+    self.gauges = {} # name: function returning a number or a {label: number} dict
+    self.started = time.time()
+
+  def _histogram(self, histograms, key):
+    histogram = histograms.get(key)
+    if histogram == None:
+      histogram = histograms[key] = Histogram(self.buckets)
+    return histogram
+
+  def observe_request(self, method, status_code, seconds):
+    '''
+    Records an APIClient call
+
+    :param str method: the Client method name
+    :param int status_code: the response status code
+    :param float seconds: the time the call took, including waiting for the rate limiter
+    '''
+    if self.enabled:
+      with self.lock:
+        stats = self.requests.get(method)
+        if stats == None:
+          stats = self.requests[method] = {'count': 0, 'status': {}, 'latency': Histogram(self.buckets)}
+        stats['count'] += 1
+        stats['status'][status_code] = stats['status'].get(status_code, 0) + 1
+        stats['latency'].observe(seconds)
+
+  def observe_limiter_wait(self, lane, seconds):
+    if self.enabled:
+      with self.lock:
+        self._histogram(self.limiter_wait, lane).observe(seconds)
+
+  def observe_stream_lag(self, service, message):
+    '''
+    Records the time between a stream message's server timestamp and now
+    '''
+    if self.enabled and 'timestamp' in message:
+      lag = time.time() - message['timestamp'] / 1000
+      with self.lock: # every StreamHub (one per APIClient) and ReplayHub in the process writes here
+        self._histogram(self.stream_lag, service).observe(lag if lag > 0 else 0.0)
+
+  def observe_handler(self, service, seconds):
+    if self.enabled:
+      with self.lock:
+        self._histogram(self.handler_time, service).observe(seconds)
+
+  def add_gauge(self, name, func):
+    '''
+    Reports func() under name in every export; func returns a number or a dict of label: number
+    '''
+    with self.lock:
+      self.gauges[name] = func
+
+  def reset(self):
+    with self.lock:
+      self.requests.clear()
+      self.limiter_wait.clear()
+      self.stream_lag.clear()
+      self.handler_time.clear()
+      self.started = time.time()
+
+  def _read_gauges(self):
+    with self.lock:
+      gauges = dict(self.gauges)
+    values = {}
+    for name, func in gauges.items():
+      try:
+        values[name] = func()
+      except Exception:
+        pass
+    return values
+
+  def snapshot(self):
+    '''
+    Returns every metric as a dict of plain values
+    '''
+    gauges = self._read_gauges()
+    with self.lock:
+      return {
+        'started': self.started,
+        'time': time.time(),
+        'requests': {method: {
+          'count': stats['count'],
+          'status': {str(code): count for code, count in stats['status'].items()},
+          'latency': stats['latency'].snapshot()}
+          for method, stats in self.requests.items()},
+        'limiter_wait': {lane: histogram.snapshot() for lane, histogram in self.limiter_wait.items()},
+        'stream_lag': {service: histogram.snapshot() for service, histogram in self.stream_lag.items()},
+        'handler_time': {service: histogram.snapshot() for service, histogram in self.handler_time.items()},
+        'gauges': gauges}
+
+  def to_json(self):
+    return json.dumps(self.snapshot())
+
+  def to_prometheus(self):
+    '''
+    Returns every metric in the Prometheus text exposition format
+    '''
+    gauges = self._read_gauges()
+    lines = []
+    with self.lock:
+      lines += ['# TYPE schwab_wetrade_requests_total counter']
+      for method, stats in self.requests.items():
+        for code, count in stats['status'].items():
+          lines.append(f'schwab_wetrade_requests_total{{method="{method}",status="{code}"}} {count}')
+      histograms = [
+        ('schwab_wetrade_request_seconds', 'method', {method: stats['latency'] for method, stats in self.requests.items()}),
+        ('schwab_wetrade_limiter_wait_seconds', 'lane', self.limiter_wait),
+        ('schwab_wetrade_stream_lag_seconds', 'service', self.stream_lag),
+        ('schwab_wetrade_handler_seconds', 'service', self.handler_time)]
+      for name, label, by_label in histograms:
+        lines.append(f'# TYPE {name} histogram')
+        for value, histogram in by_label.items():
+          total = 0
+          for bound, count in zip([*map(str, histogram.buckets), '+Inf'], histogram.counts):
+            total += count
+            lines.append(f'{name}_bucket{{{label}="{value}",le="{bound}"}} {total}')
+          lines.append(f'{name}_sum{{{label}="{value}"}} {histogram.sum}')
+          lines.append(f'{name}_count{{{label}="{value}"}} {histogram.count}')
+    for name, value in gauges.items():
+      lines.append(f'# TYPE schwab_wetrade_{name} gauge')
+      if isinstance(value, dict):
+        for label, number in value.items():
+          lines.append(f'schwab_wetrade_{name}{{label="{label}"}} {number}')
+      else:
+        lines.append(f'schwab_wetrade_{name} {value}')
+    return '\n'.join(lines) + '\n'
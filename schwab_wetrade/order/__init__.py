@@ -1,5 +1,6 @@
 from .basic_order_types import MarketOrder, LimitOrder, StopOrder, StopLimitOrder
 from .multi_order import MultiOrder
+from .batch_order import BatchOrderSubmitter
 
 
 __all__ = (
@@ -7,4 +8,5 @@ __all__ = (
   'MarketOrder',
   'StopOrder',
   'StopLimitOrder',
-  'MultiOrder')
\ No newline at end of file
+  'MultiOrder',
+  'BatchOrderSubmitter')
\ No newline at end of file
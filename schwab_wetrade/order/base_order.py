@@ -1,8 +1,42 @@
 import time
+import threading
+from concurrent.futures import Future, InvalidStateError, CancelledError, ThreadPoolExecutor
 from contextlib import suppress
 from schwab_wetrade.api import APIClient
-from schwab_wetrade.account import Account
-from schwab_wetrade.utils import start_thread, log_in_background
+from schwab_wetrade.account import Account, FINAL_STATUSES
+from schwab_wetrade.order_store import average_fill_price
+from schwab_wetrade.utils import call_later, log_in_background
+
+
+class OrderStatusError(Exception):
+  '''
+  Raised by a :meth:`BaseOrder.when` future when the order reaches a final status other than the one awaited
+  '''
+  def __init__(self, order, status):
+    Exception.__init__(self, f'Order {order.order_id} {status}')
+    self.order = order
+    self.status = status
+
+_callback_executor = None
+_callback_executor_lock = threading.Lock()
+
+def get_callback_executor(max_workers=16):
+  '''
+  Returns the thread pool shared by :meth:`BaseOrder.run_when_status` callbacks, kept apart from the scheduler's pool so
+  callbacks that block (e.g. placing another order and waiting for it to fill) can't hold up reconciliation or timeouts
+  '''
+  global _callback_executor
+  with _callback_executor_lock:
+    if _callback_executor == None:
+      _callback_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='OrderCallback')
+    return _callback_executor
+
+def _resolve(future, result=None, exception=None):
+  with suppress(InvalidStateError): # already cancelled or timed out
+    if exception != None:
+      future.set_exception(exception)
+    else:
+      future.set_result(result)
 
 class BaseOrder:
   '''
@@ -25,11 +59,127 @@ class BaseOrder:
     self.order_type = self.order_type if hasattr(self, 'order_type') else 'LIMIT'
     self.security_type = self.security_type if hasattr(self, 'security_type') else 'EQUITY'
     self.order_id = 0
+    self.error = ''
+    self.placed_at = None
+    self.filled_quantity = 0
+    self.fill_price = 0.0 # average price of the shares filled so far
     self.updating = False
-    self.status = ''
-    self.disable_await_status = False
+    self.status_lock = threading.Lock()
+    self.status_futures = {} # status: [Future]
+    self._status = ''
+    self._disable_await_status = False
     self.subscribed = False
 
+  @property
+  def status(self):
+    return self._status
+
+  @status.setter
+  def status(self, status):
+    '''
+    Resolves the futures waiting on the new status, and fails every other waiting future once the status is final
+    '''
+    with self.status_lock:
+      self._status = status
+      resolved = self.status_futures.pop(status, [])
+      failed = []
+      if status in FINAL_STATUSES:
+        failed = [future for futures in self.status_futures.values() for future in futures]
+        self.status_futures.clear()
+    for future in resolved:
+      _resolve(future, self)
+    for future in failed:
+      _resolve(future, exception=OrderStatusError(self, status))
+    if status in FINAL_STATUSES and self.subscribed == True: # no more updates will come
+      self.cancel_subscription()
+
+  @property
+  def disable_await_status(self):
+    return self._disable_await_status
+
+  @disable_await_status.setter
+  def disable_await_status(self, disable):
+    '''
+    Setting this to True cancels every future waiting on a status
+    '''
+    self._disable_await_status = disable
+    if disable == True:
+      with self.status_lock:
+        futures = [future for futures in self.status_futures.values() for future in futures]
+        self.status_futures.clear()
+      for future in futures:
+        future.cancel()
+
+  def when(self, status, timeout=None):
+    '''
+    Returns a concurrent.futures.Future that resolves to the order once it reaches status; the account stream resolves it
+    directly, without a thread per waiting order. Use ``asyncio.wrap_future`` to await it
+
+    The future fails with :class:`OrderStatusError` if the order reaches a different final status, or TimeoutError
+    after timeout seconds; cancelling it stops waiting
+
+    :param str status: the status to wait for (WORKING, FILLED, CANCELED, EXPIRED, REJECTED, etc.)
+    :param float timeout: (optional) the most seconds to wait
+    '''
+    future = Future()
+    with self.status_lock:
+      current = self._status
+      if current != status and current not in FINAL_STATUSES:
+        self.status_futures.setdefault(status, []).append(future)
+    if current == status:
+      future.set_result(self)
+      return future
+    if current in FINAL_STATUSES:
+      future.set_exception(OrderStatusError(self, current))
+      return future
+    if timeout != None:
+      timer = call_later(timeout, _resolve, args=[future], kwargs={'exception': TimeoutError(f'Order {self.order_id} not {status} after {timeout} sec')})
+      future.add_done_callback(lambda future: timer.cancel())
+    future.add_done_callback(lambda future: self._discard_future(status, future))
+    self.create_subscription()
+    return future
+
+  def _discard_future(self, status, future):
+    with self.status_lock:
+      with suppress(KeyError, ValueError):
+        self.status_futures[status].remove(future)
+        if self.status_futures[status] == []:
+          del self.status_futures[status]
+
+  def run_when_status(self, status, func, func_args=[], func_kwargs={}, timeout=None):
+    '''
+    Runs func(*func_args, **func_kwargs) off the stream thread once the order reaches status; returns a Future for its result,
+    which fails like :meth:`when` if the status is never reached
+
+    :param str status: the status to wait for
+    :param func: the function to run
+    :param list func_args: (optional) a list of args for your function
+    :param dict func_kwargs: (optional) a dict containing kwargs for your function
+    :param float timeout: (optional) the most seconds to wait for status
+    '''
+    result = Future()
+    def run():
+      try:
+        _resolve(result, func(*func_args, **func_kwargs))
+      except Exception as e:
+        _resolve(result, exception=e)
+        log_in_background(
+          called_from = 'run_when_status',
+          tags = ['user-message'], 
+          account_key = self.account.account_key,
+          symbol = self.symbol,
+          message = '{}: Error running callback for order {} {}, check logs'.format(time.strftime('%H:%M:%S', time.localtime()), self.order_id, status),
+          e = e)
+    def chain(future):
+      if future.cancelled():
+        result.cancel()
+      elif future.exception() != None:
+        _resolve(result, exception=future.exception())
+      else:
+        get_callback_executor().submit(run)
+    self.when(status, timeout).add_done_callback(chain)
+    return result
+
   def __str__(self):
     return f'{self.order_type} Order to {self.action} {self.quantity} shares of {self.symbol} at ${self.price}'
 
@@ -61,6 +211,7 @@ class BaseOrder:
           time.strftime('%H:%M:%S', time.localtime()),
           self.order_id,
           self.account.account_key[:8]))
+      self.error = 'order already placed'
       return False
     # response, status_code = self.client.place_order(account_hash=self.account.account_key, order_spec=self.generate_order_payload())
     r = self.client.place_order(account_hash=self.account.account_key, order_spec=self.generate_order_payload())
@@ -68,6 +219,8 @@ class BaseOrder:
       location = r.headers.get('location', '')
       if location != '':
         self.order_id = location.split('/orders/')[1]
+        self.placed_at = time.time()
+        self.account.orders.add_order(self)
         log_in_background(
           called_from = 'place_order',
           tags = ['user-message'], 
@@ -86,6 +239,7 @@ class BaseOrder:
     message = ''
     with suppress(Exception):
       message = r.json()['message']
+    self.error = message or f'status {r.status_code}'
     log_in_background(
       called_from = 'place_order',
       tags = ['user-message'], 
@@ -105,10 +259,10 @@ class BaseOrder:
 
   def create_subscription(self):
     if self.subscribed == False and self.order_id != 0:
-      self.check_status() # check current status
       self.account.add_order_subscription(self)
       self.subscribed = True
-      start_thread(self._delayed_check_status, args=[5]) # check status again in case something happened while subscribing
+      self.account.request_reconciliation([self.order_id]) # batched with other orders subscribing at the same time
+      call_later(5, self.account.request_reconciliation, args=[[self.order_id]]) # check again in case something happened while subscribing
 
   def cancel_subscription(self):
     self.account.remove_order_subscription(self.order_id, deactivate_monitoring=False)
@@ -149,12 +303,42 @@ class BaseOrder:
       response, status_code = self.client.get_order(parsed_response=True, order_id=self.order_id, account_hash=self.account.account_key)
       # response, status_code = self.client.get_order(parsed_response=True, order_id=self.order_id, account_hash=self.account.account_key, symbol=self.symbol) can log symbol if update schwab_py.BaseClient.get_order(add * after args) why does parsed_response work though
       if status_code == 200:
-        status = self.status = response['status']
-        if status == 'EXECUTED':
-          self.price = response['price']
-        elif status =='FILLED':
-          self.price = response['orderActivityCollection'][0]['executionLegs'][0]['price']
-        return status
+        self.apply_order_response(response)
+        return self.status
+
+  def apply_update(self, status=None, filled_quantity=None, fill_price=None):
+    '''
+    Applies a status, filled quantity or average fill price from the account stream or the REST API in place; returns True if anything changed
+
+    price keeps the order's limit price until the order fills, then takes the fill price
+    '''
+    changed = False
+    if filled_quantity != None and filled_quantity != self.filled_quantity:
+      self.filled_quantity = filled_quantity
+      changed = True
+    if fill_price != None and fill_price != self.fill_price:
+      self.fill_price = fill_price
+      changed = True
+    if fill_price != None and status in ('FILLED', 'EXECUTED'):
+      self.price = fill_price
+    if changed or (status != None and status != self.status):
+      self.account.orders.update(self.order_id, status=status, filled_quantity=filled_quantity, fill_price=fill_price)
+    if status != None and status != self.status:
+      self.status = status # set last so futures resolve with the fill price
+      changed = True
+    return changed
+
+  def apply_order_response(self, response):
+    '''
+    Applies an order from a get_order or get_orders_for_account response; returns True if anything changed
+    '''
+    status = response['status']
+    price = None
+    with suppress(LookupError, TypeError, ZeroDivisionError):
+      price = average_fill_price(response)
+      if price == None and status == 'EXECUTED':
+        price = response['price']
+    return self.apply_update(status=status, filled_quantity=response.get('filledQuantity'), fill_price=price)
  
   def cancel_order(self):
     '''Cancels your active, already-placed order'''
@@ -168,36 +352,36 @@ class BaseOrder:
       symbol = self.symbol,
       message = '{}: Order {} REJECTED - no longer waiting (Account: {})'.format(time.strftime('%H:%M:%S', time.localtime()), self.order_id, self.account.account_key[:8]))
     
-  def wait_for_status(self, status, then=None, args=[], kwargs={}):
+  def wait_for_status(self, status, then=None, args=[], kwargs={}, timeout=None):
     '''
     Waits for your order to reach your specified status then runs an optional callback function
-    Need to run create_subscription() in order to keep order status updated live
+    Subscribes the order to account updates while waiting
     
-    :param str status: the status to wait for (OPEN, EXECUTED, CANCELED, INDIVIDUAL_FILLS, CANCEL_REQUESTED, EXPIRED, REJECTED)
+    :param str status: the status to wait for (WORKING, FILLED, CANCELED, EXPIRED, REJECTED, etc.)
     :param then: (optional) a callback function to run after waiting for status
     :param list args: a list of args for your function
     :param dict kwargs: a dict containing kwargs for your function
+    :param float timeout: (optional) the most seconds to wait
     '''
-    self.create_subscription() # subscribe if not already subscribed
-    waiting = True if self.order_id != 0 else False
-    stop_for = ('CANCELED','EXECUTED','EXPIRED')
-    while waiting and self.disable_await_status == False:
-      if self.updating == False:
-        if self.status in (*stop_for, 'REJECTED', status):
-          self.cancel_subscription()
-        if self.status == 'REJECTED': # special handling for rejected orders
-          return self._handle_rejected_order()
-        if self.status == status:
-          if then:
-            return then(*args, **kwargs)
-          else:
-            return
-        elif self.status in stop_for:
-          log_in_background(
-            called_from = 'wait_for_status',
-            tags = ['user-message'], 
-            account_key = self.account_key,
-            symbol = self.symbol,
-            message = '{}: Order # {} {} - no longer waiting (Account: {})'.format(time.strftime('%H:%M:%S', time.localtime()), self.order_id, self.status, self.account.account_key[:8]))
-          return
-      time.sleep(.2)
\ No newline at end of file
+    if self.order_id == 0 or self.disable_await_status == True:
+      return
+    future = self.when(status, timeout)
+    try:
+      future.result()
+    except OrderStatusError as e:
+      if e.status == 'REJECTED': # special handling for rejected orders
+        return self._handle_rejected_order()
+      log_in_background(
+        called_from = 'wait_for_status',
+        tags = ['user-message'], 
+        account_key = self.account.account_key,
+        symbol = self.symbol,
+        message = '{}: Order # {} {} - no longer waiting (Account: {})'.format(time.strftime('%H:%M:%S', time.localtime()), self.order_id, e.status, self.account.account_key[:8]))
+      return
+    except (TimeoutError, CancelledError):
+      return
+    finally:
+      if self.subscribed == True and self.status_futures == {}:
+        self.cancel_subscription()
+    if then:
+      return then(*args, **kwargs)
@@ -0,0 +1,68 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from schwab_wetrade.utils import log_in_background
+
+
+class BatchOrderSubmitter:
+  '''
+  Places many orders at once, sending them concurrently through the client's shared rate limiter instead of one round trip
+  after another
+
+  Any order with a ``place_order`` method works (LimitOrder, MarketOrder, MultiOrder, etc.)
+
+  :param int max_workers: (optional) the most orders in flight at once
+  '''
+  def __init__(self, max_workers=8):
+    self.max_workers = max_workers
+    self._executor = None
+    self._executor_lock = threading.Lock()
+
+  def _place(self, order):
+    start = time.perf_counter()
+    error = ''
+    try:
+      placed = order.place_order()
+      if placed == False:
+        error = getattr(order, 'error', '') or 'order not placed'
+    except Exception as e:
+      placed = False
+      error = repr(e)
+      log_in_background(
+        called_from = 'BatchOrderSubmitter',
+        tags = ['user-message'],
+        message = time.strftime('%H:%M:%S', time.localtime()) + ': Error placing order',
+        e = e,
+        symbol = getattr(order, 'symbol', ''))
+    return {
+      'order': order,
+      'placed': placed,
+      'order_id': order.order_id if placed else None,
+      'error': error,
+      'seconds': time.perf_counter() - start}
+
+  def submit(self, orders, subscribe=False):
+    '''
+    Places orders concurrently and returns one result per order, in the same order:
+    ``{'order', 'placed', 'order_id', 'error', 'seconds'}``
+
+    :param list orders: the orders to place
+    :param bool subscribe: (optional) subscribe each placed order to account updates
+    '''
+    with self._executor_lock:
+      if self._executor == None:
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='BatchOrder')
+      futures = [self._executor.submit(self._place, order) for order in orders]
+    results = [future.result() for future in futures]
+    if subscribe == True:
+      for result in results: # subscribe here so the initial status checks share one reconciliation request
+        if result['placed'] and hasattr(result['order'], 'create_subscription'):
+          result['order'].create_subscription()
+    return results
+
+  def close(self):
+    with self._executor_lock:
+      executor, self._executor = self._executor, None
+    if executor != None:
+      executor.shutdown(wait=True)
+    self._executor_lock = threading.Lock()
@@ -24,6 +24,8 @@ class MultiOrder:
     self.order_type = self.order_type if hasattr(self, 'order_type') else 'MARKET'
     self.security_type = self.security_type if hasattr(self, 'security_type') else 'EQUITY'
     self.order_id = 0
+    self.placed_at = None
+    self.error = ''
     self.updating = False
     self.status = ''
     self.disable_await_status = False
@@ -53,6 +55,8 @@ class MultiOrder:
       location = r.headers.get('location', '')
       if location != '':
         self.order_id = location.split('/orders/')[1]
+        self.placed_at = time.time()
+        self.account.orders.add_order(self)
         log_in_background(
           called_from = 'place_order',
           tags = ['user-message'], 
@@ -69,6 +73,7 @@ class MultiOrder:
     message = ''
     with suppress(Exception):
       message = r.json()['message']
+    self.error = message or f'status {r.status_code}'
     log_in_background(
       called_from = 'place_order',
       tags = ['user-message'], 
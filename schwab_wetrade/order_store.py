@@ -0,0 +1,310 @@
+import json
+import time
+import sqlite3
+import datetime
+import threading
+from bisect import bisect_left, insort
+from contextlib import suppress
+
+
+OPEN_STATUSES = ('AWAITING_PARENT_ORDER', 'AWAITING_CONDITION', 'AWAITING_STOP_CONDITION', 'AWAITING_MANUAL_REVIEW', 'ACCEPTED',
+  'AWAITING_UR_OUT', 'PENDING_ACTIVATION', 'QUEUED', 'WORKING', 'PENDING_CANCEL', 'PENDING_REPLACE', 'NEW', 'AWAITING_RELEASE_TIME',
+  'PENDING_ACKNOWLEDGEMENT', 'PENDING_RECALL', '')
+
+def parse_order_time(value):
+  '''
+  Parses an order timestamp like "2024-03-12T14:02:11+0000" into epoch seconds, or returns None
+  '''
+  with suppress(TypeError, ValueError):
+    return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S%z').timestamp()
+  return None
+
+def average_fill_price(response):
+  '''
+  Returns the quantity-weighted average price of every execution leg in an order response, or None if it has none
+  '''
+  filled = total = 0
+  for activity in response.get('orderActivityCollection', []):
+    for leg in activity.get('executionLegs', []):
+      if leg.get('quantity') != None and leg.get('price') != None:
+        filled += leg['quantity']
+        total += leg['quantity'] * leg['price']
+  return total / filled if filled else None
+
+
+class StoredOrder:
+  '''
+  An order as kept by :class:`OrderStore`; has the attributes account stream updates are decoded against
+  '''
+  FIELDS = ('order_id', 'symbol', 'action', 'order_type', 'quantity', 'status', 'filled_quantity', 'price', 'fill_price', 'placed_at', 'updated_at', 'legs')
+
+  def __init__(self, order_id, symbol='', action='', order_type='', quantity=0, status='', filled_quantity=0, price=0.0, fill_price=0.0, placed_at=None, updated_at=None, legs=None):
+    self.order_id = str(order_id)
+    self.symbol = symbol # the first leg's symbol for multi-leg orders
+    self.legs = {} if legs == None else legs # symbol: quantity, for multi-leg orders
+    self.action = action
+    self.order_type = order_type
+    self.quantity = quantity
+    self.status = status
+    self.filled_quantity = filled_quantity
+    self.price = price # the order's price
+    self.fill_price = fill_price # the average price of the shares filled so far
+    self.placed_at = placed_at
+    self.updated_at = updated_at
+    self.fills = [] # [{'order_id', 'symbol', 'time', 'quantity', 'price'}] oldest first
+
+  @property
+  def symbols(self):
+    return list(self.legs) if self.legs else [self.symbol]
+
+  @property
+  def is_open(self):
+    return self.status in OPEN_STATUSES
+
+  def to_dict(self):
+    return {field: getattr(self, field) for field in self.FIELDS}
+
+  def __repr__(self):
+    return 'StoredOrder({})'.format(', '.join(f'{field}={getattr(self, field)!r}' for field in self.FIELDS[:7]))
+
+
+class OrderStore:
+  '''
+  Keeps an account's orders and fills in memory, indexed by order id, symbol, status and placement time, so order
+  queries are answered without a request; :class:`Account <schwab_wetrade.account.Account>` fills it from placed orders,
+  account stream updates, reconciliation sweeps and :meth:`Account.bootstrap_orders`
+
+  Snapshots can be written to and read from SQLite with :meth:`save` and :meth:`load`
+  '''
+  def __init__(self):
+    self.lock = threading.RLock()
+    self.orders = {} # order_id: StoredOrder
+    self.symbols = {} # symbol: {order_id}
+    self.statuses = {} # status: {order_id}
+    self.placed = [] # (placed_at, order_id) sorted
+    self.fills = [] # fills sorted by time
+    self.fill_times = [] # fill times, parallel to fills
+    self.last_updated = None
+
+  def __len__(self):
+    return len(self.orders)
+
+  def __contains__(self, order_id):
+    return str(order_id) in self.orders
+
+  def get(self, order_id):
+    return self.orders.get(str(order_id))
+
+  def _index(self, order):
+    for symbol in order.symbols:
+      self.symbols.setdefault(symbol, set()).add(order.order_id)
+    self.statuses.setdefault(order.status, set()).add(order.order_id)
+    if order.placed_at != None:
+      insort(self.placed, (order.placed_at, order.order_id))
+
+  def _unindex(self, order):
+    for symbol in order.symbols:
+      self.symbols.get(symbol, set()).discard(order.order_id)
+    self.statuses.get(order.status, set()).discard(order.order_id)
+    if order.placed_at != None:
+      i = bisect_left(self.placed, (order.placed_at, order.order_id))
+      if i < len(self.placed) and self.placed[i] == (order.placed_at, order.order_id):
+        del self.placed[i]
+
+  def upsert(self, order_id, **fields):
+    '''
+    Adds an order or updates its fields (any of :attr:`StoredOrder.FIELDS`), keeping the indexes current; returns the StoredOrder
+    '''
+    order_id = str(order_id)
+    with self.lock:
+      order = self.orders.get(order_id)
+      if order == None:
+        order = self.orders[order_id] = StoredOrder(order_id)
+      else:
+        self._unindex(order)
+      for field, value in fields.items():
+        if value != None:
+          setattr(order, field, value)
+      order.updated_at = self.last_updated = time.time() if fields.get('updated_at') == None else fields['updated_at']
+      self._index(order)
+      return order
+
+  def _add_fill(self, order, fill_time, quantity, price):
+    fill = {'order_id': order.order_id, 'symbol': order.symbol, 'time': fill_time, 'quantity': quantity, 'price': price}
+    order.fills.append(fill)
+    i = bisect_left(self.fill_times, fill_time + 1e-9) # after fills at the same time
+    self.fill_times.insert(i, fill_time)
+    self.fills.insert(i, fill)
+
+  def _set_fills(self, order, fills):
+    if order.fills != []:
+      old = set(map(id, order.fills))
+      kept = [(t, fill) for t, fill in zip(self.fill_times, self.fills) if id(fill) not in old]
+      self.fill_times = [t for t, fill in kept]
+      self.fills = [fill for t, fill in kept]
+      order.fills = []
+    for fill_time, quantity, price in sorted(fills):
+      self._add_fill(order, fill_time, quantity, price)
+
+  def add_order(self, order):
+    '''
+    Adds a just placed :class:`BaseOrder <schwab_wetrade.order.base_order.BaseOrder>` or
+    :class:`MultiOrder <schwab_wetrade.order.multi_order.MultiOrder>`
+    '''
+    legs = dict(getattr(order, 'symbol_quantities', {}))
+    return self.upsert(
+      order.order_id,
+      symbol = getattr(order, 'symbol', next(iter(legs), '')),
+      legs = legs,
+      action = order.action,
+      order_type = getattr(order, 'order_type', ''),
+      quantity = getattr(order, 'quantity', sum(legs.values())),
+      status = order.status,
+      filled_quantity = getattr(order, 'filled_quantity', 0),
+      price = getattr(order, 'price', None),
+      fill_price = getattr(order, 'fill_price', None),
+      placed_at = getattr(order, 'placed_at', None) or time.time())
+
+  def update(self, order_id, status=None, filled_quantity=None, fill_price=None):
+    '''
+    Applies an order update from the account stream or an order object; an increase in filled quantity is recorded as a fill
+    at the price implied by the new average fill price
+    '''
+    with self.lock:
+      order = self.get(order_id)
+      if order == None:
+        return None
+      if filled_quantity != None and filled_quantity > order.filled_quantity:
+        quantity = filled_quantity - order.filled_quantity
+        price = fill_price if fill_price != None else order.fill_price
+        if fill_price != None and order.filled_quantity > 0:
+          price = (fill_price * filled_quantity - order.fill_price * order.filled_quantity) / quantity
+        self._add_fill(order, time.time(), quantity, price)
+      return self.upsert(order_id, status=status, filled_quantity=filled_quantity, fill_price=fill_price)
+
+  def add_order_response(self, response):
+    '''
+    Adds or updates an order from a get_order or get_orders_for_account response, including its execution legs as fills
+    '''
+    legs = response.get('orderLegCollection') or [{}]
+    instrument = legs[0].get('instrument', {})
+    executions = []
+    for activity in response.get('orderActivityCollection', []):
+      for leg in activity.get('executionLegs', []):
+        fill_time = parse_order_time(leg.get('time'))
+        if fill_time != None and leg.get('quantity') != None and leg.get('price') != None:
+          executions.append((fill_time, leg['quantity'], leg['price']))
+    fill_price = average_fill_price(response)
+    with self.lock:
+      order = self.upsert(
+        response['orderId'],
+        symbol = instrument.get('symbol'),
+        legs = {leg.get('instrument', {}).get('symbol'): leg.get('quantity') for leg in legs} if len(legs) > 1 else None,
+        action = legs[0].get('instruction'),
+        order_type = response.get('orderType'),
+        quantity = response.get('quantity'),
+        status = response.get('status'),
+        filled_quantity = response.get('filledQuantity'),
+        price = response.get('price'),
+        fill_price = fill_price,
+        placed_at = parse_order_time(response.get('enteredTime')))
+      if executions != []:
+        self._set_fills(order, executions)
+      return order
+
+  def by_symbol(self, symbol, status=None):
+    with self.lock:
+      order_ids = self.symbols.get(symbol, set())
+      if status != None:
+        order_ids = order_ids & self.statuses.get(status, set())
+      return [self.orders[order_id] for order_id in order_ids]
+
+  def by_status(self, status):
+    with self.lock:
+      return [self.orders[order_id] for order_id in self.statuses.get(status, ())]
+
+  def open_orders(self, symbol=None):
+    '''
+    Returns orders that haven't reached a final status, optionally for one symbol
+    '''
+    with self.lock:
+      order_ids = set().union(*(self.statuses.get(status, ()) for status in OPEN_STATUSES))
+      if symbol != None:
+        order_ids &= self.symbols.get(symbol, set())
+      return [self.orders[order_id] for order_id in order_ids]
+
+  def placed_between(self, start=None, end=None):
+    '''
+    Returns orders placed between start and end (epoch seconds or datetimes), oldest first
+    '''
+    start, end = [value.timestamp() if isinstance(value, datetime.datetime) else value for value in (start, end)]
+    with self.lock:
+      i = 0 if start == None else bisect_left(self.placed, (start, ''))
+      j = len(self.placed) if end == None else bisect_left(self.placed, (end, chr(0x10ffff)))
+      return [self.orders[order_id] for placed_at, order_id in self.placed[i:j]]
+
+  def fills_since(self, seconds=None, since=None, symbol=None):
+    '''
+    Returns fills from the last seconds, or since a time (epoch seconds or datetime), oldest first
+
+    :param float seconds: (optional) how far back to look
+    :param since: (optional) the earliest fill time
+    :param str symbol: (optional) only return fills for this symbol
+    '''
+    if seconds != None:
+      since = time.time() - seconds
+    elif isinstance(since, datetime.datetime):
+      since = since.timestamp()
+    with self.lock:
+      fills = self.fills[0 if since == None else bisect_left(self.fill_times, since):]
+    return fills if symbol == None else [fill for fill in fills if fill['symbol'] == symbol]
+
+  def clear(self):
+    with self.lock:
+      self.orders.clear()
+      self.symbols.clear()
+      self.statuses.clear()
+      self.placed = []
+      self.fills = []
+      self.fill_times = []
+      self.last_updated = None
+
+  def save(self, path):
+    '''
+    Writes every order and fill to a SQLite file, replacing its previous snapshot
+    '''
+    with self.lock:
+      orders = [(order.order_id, json.dumps(order.to_dict())) for order in self.orders.values()]
+      fills = [(fill['order_id'], fill['time'], fill['quantity'], fill['price']) for fill in self.fills]
+    db = sqlite3.connect(path)
+    try:
+      with db:
+        db.execute('CREATE TABLE IF NOT EXISTS orders (order_id TEXT PRIMARY KEY, data TEXT)')
+        db.execute('CREATE TABLE IF NOT EXISTS fills (order_id TEXT, time REAL, quantity REAL, price REAL)')
+        db.execute('DELETE FROM orders')
+        db.execute('DELETE FROM fills')
+        db.executemany('INSERT INTO orders VALUES (?, ?)', orders)
+        db.executemany('INSERT INTO fills VALUES (?, ?, ?, ?)', fills)
+    finally:
+      db.close()
+
+  def load(self, path):
+    '''
+    Replaces the store's contents with a snapshot written by :meth:`save`; returns the number of orders loaded
+    '''
+    db = sqlite3.connect(path)
+    try:
+      orders = db.execute('SELECT data FROM orders').fetchall()
+      fills = db.execute('SELECT order_id, time, quantity, price FROM fills ORDER BY time').fetchall()
+    finally:
+      db.close()
+    with self.lock:
+      self.clear()
+      for (data,) in orders:
+        fields = json.loads(data)
+        self.upsert(fields.pop('order_id'), **fields)
+      for order_id, fill_time, quantity, price in fills:
+        if order_id in self.orders:
+          self._add_fill(self.orders[order_id], fill_time, quantity, price)
+      self.last_updated = max([order.updated_at for order in self.orders.values() if order.updated_at != None], default=None)
+    return len(orders)
@@ -1,9 +1,25 @@
+import importlib
 from .quote import Quote
-from .data_frame_quote import DataFrameQuote
 from .multi_quote import MultiQuote
 
 
+_lazy_imports = { # loaded on first access (PEP 562) so importing schwab_wetrade doesn't load numpy, polars or pandas
+  'DataFrameQuote': '.data_frame_quote',
+  'BarAggregator': '.bar_aggregator'}
+
+def __getattr__(name):
+  if name in _lazy_imports:
+    value = getattr(importlib.import_module(_lazy_imports[name], __name__), name)
+    globals()[name] = value
+    return value
+  raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+def __dir__():
+  return sorted([*globals(), *_lazy_imports])
+
+
 __all__ = (
   'Quote',
   'DataFrameQuote',
-  'MultiQuote')
\ No newline at end of file
+  'MultiQuote',
+  'BarAggregator')
@@ -0,0 +1,239 @@
+import time
+import threading
+import numpy as np
+from schwab_wetrade.utils import log_in_background, start_thread
+
+
+INTERVALS = {'1s': 1000, '5s': 5000, '1m': 60000, '5m': 300000}
+
+BAR_FIELDS = ('start', 'open', 'high', 'low', 'close', 'volume', 'vwap', 'trades')
+
+
+class BarRing:
+  '''
+  A fixed-size ring of closed bars for one symbol and interval stored in NumPy arrays
+  '''
+  def __init__(self, size):
+    self.size = size
+    self.start = np.zeros(size, dtype=np.int64)
+    self.open = np.zeros(size, dtype=np.float64)
+    self.high = np.zeros(size, dtype=np.float64)
+    self.low = np.zeros(size, dtype=np.float64)
+    self.close = np.zeros(size, dtype=np.float64)
+    self.volume = np.zeros(size, dtype=np.int64)
+    self.vwap = np.zeros(size, dtype=np.float64)
+    self.trades = np.zeros(size, dtype=np.int64)
+    self.count = 0
+
+  def __len__(self):
+    return min(self.count, self.size)
+
+  def append(self, bar):
+    i = self.count % self.size
+    for field in BAR_FIELDS:
+      getattr(self, field)[i] = bar[field]
+    self.count += 1
+
+  def last(self, n=None):
+    '''
+    Returns a dict of arrays containing the last n bars, oldest first
+    '''
+    length = len(self)
+    n = length if n == None else min(n, length)
+    order = (np.arange(self.count - n, self.count) % self.size)
+    return {field: getattr(self, field)[order] for field in BAR_FIELDS}
+
+
+class BarAggregator:
+  '''
+  Builds OHLCV and VWAP bars incrementally from level one trades
+
+  Feed it from any Quote or MultiQuote by setting its bar_aggregator, or pass stream messages to
+  :meth:`handle_message` yourself. Bars close on wall-clock boundaries even when no trades arrive
+
+  :param tuple intervals: (optional) bar intervals to build ('1s', '5s', '1m', '5m')
+  :param int ring_size: (optional) the number of closed bars kept per symbol and interval
+  :param float close_delay: (optional) seconds after a boundary to wait for late ticks before closing a bar
+  '''
+  def __init__(self, intervals=('1s', '5s', '1m', '5m'), ring_size=1000, close_delay=.05):
+    self.intervals = {interval: INTERVALS[interval] for interval in intervals}
+    self.ring_size = ring_size
+    self.close_delay = close_delay
+    self.open_bars = {} # (symbol, interval): bar dict
+    self.last_trades = {} # symbol: {'price', 'size', 'time', 'volume'} from the stream so far
+    self.rings = {} # (symbol, interval): BarRing
+    self.callbacks = {interval: [] for interval in self.intervals}
+    self.lock = threading.Lock()
+    self.running = False
+
+  def on_bar(self, interval, func):
+    '''
+    Runs func(symbol, interval, bar) every time a bar closes
+
+    :param str interval: the bar interval ('1s', '5s', '1m', '5m')
+    :param func: a callback function
+    '''
+    self.callbacks[interval].append(func)
+    self.start()
+
+  def start(self):
+    '''
+    Starts the thread that closes bars on wall-clock boundaries
+    '''
+    with self.lock:
+      start = self.running == False
+      self.running = True
+    if start:
+      start_thread(self._run, name='BarAggregator', daemon=True)
+
+  def stop(self):
+    with self.lock:
+      self.running = False
+
+  def handle_message(self, message):
+    '''
+    Updates bars from a level one stream message
+
+    Stream messages only carry the fields that changed, so the last price, size, trade time and volume are kept per symbol
+    and a trade is counted when the trade time or the cumulative volume changes
+    '''
+    trades = []
+    with self.lock:
+      for quote in message.get('content', []):
+        trade = self._merge_trade(quote, message.get('timestamp'))
+        if trade != None:
+          trades.append(trade)
+    for trade in trades:
+      self.update(*trade)
+
+  def _merge_trade(self, quote, timestamp):
+    last = self.last_trades.get(quote['key'])
+    if last == None:
+      last = self.last_trades[quote['key']] = {'price': None, 'size': 0, 'time': None, 'volume': None}
+    previous_time, previous_volume = last['time'], last['volume']
+    for field, name in (('LAST_PRICE', 'price'), ('LAST_SIZE', 'size'), ('TRADE_TIME_MILLIS', 'time'), ('TOTAL_VOLUME', 'volume')):
+      if field in quote:
+        last[name] = quote[field]
+    if last['price'] == None:
+      return None
+    traded = last['time'] != previous_time or last['volume'] != previous_volume
+    if last['time'] == None and last['volume'] == None:
+      traded = 'LAST_PRICE' in quote # no trade time or volume to compare, so every price is a new trade
+    if not traded:
+      return None
+    size = last['size']
+    if previous_volume != None and last['volume'] != None and last['volume'] > previous_volume:
+      size = last['volume'] - previous_volume # covers trades that happened between messages
+    time_ms = last['time'] if last['time'] != None else (timestamp if timestamp != None else int(time.time() * 1000))
+    return quote['key'], last['price'], size, time_ms
+
+  def update(self, symbol, price, size, time_ms):
+    '''
+    Adds a trade to the open bars for symbol
+
+    :param str symbol: the symbol of the security
+    :param float price: the trade price
+    :param int size: the trade size
+    :param int time_ms: the epoch trade time in milliseconds
+    '''
+    closed = []
+    with self.lock:
+      for interval, interval_ms in self.intervals.items():
+        key = (symbol, interval)
+        start = time_ms - time_ms % interval_ms
+        bar = self.open_bars.get(key)
+        if bar != None and start > bar['start']:
+          closed.append(self._close_bar(key, bar))
+          closed += self._fill_gap(key, bar, start, interval_ms)
+          bar = None
+        if bar == None:
+          bar = self.open_bars[key] = self._new_bar(start, price)
+        elif bar['trades'] == 0: # first trade in a bar opened on a wall-clock boundary
+          bar['open'] = bar['high'] = bar['low'] = price
+        bar['high'] = max(bar['high'], price)
+        bar['low'] = min(bar['low'], price)
+        bar['close'] = price
+        bar['volume'] += size
+        bar['notional'] += price * size
+        bar['trades'] += 1
+    self._run_callbacks(closed)
+
+  def _new_bar(self, start, price):
+    return {'start': start, 'open': price, 'high': price, 'low': price, 'close': price, 'volume': 0, 'notional': 0.0, 'trades': 0}
+
+  def _close_bar(self, key, bar):
+    bar['vwap'] = bar['notional'] / bar['volume'] if bar['volume'] > 0 else bar['close']
+    if key not in self.rings:
+      self.rings[key] = BarRing(self.ring_size)
+    self.rings[key].append(bar)
+    self.open_bars.pop(key, None)
+    return key, bar
+
+  def _fill_gap(self, key, last_bar, until, interval_ms):
+    closed = []
+    start = last_bar['start'] + interval_ms
+    while start < until: # flat bars for intervals with no trades
+      bar = self._new_bar(start, last_bar['close'])
+      closed.append(self._close_bar(key, bar))
+      start += interval_ms
+    return closed
+
+  def close_due_bars(self, now_ms=None):
+    '''
+    Closes every open bar whose interval has ended, opening flat bars for symbols with no new trades
+    '''
+    now_ms = int(time.time() * 1000) if now_ms == None else now_ms
+    closed = []
+    with self.lock:
+      for key, bar in list(self.open_bars.items()):
+        interval_ms = self.intervals[key[1]]
+        if bar['start'] + interval_ms <= now_ms:
+          closed.append(self._close_bar(key, bar))
+          closed += self._fill_gap(key, bar, now_ms - now_ms % interval_ms, interval_ms)
+          self.open_bars[key] = self._new_bar(now_ms - now_ms % interval_ms, bar['close'])
+    self._run_callbacks(closed)
+    return closed
+
+  def _run_callbacks(self, closed):
+    for (symbol, interval), bar in closed:
+      for func in self.callbacks[interval]:
+        try:
+          func(symbol, interval, bar)
+        except Exception as e:
+          log_in_background(
+            called_from = 'BarAggregator._run_callbacks',
+            tags = ['user-message'],
+            symbol = symbol,
+            message = time.strftime('%H:%M:%S', time.localtime()) + f': Error in {interval} bar callback for {symbol}, check logs',
+            e = e)
+
+  def _run(self):
+    step_ms = min(self.intervals.values())
+    while self.running == True:
+      now_ms = int(time.time() * 1000)
+      next_boundary = now_ms - now_ms % step_ms + step_ms
+      time.sleep((next_boundary - now_ms) / 1000 + self.close_delay)
+      self.close_due_bars(next_boundary)
+
+  def get_bars(self, symbol, interval, n=None):
+    '''
+    Returns a dict of NumPy arrays (start, open, high, low, close, volume, vwap, trades) with the last n closed bars, oldest first
+
+    :param str symbol: the symbol of the security
+    :param str interval: the bar interval ('1s', '5s', '1m', '5m')
+    :param int n: (optional) the number of bars to return
+    '''
+    with self.lock:
+      ring = self.rings.get((symbol, interval))
+      if ring == None:
+        return {field: np.array([]) for field in BAR_FIELDS}
+      return ring.last(n)
+
+  def last_bar(self, symbol, interval):
+    '''
+    Returns the most recently closed bar as a dict, or None
+    '''
+    bars = self.get_bars(symbol, interval, 1)
+    if len(bars['start']) == 0:
+      return None
+    return {field: bars[field][0].item() for field in BAR_FIELDS}
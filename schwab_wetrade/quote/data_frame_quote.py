@@ -1,10 +1,8 @@
-import time
 import datetime
-import pickle
-import google.cloud.storage
-import polars as pl 
-import pandas as pd
 from .quote import Quote
+from .rolling_window import RollingWindows
+from .tick_buffer import TickBuffer
+from .tick_writer import TickWriter, get_tick_writer
 from schwab_wetrade.api import APIClient
 from schwab_wetrade.utils import log_in_background
 try:
@@ -13,6 +11,18 @@ except ModuleNotFoundError:
   import schwab_wetrade.project_template.settings as settings
 
 
+STREAM_FIELDS = { # level one field: (column, multiplier to epoch ns for times)
+  'ASK_PRICE': ('ask', None),
+  'ASK_SIZE': ('ask_size', None),
+  'ASK_TIME_MILLIS': ('ask_time', 1_000_000),
+  'BID_PRICE': ('bid', None),
+  'BID_SIZE': ('bid_size', None),
+  'BID_TIME_MILLIS': ('bid_time', 1_000_000),
+  'LAST_PRICE': ('last_trade', None),
+  'LAST_SIZE': ('last_trade_size', None),
+  'TRADE_TIME_MILLIS': ('last_trade_time', 1_000_000)}
+
+
 class DataFrameQuote(Quote):
   '''
   A Quote that uses a DataFrame to keep track of quote details and enable complex calculations
@@ -22,67 +32,97 @@ class DataFrameQuote(Quote):
   '''
   def __init__(self, client:APIClient, symbol):
     Quote.__init__(self, client, symbol)
-    self.data = pl.DataFrame(schema={ #maybe use numpy array instead of polars df
-      'datetime': pl.Datetime,
-      'datetime_epoch': pl.Int64,
-      'ask': pl.Float64,
-      'ask_size': pl.Int64,
-      'ask_time': pl.Datetime,
-      'bid': pl.Float64,
-      'bid_size': pl.Int64,
-      'bid_time': pl.Datetime,
-      'last_trade': pl.Float64,
-      'last_trade_size': pl.Int64,
-      'last_trade_time': pl.Datetime,
-      '30s_average': pl.Float64,
-      '10s_average': pl.Float64})
+    self.ticks = TickBuffer(columns={
+      'datetime': 'datetime',
+      'datetime_epoch': 'int',
+      'ask': 'float',
+      'ask_size': 'int',
+      'ask_time': 'datetime',
+      'bid': 'float',
+      'bid_size': 'int',
+      'bid_time': 'datetime',
+      'last_trade': 'float',
+      'last_trade_size': 'int',
+      'last_trade_time': 'datetime',
+      '30s_average': 'float',
+      '10s_average': 'float'})
+    self.last_values = {column: float('nan') if self.ticks.columns[column] == 'float' else 0 for column, _ in STREAM_FIELDS.values()}
     self.smoothed_price = 0.0
+    self.rolling_windows = RollingWindows()
+    self.rolling_windows.add_window('30s_average', 30)
+    self.rolling_windows.add_window('10s_average', 10)
+    self.tick_writer = None
+
+  @property
+  def data(self):
+    '''
+    A Polars DataFrame view of your quote data
+    '''
+    return self.ticks.to_polars()
+
+  def add_rolling_window(self, seconds, name=''):
+    '''
+    Adds a rolling average of the last trade price that is updated on every tick
 
-  async def _stream_quote(self):
-    await self.client.login() # should we move this to APIClient.__init__?
-    def handler(message):
-      nonlocal self
-      content = message['content'][0]
-      if 'LAST_PRICE' in content: # update price first
-        self.last_price = last_trade = content['LAST_PRICE']
-      else:
-        last_trade = self.data[-1, 'last_trade']
-      self.data.extend(pl.DataFrame({    
-        'datetime': datetime.datetime.fromtimestamp(message['timestamp']/1000),
-        'datetime_epoch': message['timestamp'],
-        'ask': content['ASK_PRICE'] if 'ASK_PRICE' in content else self.data[-1, 'ask'],
-        'ask_size': content['ASK_SIZE'] if 'ASK_SIZE' in content else self.data[-1, 'ask_size'],
-        'ask_time': datetime.datetime.fromtimestamp(content['ASK_TIME_MILLIS']/1000) if 'ASK_TIME_MILLIS' in content else self.data[-1, 'ask_time'],
-        'bid': content['BID_PRICE'] if 'BID_PRICE' in content else self.data[-1, 'bid'],
-        'bid_size': content['BID_SIZE'] if 'BID_SIZE' in content else self.data[-1, 'bid_size'],
-        'bid_time': datetime.datetime.fromtimestamp(content['BID_TIME_MILLIS']/1000) if 'BID_TIME_MILLIS' in content else self.data[-1, 'bid_time'],
-        'last_trade': last_trade,
-        'last_trade_size': content['LAST_SIZE'] if 'LAST_SIZE' in content else self.data[-1, 'last_trade_size'],
-        'last_trade_time': datetime.datetime.fromtimestamp(content['TRADE_TIME_MILLIS']/1000) if 'TRADE_TIME_MILLIS' in content else self.data[-1, 'last_trade_time'],
-        '30s_average': 0.0,
-        '10s_average': 0.0}))
-      self.data = self.data.set_sorted('datetime').with_columns([
-        pl.col('last_trade').rolling_mean_by(by='datetime', window_size='30s', closed='both').alias('30s_average'),
-        pl.col('last_trade').rolling_mean_by(by='datetime', window_size='10s', closed='both').alias('10s_average')])
-      self.smoothed_price = self.data[-1, '10s_average']
-    self.client.add_level_one_equity_handler(handler=handler)
-    await self.client.level_one_equity_subs(symbols=[self.symbol])
-    while self.monitoring_active == True and self.market_hours.market_has_closed() == False:
-      await self.client.handle_message()
-    await self.client.level_one_equity_unsubs(symbols=[self.symbol])
-    await self.client.logout()
+    :param float seconds: the length of the window in seconds
+    :param str name: (optional) the column name for the average (default: '{seconds}s_average')
+    '''
+    name = name if name != '' else f'{seconds}s_average'
+    if name not in self.rolling_windows:
+      self.ticks.add_column(name, 'float') # the column must exist before the stream thread writes the window's mean
+      with self.ticks.lock:
+        self.rolling_windows.add_window(name, seconds)
+    return name
+
+  def _handle_level_one(self, message):
+    content = message['content'][0]
+    last_values = self.last_values
+    for field, (column, to_ns) in STREAM_FIELDS.items():
+      if field in content:
+        last_values[column] = content[field] if to_ns == None else content[field] * to_ns
+    if 'LAST_PRICE' in content:
+      self._set_last_price(content['LAST_PRICE'])
+      averages = self.rolling_windows.update(message['timestamp'], content['LAST_PRICE'])
+    elif last_values['last_trade'] == last_values['last_trade']: # not NaN
+      averages = self.rolling_windows.update(message['timestamp'], last_values['last_trade'])
+    else:
+      averages = self.rolling_windows.means()
+    self.ticks.append({
+      'datetime': message['timestamp'] * 1_000_000,
+      'datetime_epoch': message['timestamp'],
+      **last_values,
+      **averages})
+    self.smoothed_price = averages['10s_average']
+    if self.tick_writer != None and self.tick_writer.unwritten_rows(self) >= self.tick_writer.flush_rows:
+      self.tick_writer.notify()
+    if self.bar_aggregator != None:
+      self.bar_aggregator.handle_message(message)
+    if self.market_hours.market_has_closed() == True:
+      self.stop_monitoring()
+
+  def persist_ticks(self, writer:TickWriter=None):
+    '''
+    Continuously appends your quote data to partitioned files in the background
 
-  def export_data(self):
+    :param TickWriter writer: (optional) the writer to use (default: a TickWriter shared by all DataFrameQuotes)
     '''
-    Exports a DataFrame containing your quote data as a .pkl file saved to *./export/data*
+    self.tick_writer = get_tick_writer() if writer == None else writer
+    self.tick_writer.add(self)
+
+  def export_data(self, file_format='parquet'):
+    '''
+    Writes any quote data not yet on disk to *./export/data/date=YYYY-MM-DD/symbol=SYMBOL*
+
+    :param str file_format: (optional) 'parquet' or 'ipc' if this quote isn't already being persisted
     '''
-    filename = datetime.datetime.today().strftime('%Y_%m_%d') + '-' + self.ticker
-    df = self.data.to_pandas()
-    df.to_pickle('./export/data/{}.pkl'.format(filename))
+    if self.tick_writer == None: # keep the writer so the next export only writes newer ticks
+      self.tick_writer = TickWriter(file_format=file_format)
+    self.tick_writer.flush(self)
+    return self.tick_writer
 
   def upload_quote_data(self):
     '''
-    Uploads a DataFrame to a Google Cloud Storage bucket specified in :ref:`settings.py <settings>`
+    Uploads today's quote data files to a Google Cloud Storage bucket specified in :ref:`settings.py <settings>`
     '''
     if hasattr(settings, 'quote_bucket'):
       log_in_background(
@@ -90,16 +130,11 @@ class DataFrameQuote(Quote):
         tags = ['user-message'], 
         message = '{}: Uploading quote data to Google Cloud'.format(
           datetime.datetime.now().strftime('%H:%M:%S')))
-      filename = datetime.datetime.today().strftime('%Y_%m_%d') + '-' + self.ticker
-      df = self.data.to_pandas()
-      storage_client = google.cloud.storage.Client()
-      bucket = storage_client.bucket(settings.quote_bucket)
-      blob = bucket.blob(filename)
-      with blob.open(mode='wb') as f:
-        pickle.dump(df, f)
+      writer = self.export_data()
+      writer.upload_partitions(symbol=self.symbol)
 
   def get_pd_data(self):
     '''
     Returns a pandas DataFrame containing your quote data
     '''
-    return self.data.to_pandas()
\ No newline at end of file
+    return self.ticks.to_pandas()
\ No newline at end of file
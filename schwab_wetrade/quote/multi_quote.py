@@ -1,8 +1,10 @@
 import time
-import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from schwab_wetrade.api import APIClient
 from schwab_wetrade.market_hours import MarketHours
-from schwab_wetrade.utils import log_in_background, start_thread
+from schwab_wetrade.utils import log_in_background
+from .price_trigger import PriceTriggerIndex
+from .quote_cache import QuoteCache
 
 
 class MultiQuote:
@@ -11,13 +13,18 @@ class MultiQuote:
 
   :param APIClient client: your :ref:`APIClient <api_client>`
   :param tuple symbols: a tuple or list containing a list of symbols
+  :param int max_workers: (optional) the most quote batches requested at once
   '''
-  def __init__(self, client:APIClient, symbols):
+  def __init__(self, client:APIClient, symbols, max_workers=8):
     self.client = client
-    self.symbols = symbols
+    self.max_workers = max_workers
+    self._executor = None
+    self.symbols = list(symbols)
     self.symbol_str = ','.join(self.symbols)
     self.last_prices = {}
+    self.price_triggers = {} # symbol: PriceTriggerIndex
     self.monitoring_active = False
+    self.bar_aggregator = None
     self.market_hours = MarketHours(client=self.client)
 
   def get_quote(self, symbols=[]):
@@ -28,6 +35,7 @@ class MultiQuote:
       symbols=self.symbols[:25]
     response, status_code = self.client.get_quotes(parsed_response=True, symbols=symbols)
     if status_code == 200:
+      QuoteCache.for_client(self.client).store(response)
       return response
     else:
       log_in_background(
@@ -36,57 +44,103 @@ class MultiQuote:
         message = time.strftime('%H:%M:%S', time.localtime()) + ': Error getting quote, retrying',
         symbol = self.symbol_str)
       time.sleep(.5)
-      return self.get_quote()
+      return self.get_quote(symbols)
     
-  def get_last_price(self):
-    '''
-    Gets the most recent prices for all of your securities
-    '''
-    quote_dict = {}
-    for i in range(0, len(self.symbols), 25):
-      batch = self.symbols[i:i+25]
-      batch_data = self.get_quote(batch)
-      quote_dict.update(batch_data)
-    if 'errors' in quote_dict:
-      errors = quote_dict.pop('errors')
-      if 'invalidSymbols' in errors:
-        invalid_symbols = errors['invalidSymbols']
-        self.symbols = [symbol for symbol in self.symbols if symbol not in set(invalid_symbols)]
-    for symbol in quote_dict:
-      self.last_prices[symbol] = quote_dict[symbol]['quote']['lastPrice'] 
+  def get_last_price(self, batch_size=25):
+    '''
+    Gets the most recent prices for all of your securities, requesting batches concurrently
+
+    :param int batch_size: (optional) the number of symbols per request
+    '''
+    if self._executor == None:
+      self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='MultiQuote')
+    batches = [self.symbols[i:i+batch_size] for i in range(0, len(self.symbols), batch_size)]
+    invalid_symbols = set()
+    for future in as_completed([self._executor.submit(self.get_quote, batch) for batch in batches]):
+      batch_data = future.result()
+      for symbol, data in batch_data.items():
+        if symbol == 'errors':
+          invalid_symbols.update(data.get('invalidSymbols', []))
+        elif 'quote' in data:
+          self._set_last_price(symbol, data['quote']['lastPrice'])
+    if invalid_symbols:
+      self.remove_symbols(invalid_symbols)
     return self.last_prices
 
-  async def _stream_quote(self): # only uses first 25 symbols
-    await self.client.login() # should we move this to APIClient.__init__?
-    def handler(message):
-      nonlocal self
-      for quote in message['content']:
-        symbol = quote['key']
-        if 'LAST_PRICE' in quote:
-          self.last_prices[symbol] = quote['LAST_PRICE']
-    self.client.add_level_one_equity_handler(handler=handler)
-    await self.client.level_one_equity_subs(symbols=self.symbols[:25])
-    while self.monitoring_active == True and self.market_hours.market_has_closed() == False:
-      await self.client.handle_message()
-    await self.client.level_one_equity_unsubs(symbols=self.symbols[:25])
-    await self.client.logout()
+  def _set_last_price(self, symbol, price):
+    self.last_prices[symbol] = price
+    if symbol in self.price_triggers:
+      self.price_triggers[symbol].update(price)
+
+  def _handle_level_one(self, message):
+    for quote in message['content']:
+      if 'LAST_PRICE' in quote:
+        self._set_last_price(quote['key'], quote['LAST_PRICE'])
+    if self.bar_aggregator != None:
+      self.bar_aggregator.handle_message(message)
+    if self.market_hours.market_has_closed() == True:
+      self.stop_monitoring()
     
   def _monitor_quote(self):
     if self.monitoring_active == False:
       if self.market_hours.market_has_closed() == False:
         self.monitoring_active = True
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(self._stream_quote())
-        loop.close()
-        self.monitoring_active = False
+        self.client.stream_hub.subscribe('LEVELONE_EQUITIES', self.symbols, self._handle_level_one)
 
   def monitor_in_background(self):
     '''
-    Monitors quote details using asyncio to keep Quote.last_price up to date 
+    Monitors quote details using the client's shared stream to keep MultiQuote.last_prices up to date 
+    '''
+    self._monitor_quote()
+
+  def stop_monitoring(self):
+    '''
+    Stops monitoring quote details for your securities
+    '''
+    if self.monitoring_active == True:
+      self.monitoring_active = False
+      self.client.stream_hub.unsubscribe('LEVELONE_EQUITIES', self.symbols, self._handle_level_one)
+      for triggers in self.price_triggers.values():
+        triggers.cancel_all()
+
+  def add_symbols(self, symbols):
+    '''
+    Adds securities to your MultiQuote, streaming them right away if monitoring is active
+
+    :param list symbols: a list of symbols to add
+    '''
+    current = set(self.symbols)
+    new_symbols = [symbol for symbol in dict.fromkeys(symbols) if symbol not in current]
+    self.symbols = [*self.symbols, *new_symbols]
+    self.symbol_str = ','.join(self.symbols)
+    if self.monitoring_active == True and new_symbols != []:
+      self.client.stream_hub.subscribe('LEVELONE_EQUITIES', new_symbols, self._handle_level_one)
+    return new_symbols
+
+  def remove_symbols(self, symbols):
+    '''
+    Removes securities from your MultiQuote and stops streaming them
+
+    :param list symbols: a list of symbols to remove
     '''
-    start_thread(self._monitor_quote)
+    removed = set(symbols) & set(self.symbols)
+    self.symbols = [symbol for symbol in self.symbols if symbol not in removed]
+    self.symbol_str = ','.join(self.symbols)
+    for symbol in removed:
+      self.last_prices.pop(symbol, None)
+      if symbol in self.price_triggers:
+        self.price_triggers.pop(symbol).cancel_all()
+    if self.monitoring_active == True and removed:
+      self.client.stream_hub.unsubscribe('LEVELONE_EQUITIES', list(removed), self._handle_level_one)
+    return list(removed)
   
+  def _get_price_triggers(self, symbol):
+    if symbol not in self.price_triggers:
+      triggers = self.price_triggers[symbol] = PriceTriggerIndex()
+      if symbol in self.last_prices:
+        triggers.update(self.last_prices[symbol])
+    return self.price_triggers[symbol]
+
   def wait_for_price_fall(self, symbol, target_price, then=None, args=[], kwargs={}):
     '''
     Waits for a specified security to fall below a certain price then optionally runs a callback function 
@@ -99,26 +153,27 @@ class MultiQuote:
     '''
     if symbol in self.symbols:
       self.monitor_in_background()
-      waiting = True
-      while waiting and self.monitoring_active == True:
-        if symbol in self.last_prices and self.last_prices[symbol] < target_price:
-          waiting = False
-          if then:
-            then(*args, **kwargs)
-        time.sleep(.2)
+      if self.monitoring_active == True:
+        trigger = self._get_price_triggers(symbol).add_below(target_price)
+        trigger.wait()
+        if trigger.fired_count > 0 and then:
+          then(*args, **kwargs)
 
-  def run_below_price(self, symbol, target_price, func, func_args=[], func_kwargs={}):
+  def run_below_price(self, symbol, target_price, func, func_args=[], func_kwargs={}, repeat=False):
     '''
-    Runs a callback when a specified security falls below a certain price without waiting
+    Runs a callback when a specified security falls below a certain price without waiting; returns a :class:`PriceTrigger` you can cancel
 
     :param str symbol: the symbol of your specified security
     :param float target_price: your set target price
     :param func: (optional) a callback function to run when price falls below target
     :param list func_args: a list of args for your func
     :param dict func_kwargs: a dict containing kwargs for your func
+    :param bool repeat: (optional) run func every time the price falls below target
     '''
-    args = [symbol, target_price, func, func_args, func_kwargs]
-    start_thread(self.wait_for_price_fall, args=args)
+    if symbol in self.symbols:
+      self.monitor_in_background()
+      if self.monitoring_active == True:
+        return self._get_price_triggers(symbol).add_below(target_price, func, func_args, func_kwargs, repeat)
 
   def wait_for_price_rise(self, symbol, target_price, then=None, args=[], kwargs={}):
     '''
@@ -132,23 +187,24 @@ class MultiQuote:
     '''
     if symbol in self.symbols:
       self.monitor_in_background()
-      waiting = True
-      while waiting and self.monitoring_active == True:
-        if symbol in self.last_prices and self.last_prices[symbol] > target_price:
-          waiting = False
-          if then:
-            then(*args, **kwargs)
-        time.sleep(.2)
+      if self.monitoring_active == True:
+        trigger = self._get_price_triggers(symbol).add_above(target_price)
+        trigger.wait()
+        if trigger.fired_count > 0 and then:
+          then(*args, **kwargs)
 
-  def run_above_price(self, symbol, target_price, func, func_args=[], func_kwargs={}):
+  def run_above_price(self, symbol, target_price, func, func_args=[], func_kwargs={}, repeat=False):
     '''
-    Runs a callback when a specified security rises above a certain price without waiting
+    Runs a callback when a specified security rises above a certain price without waiting; returns a :class:`PriceTrigger` you can cancel
 
     :param str symbol: the symbol of your specified security
     :param float target_price: your set target price
     :param func: (optional) a callback function to run when price rises above target
     :param list func_args: a list of args for your func
     :param dict func_kwargs: a dict containing kwargs for your func
+    :param bool repeat: (optional) run func every time the price rises above target
     '''
-    args = [symbol, target_price, func, func_args, func_kwargs]
-    start_thread(self.wait_for_price_rise, args=args)
+    if symbol in self.symbols:
+      self.monitor_in_background()
+      if self.monitoring_active == True:
+        return self._get_price_triggers(symbol).add_above(target_price, func, func_args, func_kwargs, repeat)
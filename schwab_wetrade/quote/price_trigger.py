@@ -0,0 +1,175 @@
+import bisect
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+_executor = None
+_executor_lock = threading.Lock()
+_trigger_ids = itertools.count()
+
+def get_trigger_executor(max_workers=8):
+  '''
+  Returns the bounded thread pool shared by all price trigger callbacks
+  '''
+  global _executor
+  with _executor_lock:
+    if _executor == None:
+      _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='PriceTrigger')
+    return _executor
+
+
+class PriceTrigger:
+  '''
+  A handle for a callback registered with a :class:`PriceTriggerIndex`
+  '''
+  def __init__(self, index, direction, target_price, func=None, args=[], kwargs={}, repeat=False):
+    self.index = index
+    self.id = next(_trigger_ids)
+    self.direction = direction
+    self.target_price = target_price
+    self.func = func
+    self.args = args
+    self.kwargs = kwargs
+    self.repeat = repeat
+    self.active = True
+    self.fired_count = 0
+    self.done = threading.Event()
+
+  def __repr__(self):
+    return f'PriceTrigger({self.direction} {self.target_price}, fired={self.fired_count}, active={self.active})'
+
+  def cancel(self):
+    '''Cancels the trigger'''
+    self.index.cancel(self)
+
+  def wait(self, timeout=None):
+    '''
+    Blocks until a one-shot trigger fires or the trigger is cancelled
+
+    :param float timeout: (optional) the most seconds to wait
+    '''
+    return self.done.wait(timeout)
+
+
+class PriceTriggerIndex:
+  '''
+  Price triggers for one security kept sorted by target price, so each tick only needs a bisect
+
+  A 'below' trigger fires when the price falls below its target and an 'above' trigger when the price
+  rises above it. Repeating triggers re-arm once the price is back on the other side of the target
+
+  :param executor: (optional) the executor callbacks run on (default: :func:`get_trigger_executor`)
+  '''
+  def __init__(self, executor=None):
+    self.executor = executor
+    self.lock = threading.Lock()
+    self.armed = {'below': [], 'above': []} # sorted lists of (target_price, id)
+    self.rearm = {'below': [], 'above': []}
+    self.triggers = {}
+    self.last_price = None
+
+  def __len__(self):
+    return len(self.triggers)
+
+  def add(self, direction, target_price, func=None, args=[], kwargs={}, repeat=False):
+    '''
+    Registers a trigger and returns its :class:`PriceTrigger` handle
+
+    :param str direction: 'below' or 'above'
+    :param float target_price: your set target price
+    :param func: (optional) a callback function to run when the price crosses the target
+    :param list args: a list of args for your func
+    :param dict kwargs: a dict containing kwargs for your func
+    :param bool repeat: (optional) keep the trigger after it fires
+    '''
+    trigger = PriceTrigger(self, direction, target_price, func, args, kwargs, repeat)
+    with self.lock:
+      self.triggers[trigger.id] = trigger
+      bisect.insort(self.armed[direction], (target_price, trigger.id))
+      fired = self._evaluate(self.last_price) if self.last_price != None else []
+    self._dispatch(fired)
+    return trigger
+
+  def add_below(self, target_price, func=None, args=[], kwargs={}, repeat=False):
+    return self.add('below', target_price, func, args, kwargs, repeat)
+
+  def add_above(self, target_price, func=None, args=[], kwargs={}, repeat=False):
+    return self.add('above', target_price, func, args, kwargs, repeat)
+
+  def update(self, price):
+    '''
+    Evaluates all triggers against a new price and dispatches the ones that fire
+    '''
+    with self.lock:
+      self.last_price = price
+      if self.triggers == {}:
+        return
+      fired = self._evaluate(price)
+    if fired != []:
+      self._dispatch(fired)
+
+  def _evaluate(self, price):
+    armed, rearm = self.armed, self.rearm
+    i = bisect.bisect_right(rearm['below'], (price, float('inf'))) # back at or above target
+    for key in rearm['below'][:i]:
+      bisect.insort(armed['below'], key)
+    del rearm['below'][:i]
+    i = bisect.bisect_left(rearm['above'], (price, -1)) # back at or below target
+    for key in rearm['above'][i:]:
+      bisect.insort(armed['above'], key)
+    del rearm['above'][i:]
+    i = bisect.bisect_right(armed['below'], (price, float('inf'))) # targets above the price
+    fired_keys = [('below', key) for key in armed['below'][i:]]
+    del armed['below'][i:]
+    i = bisect.bisect_left(armed['above'], (price, -1)) # targets below the price
+    fired_keys += [('above', key) for key in armed['above'][:i]]
+    del armed['above'][:i]
+    fired = []
+    for direction, key in fired_keys:
+      trigger = self.triggers[key[1]]
+      trigger.fired_count += 1
+      if trigger.repeat == True:
+        bisect.insort(rearm[direction], key)
+      else:
+        del self.triggers[key[1]]
+        trigger.active = False
+      fired.append(trigger)
+    return fired
+
+  def _dispatch(self, fired):
+    executor = None
+    for trigger in fired:
+      if trigger.repeat == False:
+        trigger.done.set()
+      if trigger.func:
+        executor = executor or self.executor or get_trigger_executor()
+        executor.submit(trigger.func, *trigger.args, **trigger.kwargs)
+
+  def cancel(self, trigger):
+    '''
+    Cancels a trigger so it no longer fires
+    '''
+    with self.lock:
+      if self.triggers.pop(trigger.id, None) != None:
+        key = (trigger.target_price, trigger.id)
+        for keys in (self.armed[trigger.direction], self.rearm[trigger.direction]):
+          i = bisect.bisect_left(keys, key)
+          if i < len(keys) and keys[i] == key:
+            del keys[i]
+            break
+      trigger.active = False
+    trigger.done.set()
+
+  def cancel_all(self):
+    '''
+    Cancels every trigger in the index
+    '''
+    with self.lock:
+      triggers = list(self.triggers.values())
+      self.triggers = {}
+      self.armed = {'below': [], 'above': []}
+      self.rearm = {'below': [], 'above': []}
+    for trigger in triggers:
+      trigger.active = False
+      trigger.done.set()
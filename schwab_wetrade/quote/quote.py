@@ -1,10 +1,10 @@
 import pprint
 import time
-import asyncio
-from contextlib import suppress
 from schwab_wetrade.api import APIClient
 from schwab_wetrade.market_hours import MarketHours
-from schwab_wetrade.utils import log_in_background, start_thread
+from schwab_wetrade.utils import log_in_background
+from .price_trigger import PriceTriggerIndex
+from .quote_cache import QuoteCache
 
 
 class Quote:
@@ -19,22 +19,21 @@ class Quote:
     self.symbol = symbol
     self.last_price = 0.0
     self.monitoring_active = False
+    self.bar_aggregator = None
     self.market_hours = None
+    self.price_triggers = PriceTriggerIndex()
+    self.quote_cache = QuoteCache.for_client(client)
 
-  def get_quote(self):
+  def get_quote(self, max_age=None):
     '''
-    Gets the most recent quote details for your security
+    Gets the most recent quote details for your security from the client's shared :class:`QuoteCache`
+
+    :param float max_age: (optional) the oldest cached snapshot in seconds you'll accept
     '''
-    error_msg = ''
-    if '/' in self.symbol:
-      response, status_code = self.client.get_quotes(parsed_response=True, symbols=[self.symbol])
-    else:
-      response, status_code = self.client.get_quote(parsed_response=True, symbol=self.symbol)
-    with suppress(Exception):
-      error_msg = response['errors'][0]['title']
+    quote, status_code = self.quote_cache.get(self.symbol, max_age)
     if status_code == 200:
-      return response
-    elif error_msg == 'Not Found':
+      return {self.symbol: quote} if quote != None else {}
+    elif status_code == 404:
       return {} # maybe error msg instead
     else:
       log_in_background(
@@ -43,7 +42,7 @@ class Quote:
         message = time.strftime('%H:%M:%S', time.localtime()) + f': Error getting quote for {self.symbol}, retrying',
         symbol = self.symbol)
       time.sleep(.5)
-      return self.get_quote()
+      return self.get_quote(max_age)
     
   def get_open(self):
     '''
@@ -61,23 +60,22 @@ class Quote:
     '''
     quote = self.get_quote()
     if self.symbol in quote:
-      self.last_price = quote[self.symbol]['quote']['lastPrice']
+      self._set_last_price(quote[self.symbol]['quote']['lastPrice'])
       return self.last_price
     else:
       return 0.0
 
-  async def _stream_quote(self): 
-    await self.client.login() # should we move this to APIClient.__init__?
-    def handler(message):
-      nonlocal self
-      if 'LAST_PRICE' in message['content'][0]:
-        self.last_price = message['content'][0]['LAST_PRICE']
-    self.client.add_level_one_equity_handler(handler=handler)
-    await self.client.level_one_equity_subs(symbols=[self.symbol])
-    while self.monitoring_active == True and self.market_hours.market_has_closed() == False:
-      await self.client.handle_message()
-    await self.client.level_one_equity_unsubs(symbols=[self.symbol])
-    await self.client.logout()
+  def _set_last_price(self, price):
+    self.last_price = price
+    self.price_triggers.update(price)
+
+  def _handle_level_one(self, message):
+    if 'LAST_PRICE' in message['content'][0]:
+      self._set_last_price(message['content'][0]['LAST_PRICE'])
+    if self.bar_aggregator != None:
+      self.bar_aggregator.handle_message(message)
+    if self.market_hours.market_has_closed() == True:
+      self.stop_monitoring()
     
   def _monitor_quote(self):
     if self.market_hours == None:
@@ -85,17 +83,22 @@ class Quote:
     if self.monitoring_active == False:
       if self.market_hours.market_has_closed() == False:
         self.monitoring_active = True
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(self._stream_quote())
-        loop.close()
-        self.monitoring_active = False
+        self.client.stream_hub.subscribe('LEVELONE_EQUITIES', [self.symbol], self._handle_level_one)
 
   def monitor_in_background(self):
     '''
-    Monitors quote details using asyncio to keep Quote.last_price up to date 
+    Monitors quote details using the client's shared stream to keep Quote.last_price up to date 
+    '''
+    self._monitor_quote()
+
+  def stop_monitoring(self):
+    '''
+    Stops monitoring quote details for your security
     '''
-    start_thread(self._monitor_quote)
+    if self.monitoring_active == True:
+      self.monitoring_active = False
+      self.client.stream_hub.unsubscribe('LEVELONE_EQUITIES', [self.symbol], self._handle_level_one)
+      self.price_triggers.cancel_all()
   
   def wait_for_price_fall(self, target_price, then=None, args=[], kwargs={}):
     '''
@@ -107,25 +110,25 @@ class Quote:
     :param dict kwargs: a dict containing kwargs for your func
     '''
     self.monitor_in_background()
-    waiting = True
-    while waiting and self.monitoring_active == True:
-      if self.last_price!=0.0 and self.last_price < target_price:
-        waiting = False
-        if then:
-          then(*args, **kwargs)
-      time.sleep(.2)
+    if self.monitoring_active == True:
+      trigger = self.price_triggers.add_below(target_price)
+      trigger.wait()
+      if trigger.fired_count > 0 and then:
+        then(*args, **kwargs)
 
-  def run_below_price(self, target_price, func, func_args=[], func_kwargs={}):
+  def run_below_price(self, target_price, func, func_args=[], func_kwargs={}, repeat=False):
     '''
-    Runs a callback when your security falls below a certain price without waiting
+    Runs a callback when your security falls below a certain price without waiting; returns a :class:`PriceTrigger` you can cancel
 
     :param float target_price: your set target price
     :param func: a function to run when price falls below target
     :param list func_args: a list of args for your func
     :param dict func_kwargs: a dict containing kwargs for your func
+    :param bool repeat: (optional) run func every time the price falls below target
     '''
-    args = [target_price, func, func_args, func_kwargs]
-    start_thread(self.wait_for_price_fall, args=args)
+    self.monitor_in_background()
+    if self.monitoring_active == True:
+      return self.price_triggers.add_below(target_price, func, func_args, func_kwargs, repeat)
 
   def wait_for_price_rise(self, target_price, then=None, args=[], kwargs={}):
     '''
@@ -137,22 +140,22 @@ class Quote:
     :param dict kwargs: a dict containing kwargs for your func
     '''
     self.monitor_in_background()
-    waiting = True
-    while waiting and self.monitoring_active == True:
-      if self.last_price!=0.0 and self.last_price > target_price:
-        waiting = False
-        if then:
-          then(*args, **kwargs)
-      time.sleep(.2)
+    if self.monitoring_active == True:
+      trigger = self.price_triggers.add_above(target_price)
+      trigger.wait()
+      if trigger.fired_count > 0 and then:
+        then(*args, **kwargs)
 
-  def run_above_price(self, target_price, func, func_args=[], func_kwargs={}):
+  def run_above_price(self, target_price, func, func_args=[], func_kwargs={}, repeat=False):
     '''
-    Runs a callback when your security rises above a certain price without waiting
+    Runs a callback when your security rises above a certain price without waiting; returns a :class:`PriceTrigger` you can cancel
 
     :param float target_price: your set target price
     :param func: a function to run when price rises above target
     :param list func_args: a list of args for your func
     :param dict func_kwargs: a dict containing kwargs for your func
+    :param bool repeat: (optional) run func every time the price rises above target
     '''
-    args = [target_price, func, func_args, func_kwargs]
-    start_thread(self.wait_for_price_rise, args=args)
+    self.monitor_in_background()
+    if self.monitoring_active == True:
+      return self.price_triggers.add_above(target_price, func, func_args, func_kwargs, repeat)
@@ -0,0 +1,136 @@
+import time
+import threading
+from concurrent.futures import Future
+
+
+_cache_lock = threading.Lock()
+
+
+class QuoteCache:
+  '''
+  A short-lived cache of quote snapshots shared by every Quote using the same client
+
+  Callers asking for a symbol that is already being fetched wait on that request, and misses that
+  arrive within batch_window of each other are fetched together with one get_quotes call; a miss with
+  no other miss in the last batch_window is fetched right away
+
+  :param APIClient client: your :ref:`APIClient <api_client>`
+  :param float ttl: (optional) seconds a snapshot is served from the cache
+  :param float batch_window: (optional) seconds to collect misses before fetching them
+  :param int max_batch_size: (optional) the most symbols fetched in one request
+  '''
+  def __init__(self, client, ttl=1.0, batch_window=.01, max_batch_size=100):
+    self.client = client
+    self.ttl = ttl
+    self.batch_window = batch_window
+    self.max_batch_size = max_batch_size
+    self.entries = {} # symbol: (fetched_at, quote)
+    self.in_flight = {} # symbol: Future
+    self.pending = []
+    self.last_miss = float('-inf')
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.coalesced = 0
+    self.requests = 0
+
+  @classmethod
+  def for_client(cls, client):
+    '''
+    Returns the QuoteCache shared by everything using client, creating it if needed
+    '''
+    with _cache_lock:
+      if getattr(client, 'quote_cache', None) == None:
+        client.quote_cache = cls(client)
+      return client.quote_cache
+
+  def get(self, symbol, max_age=None):
+    '''
+    Returns a tuple of (quote, status_code) for symbol; quote is None if the symbol is invalid or the request failed
+
+    :param str symbol: the symbol of your security
+    :param float max_age: (optional) override the cache ttl for this call
+    '''
+    max_age = self.ttl if max_age == None else max_age
+    leader = False
+    with self.lock:
+      now = time.monotonic()
+      entry = self.entries.get(symbol)
+      if entry != None and now - entry[0] <= max_age:
+        self.hits += 1
+        return entry[1], 200
+      self.misses += 1
+      burst = now - self.last_miss <= self.batch_window # wait for more misses only when they're arriving together
+      self.last_miss = now
+      future = self.in_flight.get(symbol)
+      if future != None:
+        self.coalesced += 1
+      else:
+        future = self.in_flight[symbol] = Future()
+        self.pending.append(symbol)
+        leader = len(self.pending) == 1
+    if leader:
+      self._fetch_pending(wait=burst)
+    return future.result()
+
+  def _fetch_pending(self, wait=True):
+    if wait and self.batch_window > 0:
+      time.sleep(self.batch_window)
+    with self.lock:
+      symbols, self.pending = self.pending, []
+    for i in range(0, len(symbols), self.max_batch_size):
+      self._fetch(symbols[i:i+self.max_batch_size])
+
+  def _fetch(self, symbols):
+    with self.lock:
+      self.requests += 1
+    results = {}
+    error = None
+    try:
+      response, status_code = self.client.get_quotes(parsed_response=True, symbols=symbols)
+      if status_code == 200:
+        self.store(response)
+      for symbol in symbols:
+        results[symbol] = (response.get(symbol) if status_code == 200 else None, status_code)
+    except Exception as e:
+      error = e
+    finally: # every waiter gets an answer, whatever went wrong
+      with self.lock:
+        futures = [(self.in_flight.pop(symbol), symbol) for symbol in symbols]
+      for future, symbol in futures:
+        if symbol in results:
+          future.set_result(results[symbol])
+        else:
+          future.set_exception(error if error != None else RuntimeError('Quote request interrupted'))
+
+  def store(self, response):
+    '''
+    Adds the quotes from a get_quotes response to the cache
+
+    :param dict response: a parsed get_quotes response
+    '''
+    now = time.monotonic()
+    with self.lock:
+      for symbol, quote in response.items():
+        if symbol != 'errors':
+          self.entries[symbol] = (now, quote)
+
+  def invalidate(self, symbol=''):
+    with self.lock:
+      if symbol == '':
+        self.entries.clear()
+      else:
+        self.entries.pop(symbol, None)
+
+  def stats(self):
+    '''
+    Returns cache hit/miss counters
+    '''
+    with self.lock:
+      lookups = self.hits + self.misses
+      return {
+        'hits': self.hits,
+        'misses': self.misses,
+        'coalesced': self.coalesced,
+        'requests': self.requests,
+        'hit_rate': self.hits / lookups if lookups else 0.0}
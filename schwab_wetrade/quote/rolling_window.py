@@ -0,0 +1,78 @@
+from collections import deque
+
+
+class RollingWindow:
+  '''
+  A time-based rolling mean that updates in constant time per tick
+
+  :param str name: the column name the window writes into
+  :param float seconds: the length of the window in seconds
+  '''
+  def __init__(self, name, seconds):
+    self.name = name
+    self.seconds = seconds
+    self.window_ms = int(seconds * 1000)
+    self.values = deque()
+    self.total = 0.0
+    self.mean = 0.0
+
+  def update(self, timestamp_ms, value):
+    '''
+    Adds a value to the window, drops values older than the window and returns the new mean
+
+    :param int timestamp_ms: the epoch timestamp of the value in milliseconds
+    :param float value: the value to add
+    '''
+    values = self.values
+    values.append((timestamp_ms, value))
+    self.total += value
+    cutoff = timestamp_ms - self.window_ms
+    while values[0][0] < cutoff: # window is closed on both ends
+      self.total -= values.popleft()[1]
+    if len(values) == 1: # resync to avoid float drift after the window empties
+      self.total = value
+    self.mean = self.total / len(values)
+    return self.mean
+
+  def reset(self):
+    self.values.clear()
+    self.total = 0.0
+    self.mean = 0.0
+
+
+class RollingWindows:
+  '''
+  A set of named RollingWindows fed from the same stream of values
+
+  Adding or removing a window replaces the dict rather than changing it, so a thread updating the windows never sees it
+  change size mid-iteration
+  '''
+  def __init__(self):
+    self.windows = {}
+
+  def add_window(self, name, seconds):
+    '''
+    Registers a new rolling window
+
+    :param str name: the column name the window writes into
+    :param float seconds: the length of the window in seconds
+    '''
+    window = RollingWindow(name, seconds)
+    self.windows = {**self.windows, name: window}
+    return window
+
+  def remove_window(self, name):
+    if name in self.windows:
+      self.windows = {key: window for key, window in self.windows.items() if key != name}
+
+  def update(self, timestamp_ms, value):
+    '''
+    Updates every window and returns a dict of {name: mean}
+    '''
+    return {name: window.update(timestamp_ms, value) for name, window in self.windows.items()}
+
+  def means(self):
+    return {name: window.mean for name, window in self.windows.items()}
+
+  def __contains__(self, name):
+    return name in self.windows
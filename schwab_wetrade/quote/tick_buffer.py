@@ -0,0 +1,128 @@
+import threading
+import numpy as np
+
+
+COLUMN_DTYPES = {
+  'datetime': np.int64, # epoch ns, exposed as datetime64[ns]
+  'int': np.int64,
+  'float': np.float64}
+
+EMPTY_VALUES = {
+  'datetime': 0,
+  'int': 0,
+  'float': np.nan}
+
+
+class TickBuffer:
+  '''
+  A growable, NumPy-backed column store for streaming ticks
+
+  Rows are written into preallocated chunks that grow geometrically up to max_chunk_size,
+  so appending never copies existing data and :meth:`to_polars`/:meth:`to_pandas` can
+  return views of the filled part of each chunk instead of copies
+
+  :param dict columns: an ordered dict of {column name: 'datetime' | 'int' | 'float'}
+  :param int initial_chunk_size: (optional) number of rows in the first chunk
+  :param int max_chunk_size: (optional) largest number of rows in a single chunk
+  '''
+  def __init__(self, columns:dict, initial_chunk_size=1024, max_chunk_size=65536):
+    self.columns = dict(columns)
+    self.initial_chunk_size = initial_chunk_size
+    self.max_chunk_size = max_chunk_size
+    self.chunks = []
+    self.chunk_starts = []
+    self.length = 0
+    self._chunk = None
+    self._chunk_length = 0
+    self._chunk_capacity = 0
+    self.lock = threading.Lock()
+
+  def __len__(self):
+    return self.length
+
+  def _new_chunk(self):
+    size = self.initial_chunk_size if self._chunk_capacity == 0 else min(self._chunk_capacity * 2, self.max_chunk_size)
+    chunk = {name: self._empty_column(kind, size) for name, kind in self.columns.items()}
+    self.chunks.append(chunk)
+    self.chunk_starts.append(self.length)
+    self._chunk = chunk
+    self._chunk_length = 0
+    self._chunk_capacity = size
+
+  def _empty_column(self, kind, size):
+    column = np.empty(size, dtype=COLUMN_DTYPES[kind])
+    column.fill(EMPTY_VALUES[kind])
+    return column
+
+  def add_column(self, name, kind='float'):
+    '''
+    Adds a column to the buffer; existing rows are filled with an empty value (NaN for floats)
+
+    :param str name: the name of the new column
+    :param str kind: 'datetime', 'int' or 'float'
+    '''
+    with self.lock:
+      if name not in self.columns:
+        self.columns[name] = kind
+        for chunk in self.chunks:
+          chunk[name] = self._empty_column(kind, len(next(iter(chunk.values()))))
+
+  def append(self, row:dict):
+    '''
+    Appends one row; missing columns keep their empty value
+
+    :param dict row: a dict of {column name: value}, datetimes as epoch ns
+    '''
+    if self._chunk_length == self._chunk_capacity:
+      with self.lock:
+        self._new_chunk()
+    i = self._chunk_length
+    chunk = self._chunk
+    for name, value in row.items():
+      chunk[name][i] = value
+    self._chunk_length = i + 1
+    self.length += 1 # readers only see the row once it is fully written
+
+  def _views(self, start=0, stop=None):
+    stop = self.length if stop == None else min(stop, self.length)
+    views = []
+    for chunk, chunk_start in zip(self.chunks, self.chunk_starts):
+      chunk_rows = len(next(iter(chunk.values())))
+      lo = max(start - chunk_start, 0)
+      hi = min(stop - chunk_start, chunk_rows)
+      if hi > lo:
+        views.append({name: self._as_view(kind, chunk[name][lo:hi]) for name, kind in self.columns.items()})
+    return views
+
+  def _as_view(self, kind, column):
+    return column.view('datetime64[ns]') if kind == 'datetime' else column
+
+  def to_polars(self, start=0, stop=None):
+    '''
+    Returns a Polars DataFrame backed by the buffer's arrays (rows start:stop)
+    '''
+    import polars as pl # polars and pandas are loaded on first use to keep imports fast
+    with self.lock:
+      frames = [pl.DataFrame(view) for view in self._views(start, stop)]
+    if frames == []:
+      return pl.DataFrame(schema=self.polars_schema())
+    return frames[0] if len(frames) == 1 else pl.concat(frames, rechunk=False)
+
+  def to_pandas(self, start=0, stop=None):
+    '''
+    Returns a pandas DataFrame of rows start:stop; zero-copy while the rows fit in one chunk
+    '''
+    import pandas as pd
+    with self.lock:
+      frames = [pd.DataFrame(view, copy=False) for view in self._views(start, stop)]
+    if frames == []:
+      return pd.DataFrame({name: self._as_view(kind, self._empty_column(kind, 0)) for name, kind in self.columns.items()})
+    return frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+
+  def polars_schema(self):
+    import polars as pl
+    types = {'datetime': pl.Datetime('ns'), 'int': pl.Int64, 'float': pl.Float64}
+    return {name: types[kind] for name, kind in self.columns.items()}
+
+  def nbytes(self):
+    return sum(column.nbytes for chunk in self.chunks for column in chunk.values())
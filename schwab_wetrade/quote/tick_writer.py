@@ -0,0 +1,175 @@
+import os
+import time
+import atexit
+import weakref
+import datetime
+import threading
+from schwab_wetrade.utils import log_in_background, start_thread
+try:
+  import settings
+except ModuleNotFoundError:
+  import schwab_wetrade.project_template.settings as settings
+
+
+_default_writer = None
+_default_writer_lock = threading.Lock()
+
+def get_tick_writer():
+  '''
+  Returns the TickWriter shared by DataFrameQuotes that don't specify their own
+  '''
+  global _default_writer
+  with _default_writer_lock:
+    if _default_writer == None:
+      _default_writer = TickWriter()
+    return _default_writer
+
+
+class TickWriter:
+  '''
+  Appends DataFrameQuote ticks to date/symbol partitioned Parquet or Arrow IPC files from a background thread
+
+  Each flush writes the rows added since the last flush as a new part file, written to a temporary
+  path and renamed into place so a crash never leaves a partial file behind
+
+  :param str root: (optional) the directory partitions are written to
+  :param str file_format: (optional) 'parquet' or 'ipc' (Arrow IPC), both zstd compressed
+  :param float flush_interval: (optional) seconds between flushes
+  :param int flush_rows: (optional) flush a quote early once it has this many unwritten rows
+  '''
+  def __init__(self, root='./export/data', file_format='parquet', flush_interval=10.0, flush_rows=50000):
+    self.root = root
+    self.file_format = file_format
+    self.extension = 'parquet' if file_format == 'parquet' else 'arrow'
+    self.flush_interval = flush_interval
+    self.flush_rows = flush_rows
+    self.sources = {} # quote: None, in the order added
+    self.rows_written = weakref.WeakKeyDictionary() # quote: rows already on disk, kept until the quote is gone
+    self.part_numbers = {} # partition dir: next part number
+    self.condition = threading.Condition()
+    self.flush_lock = threading.Lock()
+    self.running = False
+    self.uploaded = set()
+
+  def add(self, quote):
+    '''
+    Starts writing a DataFrameQuote's ticks in the background
+
+    :param DataFrameQuote quote: the quote to persist
+    '''
+    with self.condition:
+      self.sources[quote] = None
+      self.rows_written.setdefault(quote, 0)
+      start = self.running == False
+      self.running = True
+    if start:
+      start_thread(self._run, name='TickWriter', daemon=True)
+      atexit.register(self.close) # flush what's left instead of holding the interpreter open
+
+  def remove(self, quote):
+    '''
+    Writes any unwritten ticks for quote and stops persisting it
+    '''
+    self.flush(quote)
+    with self.condition:
+      self.sources.pop(quote, None)
+
+  def notify(self):
+    '''
+    Wakes the writer thread to flush before the next interval
+    '''
+    with self.condition:
+      self.condition.notify()
+
+  def unwritten_rows(self, quote):
+    return len(quote.ticks) - self.rows_written.get(quote, 0)
+
+  def _run(self):
+    while True:
+      with self.condition:
+        if self.running == False:
+          return
+        self.condition.wait(self.flush_interval)
+        sources = list(self.sources)
+      for quote in sources:
+        try:
+          self.flush(quote)
+        except Exception as e:
+          log_in_background(
+            called_from = 'TickWriter._run',
+            tags = ['user-message'],
+            symbol = quote.symbol,
+            message = time.strftime('%H:%M:%S', time.localtime()) + f': Error writing tick data for {quote.symbol}, check logs',
+            e = e)
+
+  def flush(self, quote=None):
+    '''
+    Writes unwritten ticks for quote (or every quote) to a new part file
+    '''
+    with self.condition:
+      quotes = [quote] if quote != None else list(self.sources)
+    for quote in quotes:
+      with self.flush_lock:
+        start = self.rows_written.get(quote, 0)
+        stop = len(quote.ticks)
+        if stop > start:
+          self._write_part(quote.symbol, quote.ticks.to_polars(start, stop))
+          self.rows_written[quote] = stop
+
+  def partition_dir(self, symbol, date=None):
+    date = datetime.date.today() if date == None else date
+    return os.path.join(self.root, f'date={date:%Y-%m-%d}', f'symbol={symbol}')
+
+  def _write_part(self, symbol, df):
+    directory = self.partition_dir(symbol)
+    os.makedirs(directory, exist_ok=True)
+    if directory not in self.part_numbers:
+      self.part_numbers[directory] = len([f for f in os.listdir(directory) if f.endswith('.' + self.extension)])
+    path = os.path.join(directory, 'part-{:05d}.{}'.format(self.part_numbers[directory], self.extension))
+    tmp_path = path + '.tmp'
+    if self.file_format == 'parquet':
+      df.write_parquet(tmp_path, compression='zstd')
+    else:
+      df.write_ipc(tmp_path, compression='zstd')
+    os.replace(tmp_path, path)
+    self.part_numbers[directory] += 1
+    return path
+
+  def close(self, upload=False):
+    '''
+    Flushes every quote and stops the writer thread
+
+    :param bool upload: (optional) upload today's partitions to the quote_bucket in :ref:`settings.py <settings>`
+    '''
+    with self.condition:
+      self.running = False
+      self.condition.notify()
+    atexit.unregister(self.close)
+    self.flush()
+    if upload == True:
+      self.upload_partitions()
+
+  def upload_partitions(self, symbol='', date=None, chunk_size=8*1024*1024):
+    '''
+    Uploads finished part files to the quote_bucket in :ref:`settings.py <settings>`, skipping files already uploaded
+
+    :param str symbol: (optional) only upload this symbol's partition
+    :param date: (optional) the partition date (default: today)
+    :param int chunk_size: (optional) bytes per chunk of the resumable upload
+    '''
+    if hasattr(settings, 'quote_bucket'):
+      date = datetime.date.today() if date == None else date
+      date_dir = os.path.join(self.root, f'date={date:%Y-%m-%d}')
+      if os.path.isdir(date_dir):
+        import google.cloud.storage
+        bucket = google.cloud.storage.Client().bucket(settings.quote_bucket)
+        symbol_dirs = [f'symbol={symbol}'] if symbol != '' else os.listdir(date_dir)
+        for symbol_dir in symbol_dirs:
+          directory = os.path.join(date_dir, symbol_dir)
+          if os.path.isdir(directory):
+            for filename in sorted(os.listdir(directory)):
+              path = os.path.join(directory, filename)
+              if filename.endswith('.' + self.extension) and path not in self.uploaded:
+                blob = bucket.blob(os.path.relpath(path, self.root).replace(os.sep, '/'), chunk_size=chunk_size)
+                blob.upload_from_filename(path)
+                self.uploaded.add(path)
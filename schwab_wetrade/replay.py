@@ -0,0 +1,216 @@
+import gzip
+import json
+import time
+import datetime
+import threading
+from contextlib import suppress
+from collections import defaultdict, deque
+from zoneinfo import ZoneInfo
+from schwab_wetrade.stream_hub import StreamHub
+from schwab_wetrade.market_hours import MarketHours
+from schwab_wetrade.utils import ParsedResponse
+
+
+class Recorder:
+  '''
+  Records stream messages and APIClient responses with their receive time to a gzipped JSON lines file
+
+  Start one with :meth:`APIClient.start_recording`
+
+  :param str path: the file to append recordings to
+  '''
+  def __init__(self, path):
+    self.path = path
+    self.file = gzip.open(path, 'at', encoding='utf-8')
+    self.lock = threading.Lock()
+    self.count = 0
+
+  def _write(self, event):
+    line = json.dumps(event, default=str, separators=(',', ':'))
+    with self.lock:
+      if self.file != None:
+        self.file.write(line + '\n')
+        self.count += 1
+
+  def record_stream(self, service, message):
+    self._write({'t': time.time(), 'kind': 'stream', 'service': service, 'message': message})
+
+  def record_response(self, method, kwargs, r):
+    self._write({
+      't': time.time(),
+      'kind': 'rest',
+      'method': method,
+      'kwargs': kwargs,
+      'status_code': r.status_code,
+      'url': str(r.url),
+      'headers': dict(r.headers),
+      'body': r.text})
+
+  def close(self):
+    with self.lock:
+      if self.file != None:
+        self.file.close()
+        self.file = None
+
+
+def request_key(method, kwargs):
+  '''
+  Returns the key a recorded response is matched on: the method and its kwargs as the recording stores them
+  '''
+  return method, json.dumps(kwargs, default=str, sort_keys=True, separators=(',', ':'))
+
+def load_recording(path):
+  '''
+  Returns the list of events in a recording, oldest first
+  '''
+  with gzip.open(path, 'rt', encoding='utf-8') as f:
+    events = [json.loads(line) for line in f if line.strip() != '']
+  return sorted(events, key=lambda event: event['t'])
+
+
+class ReplayResponse:
+  '''
+  A recorded REST response with the parts of httpx.Response the library uses
+  '''
+  def __init__(self, event):
+    self.status_code = event['status_code']
+    self.url = event['url']
+    self.headers = event['headers']
+    self.text = event['body']
+    self.content = self.text.encode('utf-8')
+
+  def json(self):
+    return json.loads(self.text)
+
+
+class ReplayHub(StreamHub):
+  '''
+  A StreamHub that never connects; messages are fed to it by :meth:`ReplayClient.replay`
+  '''
+  def __init__(self, client):
+    StreamHub.__init__(self, client)
+    self.running = True # never start the streaming thread
+    self.timing = False
+    self.latencies = defaultdict(list) # handler name: [seconds]
+
+  def _call_handler(self, service, handler, message):
+    if self.timing == False:
+      return StreamHub._call_handler(self, service, handler, message)
+    start = time.perf_counter()
+    StreamHub._call_handler(self, service, handler, message)
+    self.latencies[getattr(handler, '__qualname__', repr(handler))].append(time.perf_counter() - start)
+
+
+class ReplayMarketHours(MarketHours):
+  '''
+  MarketHours that keep the market open for the span of a recording and follow the replay clock
+  '''
+  def __init__(self, client):
+    self.client = client
+    self.est = ZoneInfo('US/Eastern')
+    self.open = datetime.datetime.fromtimestamp(client.start_time, self.est)
+    self.close = datetime.datetime.fromtimestamp(client.end_time + 1, self.est)
+    self.date = self.open.date()
+    self.date_str = self.date.strftime('%Y-%m-%d')
+
+  def now_est(self):
+    return datetime.datetime.fromtimestamp(self.client.clock, self.est)
+
+
+class ReplayClient:
+  '''
+  A stand-in for APIClient that serves recorded REST responses and replays recorded stream messages
+  through the same Quote, MultiQuote and Account handlers, without a Schwab connection
+
+  A call gets the next response recorded for the same method and kwargs, or the next one recorded for the method
+  when no recorded call matches (e.g. kwargs holding the current time)
+
+  Give Quote and MultiQuote objects ``client.market_hours()`` as their market_hours so the market stays open during the replay
+
+  :param str path: a recording made with :meth:`APIClient.start_recording`
+  '''
+  def __init__(self, path):
+    events = load_recording(path)
+    self.stream_events = [event for event in events if event['kind'] == 'stream']
+    self.responses = defaultdict(deque) # method: events in recorded order
+    self.keyed_responses = defaultdict(deque) # (method, kwargs): events in recorded order
+    for event in events:
+      if event['kind'] == 'rest':
+        self.responses[event['method']].append(event)
+        self.keyed_responses[request_key(event['method'], event.get('kwargs', {}))].append(event)
+    self.start_time = events[0]['t'] if events else time.time()
+    self.end_time = events[-1]['t'] if events else self.start_time
+    self.clock = self.start_time
+    self.recorder = None
+    self.stream_hub = ReplayHub(self)
+
+  def __getattr__(self, name):
+    if name.startswith('_') or name not in self.__dict__.get('responses', {}):
+      raise AttributeError(name)
+    def replay_response(*args, parsed_response=False, **kwargs):
+      event = self._next_response(self.keyed_responses.get(request_key(name, kwargs)) or self.responses[name])
+      r = ReplayResponse(event)
+      if parsed_response == True:
+        r = ParsedResponse(r)
+        return (r.data, r.status_code)
+      return r
+    return replay_response
+
+  def _next_response(self, queue):
+    if len(queue) == 1:
+      return queue[0] # keep serving the last response
+    event = queue.popleft()
+    for other in (self.responses[event['method']], self.keyed_responses[request_key(event['method'], event.get('kwargs', {}))]):
+      if other is not queue and len(other) > 1: # served once, whichever way it was matched
+        with suppress(ValueError):
+          other.remove(event)
+    return event
+
+  def market_hours(self):
+    return ReplayMarketHours(self)
+
+  def replay(self, speed=1.0):
+    '''
+    Feeds the recorded stream messages to subscribed handlers
+
+    :param float speed: (optional) playback speed relative to the recording; 0 replays as fast as possible
+    '''
+    if self.stream_events == []:
+      return 0
+    first = self.stream_events[0]['t']
+    start = time.perf_counter()
+    for event in self.stream_events:
+      if speed > 0:
+        delay = (event['t'] - first) / speed - (time.perf_counter() - start)
+        if delay > 0:
+          time.sleep(delay)
+      self.clock = event['t']
+      self.stream_hub.dispatch(event['service'], event['message'])
+    return len(self.stream_events)
+
+  def benchmark(self):
+    '''
+    Replays the recording as fast as possible and returns throughput and per-handler latency percentiles (in microseconds)
+    '''
+    hub = self.stream_hub
+    hub.latencies.clear()
+    hub.timing = True
+    start = time.perf_counter()
+    count = self.replay(speed=0)
+    elapsed = time.perf_counter() - start
+    hub.timing = False
+    handlers = {}
+    for name, latencies in hub.latencies.items():
+      latencies = sorted(latencies)
+      percentile = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1e6
+      handlers[name] = {
+        'calls': len(latencies),
+        'p50_us': percentile(.5),
+        'p90_us': percentile(.9),
+        'p99_us': percentile(.99),
+        'max_us': latencies[-1] * 1e6}
+    return {
+      'messages': count,
+      'seconds': elapsed,
+      'messages_per_sec': count / elapsed if elapsed > 0 else 0.0,
+      'handlers': handlers}
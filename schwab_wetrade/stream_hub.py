@@ -0,0 +1,237 @@
+import time
+import asyncio
+import threading
+from contextlib import suppress
+from schwab.streaming import UnexpectedResponseCode
+from schwab_wetrade.utils import log_in_background, start_thread
+from schwab_wetrade.metrics import get_metrics
+
+
+class StreamHub:
+  '''
+  Shares a single streaming connection, thread and event loop between all Quote, MultiQuote and Account objects
+
+  Subscriptions are reference counted by service and key; the server subscription is only
+  changed when the first consumer of a key subscribes or the last one unsubscribes, and each
+  message is only routed to the consumers of the keys it contains
+
+  :param APIClient client: your :ref:`APIClient <api_client>`
+  :param int max_keys_per_request: (optional) the most keys sent in a single SUBS, ADD or UNSUBS request
+  '''
+  services = { # service: (subs, add, unsubs, add handler); keyless services have no add command
+    'LEVELONE_EQUITIES': ('level_one_equity_subs', 'level_one_equity_add', 'level_one_equity_unsubs', 'add_level_one_equity_handler'),
+    'LEVELONE_OPTIONS': ('level_one_option_subs', 'level_one_option_add', 'level_one_option_unsubs', 'add_level_one_option_handler'),
+    'LEVELONE_FUTURES': ('level_one_futures_subs', 'level_one_futures_add', 'level_one_futures_unsubs', 'add_level_one_futures_handler'),
+    'ACCT_ACTIVITY': ('account_activity_sub', None, 'account_activity_unsubs', 'add_account_activity_handler')}
+
+  def __init__(self, client, max_keys_per_request=300):
+    self.client = client
+    self.max_keys_per_request = max_keys_per_request
+    self.consumers = {service: {} for service in self.services} # service: {key: [handler]}
+    self.active_keys = {service: set() for service in self.services} # keys subscribed on the server
+    self.dirty = set()
+    self.running = False
+    self.connected = False
+    self.loop = None
+    self.lock = threading.Lock()
+    self._wakeup = None
+    self._handlers_added = False
+    self.recorder = None
+    self.metrics = get_metrics()
+
+  def subscribe(self, service, keys, handler):
+    '''
+    Routes messages for keys to handler, subscribing on the server if needed
+
+    :param str service: the streaming service (LEVELONE_EQUITIES, ACCT_ACTIVITY, etc.)
+    :param list keys: the symbols to subscribe to (use [''] for ACCT_ACTIVITY)
+    :param handler: a function called with each message containing only the subscribed keys
+    '''
+    with self.lock:
+      consumers = self.consumers[service]
+      for key in keys:
+        handlers = consumers.setdefault(key, [])
+        if handler not in handlers:
+          handlers.append(handler)
+      self.dirty.add(service)
+      start = self.running == False
+      self.running = True
+    if start:
+      start_thread(self._run, name='StreamHub')
+    else:
+      self._wake()
+
+  def unsubscribe(self, service, keys, handler):
+    '''
+    Stops routing messages for keys to handler, unsubscribing on the server once a key has no handlers
+
+    :param str service: the streaming service (LEVELONE_EQUITIES, ACCT_ACTIVITY, etc.)
+    :param list keys: the symbols to unsubscribe from
+    :param handler: the handler passed to :meth:`subscribe`
+    '''
+    with self.lock:
+      consumers = self.consumers[service]
+      for key in keys:
+        handlers = consumers.get(key, [])
+        if handler in handlers:
+          handlers.remove(handler)
+        if handlers == [] and key in consumers:
+          del consumers[key]
+      self.dirty.add(service)
+    self._wake()
+
+  def subscription_count(self, service=''):
+    with self.lock:
+      services = [service] if service != '' else self.services
+      return sum(len(handlers) for s in services for handlers in self.consumers[s].values())
+
+  def dispatch(self, service, message):
+    '''
+    Routes a stream message to the handlers subscribed to the keys it contains
+    '''
+    if self.recorder != None:
+      self.recorder.record_stream(service, message)
+    with self.lock:
+      consumers = self.consumers[service]
+      if self.services[service][1] == None: # keyless, every consumer gets the whole message
+        routed = {handler: None for handlers in consumers.values() for handler in handlers}
+      else:
+        routed = {}
+        for item in message.get('content', []):
+          for handler in consumers.get(item.get('key'), ()):
+            routed.setdefault(handler, []).append(item)
+    for handler, items in routed.items():
+      self._call_handler(service, handler, message if items == None else {**message, 'content': items})
+
+  def _call_handler(self, service, handler, message):
+    start = time.perf_counter()
+    try:
+      handler(message)
+    except Exception as e:
+      log_in_background(
+        called_from = 'StreamHub.dispatch',
+        tags = ['user-message'],
+        message = time.strftime('%H:%M:%S', time.localtime()) + f': Error handling {service} message, check logs',
+        e = e)
+    self.metrics.observe_handler(service, time.perf_counter() - start)
+
+  def _wake(self):
+    with self.lock:
+      loop, wakeup = self.loop, self._wakeup
+    if loop != None:
+      with suppress(RuntimeError): # loop already closed
+        loop.call_soon_threadsafe(wakeup.set)
+
+  def _wanted(self):
+    return any(self.consumers[service] for service in self.services)
+
+  def _run(self):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    with self.lock:
+      self._wakeup = asyncio.Event()
+      self.loop = loop
+    try:
+      loop.run_until_complete(self._stream())
+    finally:
+      loop.close()
+
+  async def _stream(self):
+    while True:
+      try:
+        await self._login()
+        await self._handle_messages()
+        with suppress(Exception):
+          await self.client.logout()
+      except Exception as e:
+        log_in_background(
+          called_from = 'StreamHub._stream',
+          tags = ['user-message'],
+          message = time.strftime('%H:%M:%S', time.localtime()) + ': Stream connection error, reconnecting',
+          e = e)
+        await asyncio.sleep(1)
+      self.connected = False
+      with self.lock:
+        for service in self.services:
+          self.active_keys[service].clear()
+          if self.consumers[service]:
+            self.dirty.add(service)
+        if self._wanted() == False:
+          self.running = False
+          self.loop = None
+          return
+
+  async def _login(self):
+    while True:
+      try:
+        await self.client.login()
+        break
+      except UnexpectedResponseCode as e:
+        await asyncio.get_event_loop().run_in_executor(None, self.client.session.login, False)
+    self.connected = True
+    if self._handlers_added == False:
+      for service, (_, _, _, add_handler) in self.services.items():
+        getattr(self.client, add_handler)(handler=self._router(service))
+      self._handlers_added = True
+
+  def _router(self, service):
+    def route(message):
+      self.metrics.observe_stream_lag(service, message)
+      self.dispatch(service, message)
+    return route
+
+  async def _handle_messages(self):
+    receiving = None
+    try:
+      while True:
+        self._wakeup.clear()
+        await self._sync_subscriptions()
+        with self.lock:
+          if self.dirty == set() and self._wanted() == False:
+            return
+        if receiving == None:
+          receiving = asyncio.ensure_future(self.client.handle_message())
+        waking = asyncio.ensure_future(self._wakeup.wait())
+        done, _ = await asyncio.wait({receiving, waking}, return_when=asyncio.FIRST_COMPLETED)
+        waking.cancel()
+        if receiving in done:
+          task, receiving = receiving, None
+          task.result()
+        else: # subscriptions changed, stop receiving so the commands can be sent
+          receiving.cancel()
+          with suppress(asyncio.CancelledError):
+            await receiving
+          receiving = None
+    finally:
+      if receiving != None:
+        receiving.cancel()
+
+  async def _sync_subscriptions(self):
+    while True:
+      with self.lock:
+        if self.dirty == set():
+          return
+        service = self.dirty.pop()
+        wanted = set(self.consumers[service])
+      active = self.active_keys[service]
+      subs, add, unsubs, _ = self.services[service]
+      removed = active - wanted
+      added = wanted - active
+      if add == None: # keyless
+        if added:
+          await getattr(self.client, subs)()
+        elif removed:
+          await getattr(self.client, unsubs)()
+      else:
+        for keys in self._chunks(removed):
+          await getattr(self.client, unsubs)(symbols=keys)
+          active = active - set(keys)
+        for keys in self._chunks(added):
+          command = subs if active == set() else add # SUBS replaces the whole subscription, ADD extends it
+          await getattr(self.client, command)(symbols=keys)
+          active = active | set(keys)
+      self.active_keys[service] = wanted
+
+  def _chunks(self, keys):
+    keys = sorted(keys)
+    return [keys[i:i+self.max_keys_per_request] for i in range(0, len(keys), self.max_keys_per_request)]
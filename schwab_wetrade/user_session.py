@@ -1,32 +1,79 @@
 import time
 import os
 import json
+import random
+import asyncio
+import weakref
 import threading
+import contextvars
+import importlib.util
+from collections import deque
 import authlib.integrations.base_client.errors as authlib_errors
 from pyotp import TOTP
-from contextlib import suppress
-from playwright.sync_api import sync_playwright
-from authlib.integrations.httpx_client import OAuth2Client
-from schwab.auth import client_from_manual_flow, client_from_token_file
-from schwab_wetrade.utils import log_in_background
+from contextlib import suppress, contextmanager
+from email.utils import parsedate_to_datetime
+import httpx
+from authlib.integrations.httpx_client import OAuth2Client, AsyncOAuth2Client
+from schwab.auth import client_from_manual_flow, client_from_access_functions
+from schwab_wetrade.utils import log_in_background, start_thread
+from schwab_wetrade.metrics import get_metrics
+from schwab_wetrade.coordination import file_lock, atomic_write_json, LeaderLock, SharedBucketState, fcntl
 try: 
   import settings
 except ModuleNotFoundError:
   import schwab_wetrade.project_template.settings as settings
 
-def write_token(token, token_path):
+TOKEN_URL = 'https://api.schwabapi.com/v1/oauth/token'
+RETRY_METHODS = ('GET',) # only requests that are safe to send twice are retried after a connection error or timeout
+REFRESH_TOKEN_LIFETIME = 7 * 24 * 60 * 60 # Schwab refresh tokens expire 7 days after login
+
+_sessions = weakref.WeakSet() # live sessions, read by the limiter_queue_depth gauge without keeping them alive
+_sessions_lock = threading.Lock()
+
+def limiter_queue_depth():
+  '''
+  Returns the number of requests waiting for the rate limiter in each lane, summed over every live session
+  '''
+  with _sessions_lock:
+    sessions = list(_sessions)
+  depth = {}
+  for session in sessions:
+    for lane, stats in session.token_bucket.stats()['lanes'].items():
+      depth[lane] = depth.get(lane, 0) + stats['queue_depth']
+  return depth
+
+def write_token(token, token_path, creation_timestamp=None):
   if token_path != '':
-    with open(token_path, 'w') as f:
-      content = {
-        'creation_timestamp': int(time.time()),
-        'token': token }
-      json.dump(content, f) # not overwriting existing files?
+    write_token_file({
+      'creation_timestamp': int(time.time()) if creation_timestamp == None else int(creation_timestamp),
+      'token': dict(token) }, token_path)
+
+def write_token_file(content, token_path):
+  '''
+  Atomically replaces the token file while holding its lock, so processes sharing it never read a partial token
+  '''
+  with file_lock(token_path + '.lock'):
+    atomic_write_json(token_path, content)
+
+def read_token_file(token_path):
+  with file_lock(token_path + '.lock', shared=True):
+    with open(token_path, 'r') as f:
+      return json.load(f)
+
+def read_token_creation(token_path):
+  '''
+  Returns the creation_timestamp saved in a token file, or None
+  '''
+  with suppress(OSError, ValueError, KeyError, TypeError):
+    return read_token_file(token_path)['creation_timestamp']
+  return None
 
 def get_redirect_url(authorize_url, config={}):
   config = settings.config if config == {} else config
   headless_login = settings.headless_login if hasattr(settings, 'headless_login') else True
   if settings.use_2fa == True:
     totp = TOTP(config['totp_secret'])
+  from playwright.sync_api import sync_playwright # only needed for browser logins
   with sync_playwright() as p:    
     log_in_background(
       called_from = 'get_redirect_url',
@@ -90,10 +137,11 @@ def new_session(config={}, new_token=False):
       called_from = 'new_session',
       tags = ['user-message'], 
       message = time.strftime('%H:%M:%S', time.localtime()) + ': Creating new session from token file')
-    client = client_from_token_file(
-      token_path=token_path,
+    client = client_from_access_functions(
       api_key = config['api_key'],
-      app_secret = config['api_secret'])
+      app_secret = config['api_secret'],
+      token_read_func = lambda: read_token_file(token_path),
+      token_write_func = lambda content, *args, **kwargs: write_token_file(content, token_path))
     return client.session
   if settings.login_method == 'manual':
     client = client_from_manual_flow(
@@ -113,7 +161,7 @@ def new_session(config={}, new_token=False):
     if redirect_url == None:
       return new_session(config=config)
     token = client.fetch_token(
-      url = 'https://api.schwabapi.com/v1/oauth/token',
+      url = TOKEN_URL,
       authorization_response = redirect_url,
       client_id = config['api_key'], 
       auth= (config['api_key'], config['api_secret']))
@@ -122,20 +170,100 @@ def new_session(config={}, new_token=False):
     return client
   
 class UserSession:
+  token_bucket_class = None # TokenBucket, set below
+
   def __init__(self, config={}):
     self.config = settings.config if config == {} else config
     self.session = None
     self.logged_in = False
-    self.token_bucket = TokenBucket(capacity=120, refill_rate=2) # 120 requests/min 
+    token_path = settings.token_path if hasattr(settings, 'token_path') else ''
+    self.token_bucket = self.token_bucket_class(capacity=120, refill_rate=2, reserved=10, min_rate=.25) # 120 requests/min, 10 held for orders
+    if token_path != '' and (not hasattr(settings, 'share_rate_limit') or settings.share_rate_limit == True):
+      self.token_bucket.share(token_path + '.ratelimit') # processes using the same token share one budget
+    self.refresh_leader = LeaderLock(token_path + '.refresh.lock') if token_path != '' else None
+    with _sessions_lock:
+      _sessions.add(self)
+    get_metrics().add_gauge('limiter_queue_depth', limiter_queue_depth)
+    self.request_stats = {lane: {'requests': 0, 'total_latency': 0.0, 'max_latency': 0.0} for lane in self.token_bucket.lanes}
+    self.stats_lock = threading.Lock()
+    self.max_retries = 5
+    self.max_backoff = 30.0
+    self.token_lock = threading.Lock()
+    self.token_swapped = threading.Condition(self.token_lock)
+    self.token_version = 0 # incremented on every token swap
+    self.token_created_at = time.time()
+    self.refresh_margin = settings.token_refresh_margin if hasattr(settings, 'token_refresh_margin') else 600
+    self.refresh_token_warning = settings.refresh_token_warning if hasattr(settings, 'refresh_token_warning') else 24 * 60 * 60
+    self.warned_token_created_at = None
+    self.refresh_stop = threading.Event()
+    self.refresh_wake = threading.Event()
+    self.refresh_requested = False
+    self.refreshing = False
     self.login()
+    if not hasattr(settings, 'refresh_token_in_background') or settings.refresh_token_in_background == True:
+      self.start_token_refresh()
 
-  def renew_token(self): # doesn't work? 
+  def refresh_access_token(self):
+    '''
+    Gets a new access token with the refresh token and swaps it into the session; requests already in flight keep the token they were sent with
+    '''
     token_path = settings.token_path if hasattr(settings, 'token_path') else ''
+    client = OAuth2Client(self.config['api_key'], client_secret=self.config['api_secret'])
     try:
-      self.session.refresh_token('https://api.schwabapi.com/v1/oauth/token')
-      if token_path != '':
-        write_token(self.session.token, token_path)
-      return self.session.token
+      token = client.refresh_token(TOKEN_URL, refresh_token=self.session.token['refresh_token'])
+    finally:
+      client.close()
+    self._swap_token(token)
+    write_token(token, token_path, self.token_created_at)
+    return self.session.token
+
+  def _swap_token(self, token=None):
+    '''
+    Swaps token into the session (or records that login replaced the session) and wakes requests waiting for a new token
+    '''
+    with self.token_swapped:
+      if token != None:
+        self.session.token = token
+      self.token_version += 1
+      self.refresh_requested = False
+      self.token_swapped.notify_all()
+
+  def wait_for_new_token(self, version, timeout=60):
+    '''
+    Asks the refresh thread to get a new token now and waits for it; returns False if the token hasn't changed from version
+    within timeout seconds or no refresh thread is running
+
+    Requests call this instead of logging in themselves, so they never wait on the browser login flow
+    '''
+    with self.token_swapped:
+      if self.token_version != version:
+        return True
+      if self.refreshing == False:
+        return False
+      self.refresh_requested = True
+    self.refresh_wake.set()
+    with self.token_swapped:
+      self.token_swapped.wait_for(lambda: self.token_version != version or self.refreshing == False, timeout)
+      return self.token_version != version
+
+  def reload_token(self):
+    '''
+    Swaps in the token from the token file if it expires later than the session's; returns True if it did
+
+    Processes that share a token file let the one holding the refresh lock refresh it and reload the result
+    '''
+    token_path = settings.token_path if hasattr(settings, 'token_path') else ''
+    with suppress(OSError, ValueError, KeyError):
+      content = read_token_file(token_path)
+      if content['token'].get('expires_at', 0) > self.session.token.get('expires_at', 0):
+        self.token_created_at = content['creation_timestamp']
+        self._swap_token(content['token'])
+        return True
+    return False
+
+  def renew_token(self):
+    try:
+      return self.refresh_access_token()
     except Exception as e:
       log_in_background(
         called_from = 'UserSession.renew_token',
@@ -143,18 +271,102 @@ class UserSession:
         message = time.strftime('%H:%M:%S', time.localtime()) + ': Could not renew token; check logs',
         e = e)
 
-  def login(self, new_token=False):
-    self.logged_in = False
-    try:
-      self.session = new_session(self.config, new_token)
-      self.logged_in = True
-    except Exception as e:
+  def seconds_until_refresh(self):
+    expires_at = self.session.token.get('expires_at') if self.session != None else None
+    if expires_at == None:
+      return 0.0
+    return expires_at - self.refresh_margin - time.time()
+
+  def start_token_refresh(self):
+    '''
+    Starts a background thread that refreshes the access token refresh_margin seconds before it expires
+    (``token_refresh_margin`` in :ref:`settings.py <settings>`, default 600) and warns ahead of the 7 day refresh token expiry
+    '''
+    with self.token_lock:
+      start = self.refreshing == False
+      self.refreshing = True
+      self.refresh_stop.clear()
+    if start:
+      start_thread(self._refresh_loop, name='TokenRefresh', daemon=True)
+
+  def stop_token_refresh(self):
+    with self.token_lock:
+      self.refreshing = False
+      self.refresh_stop.set()
+      self.refresh_wake.set()
+      self.token_swapped.notify_all() # requests waiting for a new token give up
+
+  def _refresh_loop(self):
+    retry_interval = 30.0
+    wait = self.seconds_until_refresh()
+    while True:
+      self.refresh_wake.wait(max(wait, 0))
+      self.refresh_wake.clear()
+      if self.refresh_stop.is_set():
+        return
+      self._check_refresh_token_expiry()
+      if self.seconds_until_refresh() > 0 and self.refresh_requested == False: # woken early to warn about the refresh token
+        wait = self._next_wakeup()
+        continue
+      try:
+        if self.refresh_leader == None or self.refresh_leader.acquire():
+          self.refresh_access_token()
+        elif self.reload_token() == False: # the leader hasn't written a new token yet
+          wait = min(retry_interval, 5.0)
+          continue
+        wait = self._next_wakeup()
+      except authlib_errors.OAuthError as e: # refresh token expired or revoked; log in again off the request path
+        log_in_background(
+          called_from = 'UserSession._refresh_loop',
+          tags = ['user-message'], 
+          message = time.strftime('%H:%M:%S', time.localtime()) + ': Could not refresh token, logging in again',
+          e = e)
+        self.login(new_token=True)
+        wait = self._next_wakeup()
+      except Exception as e:
+        log_in_background(
+          called_from = 'UserSession._refresh_loop',
+          tags = ['user-message'], 
+          message = time.strftime('%H:%M:%S', time.localtime()) + f': Could not refresh token, retrying in {retry_interval:.0f} sec',
+          e = e)
+        wait = retry_interval
+
+  def _next_wakeup(self):
+    wait = self.seconds_until_refresh()
+    if self.warned_token_created_at != self.token_created_at:
+      warn_at = self.token_created_at + REFRESH_TOKEN_LIFETIME - self.refresh_token_warning
+      wait = min(wait, warn_at - time.time())
+    return wait
+
+  def _check_refresh_token_expiry(self):
+    remaining = self.token_created_at + REFRESH_TOKEN_LIFETIME - time.time()
+    if remaining < self.refresh_token_warning and self.warned_token_created_at != self.token_created_at:
+      self.warned_token_created_at = self.token_created_at
       log_in_background(
-        called_from = 'login',
+        called_from = 'UserSession._check_refresh_token_expiry',
         tags = ['user-message'], 
-        message = time.strftime('%H:%M:%S', time.localtime()) + ': Error, retrying login',
-        e = e)
-      self.login(new_token)
+        message = time.strftime('%H:%M:%S', time.localtime()) + f': Schwab refresh token expires in {max(remaining, 0) / 3600:.1f} hours, log in again before then')
+
+  def login(self, new_token=False):
+    self.logged_in = False
+    token_path = settings.token_path if hasattr(settings, 'token_path') else ''
+    while self.logged_in == False: # retry here rather than through self.login, which subclasses wrap
+      try:
+        session = self._open_session(new_token)
+        created_at = read_token_creation(token_path) if token_path != '' else None
+        self.token_created_at = time.time() if created_at == None else created_at
+        self.session = session # requests only see the finished session
+        self.logged_in = True
+        self._swap_token()
+      except Exception as e:
+        log_in_background(
+          called_from = 'login',
+          tags = ['user-message'], 
+          message = time.strftime('%H:%M:%S', time.localtime()) + ': Error, retrying login',
+          e = e)
+
+  def _open_session(self, new_token=False):
+    return new_session(self.config, new_token)
 
   def post(self, *args, **kwargs):
     return self.handle_request('POST', args, kwargs)
@@ -165,67 +377,173 @@ class UserSession:
   def put(self, *args, **kwargs):
     return self.handle_request('PUT', args, kwargs)
 
+  def delete(self, *args, **kwargs):
+    return self.handle_request('DELETE', args, kwargs)
+
+  def lane_stats(self):
+    '''
+    Returns per-lane request counts and latency (including time spent waiting for the rate limiter) with the limiter's wait metrics
+    '''
+    bucket_stats = self.token_bucket.stats()['lanes']
+    with self.stats_lock:
+      return {lane: {
+        'requests': stats['requests'],
+        'average_latency': stats['total_latency'] / stats['requests'] if stats['requests'] else 0.0,
+        'max_latency': stats['max_latency'],
+        **{'limiter_' + k: v for k, v in bucket_stats[lane].items()}}
+        for lane, stats in self.request_stats.items()}
+
+  def _record_latency(self, lane, latency):
+    with self.stats_lock:
+      stats = self.request_stats[lane]
+      stats['requests'] += 1
+      stats['total_latency'] += latency
+      stats['max_latency'] = max(stats['max_latency'], latency)
+
+  def _backoff(self, attempt):
+    return random.uniform(0, min(self.max_backoff, .5 * 2 ** attempt)) # full jitter
+
+  def _request_failed(self, e, attempt, http_method, url):
+    '''
+    Logs an exception raised by a request and returns how to retry it: 'token' (after a new token), 'backoff', or None to re-raise
+    '''
+    called_from = type(self).__name__ + '.handle_request'
+    if isinstance(e, authlib_errors.OAuthError):
+      log_in_background(
+        called_from = called_from,
+        tags = ['user-message'], 
+        message = time.strftime('%H:%M:%S', time.localtime()) + ': OAuth error, waiting for a new token',
+        e = e)
+      return 'token' if attempt < self.max_retries else None
+    log_in_background(
+      called_from = called_from,
+      tags = ['user-message', 'connection-unknown'], 
+      message = time.strftime('%H:%M:%S', time.localtime()) + ': Error making request, check logs',
+      url = url,
+      e = e) 
+    if attempt < self.max_retries and http_method in RETRY_METHODS and isinstance(e, httpx.TransportError):
+      return 'backoff'
+    return None # the server may have already acted on it (e.g. placed an order)
+
+  def _response_retry_delay(self, r, lane, start, attempt):
+    '''
+    Records a response and returns the seconds to wait before retrying it, or None if it should be returned
+    '''
+    called_from = type(self).__name__ + '.handle_request'
+    self._record_latency(lane, time.monotonic() - start)
+    if r.status_code == 429: # Too many requests, slow down and retry
+      retry_after = parse_retry_after(r.headers.get('Retry-After'))
+      previous_rate = self.token_bucket.refill_rate
+      rate = self.token_bucket.on_throttled(retry_after)
+      if rate < previous_rate:
+        log_in_background(
+          called_from = called_from,
+          tags = ['user-message'], 
+          message = time.strftime('%H:%M:%S', time.localtime()) + f': Too many Schwab API requests, slowing request rate to {rate:.2f}/sec')
+      if attempt == self.max_retries:
+        return None
+      return self._backoff(attempt) if retry_after == None else 0.0 # the bucket holds requests until Retry-After passes
+    self.token_bucket.on_success()
+    if r.status_code == 403: # Access denied; should get a new token
+      log_in_background(
+        called_from = called_from,
+        tags = ['user-message'], 
+        message = time.strftime('%H:%M:%S', time.localtime()) + ': API Auth error, resolve with Schwab')
+    return None
+
   def handle_request(self, http_method, args, kwargs):
     if self.logged_in:
       url = kwargs['url'] if 'url' in kwargs else ''
-      while not self.token_bucket.consume():
-        time.sleep(.5)
-      try:
-        r = self.session.request(http_method, *args, **kwargs, timeout=30)
-      except authlib_errors.OAuthError as e:
-        log_in_background(
-          called_from = 'UserSession.handle_request',
-          tags = ['user-message'], 
-          message = time.strftime('%H:%M:%S', time.localtime()) + ': OAuth error, creating new User Session',
-          e = e)
-        self.login(new_token=True)
-        return self.handle_request(http_method, args, kwargs)
-      except Exception as e:
-        # print(e)
-        error_num = 0
-        error_msg = ''
-        with suppress(Exception):
-          error_num = e.args[0].args[1].errno
-          error_msg = e.args[0].args[1].message
-        log_in_background(
-          called_from = 'UserSession.handle_request',
-          tags = ['user-message', 'connection-unknown'], 
-          message = time.strftime('%H:%M:%S', time.localtime()) + ': Error making request, check logs',
-          url = url,
-          e = e) 
-      if r.status_code == 429: # Too many requests, pause or slow down traffic
-        if self.token_bucket.refill_rate == 1: # need to keep track of interval or count - might want opause anyway
-          log_in_background(
-            called_from = 'UserSession.handle_request',
-            tags = ['user-message'], 
-            message = time.strftime('%H:%M:%S', time.localtime()) + ': Too Schwab API requests, pausing requests for 30 sec')
-          self.token_bucket.freeze_refill(30.0)
-        else:
-          log_in_background(
-            called_from = 'UserSession.handle_request',
-            tags = ['user-message'], 
-            message = time.strftime('%H:%M:%S', time.localtime()) + ': Too Schwab API requests, slowing request rate')
-          self.token_bucket.refill_rate = 1 # (.75 * self.token_bucket.refill_rate) # runs like 5x in a row, need to keep track of interval since last slowdown
-        return self.handle_request(http_method, args, kwargs)
-      if r.status_code == 403: # Access denied; should get a new token
-        log_in_background(
-          called_from = 'UserSession.handle_request',
-          tags = ['user-message'], 
-          message = time.strftime('%H:%M:%S', time.localtime()) + ': API Auth error, resolve with Schwab')
-        # get a new token 
-      return r
+      lane = self.token_bucket.resolve_lane()
+      for attempt in range(self.max_retries + 1):
+        start = time.monotonic()
+        self.token_bucket.acquire(lane=lane)
+        token_version = self.token_version
+        try:
+          r = self.session.request(http_method, *args, **kwargs, timeout=30)
+        except Exception as e:
+          retry = self._request_failed(e, attempt, http_method, url)
+          if retry == 'token' and self.wait_for_new_token(token_version):
+            continue
+          if retry == 'backoff':
+            time.sleep(self._backoff(attempt))
+            continue
+          raise
+        delay = self._response_retry_delay(r, lane, start, attempt)
+        if delay == None:
+          return r
+        time.sleep(delay)
+
+def parse_retry_after(value):
+  '''
+  Returns the seconds to wait from a Retry-After header (delay seconds or an HTTP date), or None
+  '''
+  if value == None:
+    return None
+  try:
+    return max(float(value), 0.0)
+  except ValueError:
+    pass
+  with suppress(TypeError, ValueError):
+    return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+  return None
+
+LANES = ('orders', 'account', 'quotes', 'history') # highest priority first
+
+_request_lane = contextvars.ContextVar('request_lane', default=None) # per thread and per asyncio task
+
+@contextmanager
+def request_lane(lane):
+  '''
+  Tags requests made inside the with block (by this thread or asyncio task) with a :class:`TokenBucket` lane
+  '''
+  token = _request_lane.set(lane)
+  try:
+    yield
+  finally:
+    _request_lane.reset(token)
+
+def current_lane(default='account'):
+  lane = _request_lane.get()
+  return default if lane == None else lane
 
 class TokenBucket:
-  def __init__(self, capacity, refill_rate):
+  '''
+  A token bucket rate limiter; :meth:`acquire` parks callers until the exact time the next token is available
+
+  Callers are served by lane priority, then in arrival order within a lane, and the last ``reserved``
+  tokens can only be taken by the first (critical) lane so order traffic never queues behind market data
+
+  :param int capacity: the most tokens the bucket can hold
+  :param float refill_rate: tokens added per second
+  :param tuple lanes: (optional) lane names, highest priority first
+  :param int reserved: (optional) tokens held back for the first lane
+  :param float min_rate: (optional) the lowest refill_rate :meth:`on_throttled` will cut to (default: refill_rate / 8)
+  :param float decrease_factor: (optional) the refill_rate multiplier applied on each throttle
+  :param float increase_step: (optional) tokens/sec added back after each increase_interval without a throttle
+  :param float increase_interval: (optional) seconds of sustained success between increases
+  '''
+  def __init__(self, capacity, refill_rate, lanes=LANES, reserved=0, min_rate=None, decrease_factor=.5, increase_step=.1, increase_interval=5.0):
     self.capacity = capacity
     self.tokens = capacity
     self.refill_rate = refill_rate
-    self.last_check = time.time()
+    self.max_rate = refill_rate # additive increase never goes above the configured rate
+    self.min_rate = refill_rate / 8 if min_rate == None else min_rate
+    self.decrease_factor = decrease_factor
+    self.increase_step = increase_step
+    self.increase_interval = increase_interval
+    self.last_adjustment = 0.0
+    self.throttle_count = 0
+    self.last_check = time.monotonic()
     self.freeze_until = 0
     self.lock = threading.Lock()
+    self.lanes = tuple(lanes)
+    self.reserved = min(reserved, capacity - 1)
+    self.waiters = {lane: deque() for lane in self.lanes} # one Condition per waiting caller
+    self.lane_stats = {lane: {'waits': 0, 'total_wait': 0.0, 'max_wait': 0.0} for lane in self.lanes}
 
   def _refill(self):
-    now = time.time()
+    now = time.monotonic()
     if now < self.freeze_until:
       self.last_check = now
       return
@@ -234,13 +552,342 @@ class TokenBucket:
     self.tokens = min(self.capacity, self.tokens + new_tokens)
     self.last_check = now
 
-  def consume(self, tokens=1):
+  def _time_until(self, tokens):
+    wait = max(self.freeze_until - time.monotonic(), 0)
+    deficit = tokens - self.tokens
+    if deficit > 0:
+      wait += deficit / self.refill_rate if self.refill_rate > 0 else 1.0
+    return wait
+
+  def resolve_lane(self, lane=None):
+    lane = current_lane() if lane == None else lane
+    return lane if lane in self.waiters else self.lanes[-1]
+
+  def share(self, path):
+    '''
+    Shares this bucket's budget (tokens, refill rate and pauses) with every process that shares the same path; call it before the bucket is used
+
+    Lane priority and the orders reserve still apply between callers within each process
+    '''
+    if fcntl != None:
+      self.lock = SharedBucketState(path, self)
+
+  def _available(self, tokens):
+    return self.tokens >= tokens and time.monotonic() >= self.freeze_until
+
+  def _needed(self, tokens, lane):
+    return tokens if lane == self.lanes[0] else tokens + self.reserved
+
+  def _head(self):
+    for lane in self.lanes:
+      if len(self.waiters[lane]) > 0:
+        return self.waiters[lane][0]
+    return None
+
+  def _queued_ahead(self, lane):
+    '''
+    Whether callers in this lane or a higher priority one are already waiting
+    '''
+    for name in self.lanes:
+      if len(self.waiters[name]) > 0:
+        return True
+      if name == lane:
+        return False
+
+  def consume(self, tokens=1, lane=None):
+    '''
+    Takes tokens without waiting; returns False if they aren't available or callers with the same or higher priority are waiting
+    '''
+    lane = self.resolve_lane(lane)
     with self.lock:
       self._refill()
-      if self.tokens >= tokens:
+      if self._available(self._needed(tokens, lane)) and not self._queued_ahead(lane):
         self.tokens -= tokens
         return True
       return False
+
+  def acquire(self, tokens=1, timeout=None, lane=None):
+    '''
+    Blocks until tokens are available and takes them; returns the seconds waited, or None on timeout
+
+    :param int tokens: (optional) the number of tokens to take
+    :param float timeout: (optional) the most seconds to wait
+    :param str lane: (optional) the priority lane (default: the lane set with :func:`request_lane`)
+    '''
+    lane = self.resolve_lane(lane)
+    needed = self._needed(tokens, lane)
+    start = time.monotonic()
+    deadline = None if timeout == None else start + timeout
+    with self.lock:
+      self._refill()
+      if self._available(needed) and not self._queued_ahead(lane):
+        self.tokens -= tokens
+        self._record_wait(lane, 0.0)
+        return 0.0
+      waiter = threading.Condition(self.lock)
+      self.waiters[lane].append(waiter) # a preempted head finds it is no longer first when it wakes
+      try:
+        while True:
+          if self._head() is waiter:
+            self._refill()
+            if self._available(needed):
+              self.tokens -= tokens
+              break
+            wait = self._time_until(needed)
+          else:
+            wait = None # woken when this caller reaches the head of the queue
+          if deadline != None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+              return None
+            wait = remaining if wait == None else min(wait, remaining)
+          waiter.wait(wait)
+      finally:
+        was_head = self._head() is waiter
+        self.waiters[lane].remove(waiter)
+        if was_head:
+          self._wake_head()
+      waited = time.monotonic() - start
+      self._record_wait(lane, waited)
+      return waited
+
+  def _record_wait(self, lane, waited):
+    get_metrics().observe_limiter_wait(lane, waited)
+    stats = self.lane_stats[lane]
+    stats['waits'] += 1
+    stats['total_wait'] += waited
+    stats['max_wait'] = max(stats['max_wait'], waited)
+
+  def _wake_head(self):
+    head = self._head()
+    if head != None:
+      head.notify()
   
   def freeze_refill(self, seconds):
-    self.freeze_until = max(self.freeze_until, time.time() + seconds)
\ No newline at end of file
+    with self.lock:
+      self.freeze_until = max(self.freeze_until, time.monotonic() + seconds)
+      self._wake_head()
+
+  def set_refill_rate(self, refill_rate):
+    with self.lock:
+      self._refill()
+      self.refill_rate = refill_rate
+      self._wake_head() # recompute the head's wait with the new rate
+
+  def on_throttled(self, retry_after=None):
+    '''
+    Multiplicative decrease after a 429; drains the bucket down to the reserve and pauses every lane for retry_after seconds if given.
+    Returns the new refill_rate
+
+    Throttles within one refill interval of the last decrease come from requests already in flight and only cut the rate once
+    '''
+    with self.lock:
+      self._refill()
+      now = time.monotonic()
+      self.throttle_count += 1
+      if now - self.last_adjustment >= 1 / self.refill_rate:
+        self.refill_rate = max(self.min_rate, self.refill_rate * self.decrease_factor)
+        self.last_adjustment = now
+      self.tokens = min(self.tokens, self.reserved) # keep only the orders reserve
+      if retry_after != None:
+        self.freeze_until = max(self.freeze_until, now + retry_after)
+      self._wake_head()
+      return self.refill_rate
+
+  def on_success(self):
+    '''
+    Additive increase toward max_rate after increase_interval seconds without a throttle
+    '''
+    if self.refill_rate < self.max_rate:
+      with self.lock:
+        now = time.monotonic()
+        if self.refill_rate < self.max_rate and now - self.last_adjustment >= self.increase_interval:
+          self._refill()
+          self.refill_rate = min(self.max_rate, self.refill_rate + self.increase_step)
+          self.last_adjustment = now
+          self._wake_head()
+
+  def stats(self):
+    '''
+    Returns the current queue depth and wait time metrics, overall and per lane
+    '''
+    with self.lock:
+      lanes = {}
+      for lane in self.lanes:
+        stats = self.lane_stats[lane]
+        lanes[lane] = {
+          'queue_depth': len(self.waiters[lane]),
+          'waits': stats['waits'],
+          'average_wait': stats['total_wait'] / stats['waits'] if stats['waits'] else 0.0,
+          'max_wait': stats['max_wait']}
+      waits = sum(stats['waits'] for stats in self.lane_stats.values())
+      total_wait = sum(stats['total_wait'] for stats in self.lane_stats.values())
+      return {
+        'tokens': self.tokens,
+        'refill_rate': self.refill_rate,
+        'max_rate': self.max_rate,
+        'throttles': self.throttle_count,
+        'reserved': self.reserved,
+        'queue_depth': sum(len(waiters) for waiters in self.waiters.values()),
+        'waits': waits,
+        'average_wait': total_wait / waits if waits else 0.0,
+        'max_wait': max(stats['max_wait'] for stats in self.lane_stats.values()),
+        'lanes': lanes}
+
+UserSession.token_bucket_class = TokenBucket
+
+
+class AsyncWaiter:
+  '''
+  An asyncio stand-in for the threading.Condition each waiting caller parks on in :class:`TokenBucket`
+  '''
+  def __init__(self):
+    self.loop = asyncio.get_running_loop()
+    self.event = asyncio.Event()
+
+  def notify(self): # called with the bucket lock held, possibly from another thread
+    self.loop.call_soon_threadsafe(self.event.set)
+
+
+class AsyncTokenBucket(TokenBucket):
+  '''
+  A :class:`TokenBucket` whose :meth:`acquire` is a coroutine, so waiting callers park on the event loop instead of a thread
+  '''
+  async def acquire(self, tokens=1, timeout=None, lane=None):
+    '''
+    Waits until tokens are available and takes them; returns the seconds waited, or None on timeout
+
+    :param int tokens: (optional) the number of tokens to take
+    :param float timeout: (optional) the most seconds to wait
+    :param str lane: (optional) the priority lane (default: the lane set with :func:`request_lane`)
+    '''
+    lane = self.resolve_lane(lane)
+    needed = self._needed(tokens, lane)
+    start = time.monotonic()
+    deadline = None if timeout == None else start + timeout
+    with self.lock:
+      self._refill()
+      if self._available(needed) and not self._queued_ahead(lane):
+        self.tokens -= tokens
+        self._record_wait(lane, 0.0)
+        return 0.0
+      waiter = AsyncWaiter()
+      self.waiters[lane].append(waiter)
+    try:
+      while True:
+        with self.lock:
+          if self._head() is waiter:
+            self._refill()
+            if self._available(needed):
+              self.tokens -= tokens
+              break
+            wait = self._time_until(needed)
+          else:
+            wait = None # woken when this caller reaches the head of the queue
+          waiter.event.clear()
+        if deadline != None:
+          remaining = deadline - time.monotonic()
+          if remaining <= 0:
+            return None
+          wait = remaining if wait == None else min(wait, remaining)
+        with suppress(asyncio.TimeoutError):
+          await asyncio.wait_for(waiter.event.wait(), wait)
+    finally:
+      with self.lock:
+        was_head = self._head() is waiter
+        self.waiters[lane].remove(waiter)
+        if was_head:
+          self._wake_head()
+    waited = time.monotonic() - start
+    with self.lock:
+      self._record_wait(lane, waited)
+    return waited
+
+
+class AsyncUserSession(UserSession):
+  '''
+  A UserSession for asyncio code; requests share a pool of keep-alive connections (HTTP/2 when the h2 package is installed)
+  and wait for the rate limiter on the event loop
+
+  Create it outside of a running event loop (or in an executor), since logging in may need the browser login flow
+
+  :param dict config: (optional) the config for the account, default is the config in :ref:`settings.py <settings>`
+  :param int max_connections: (optional) the most open connections in the pool and requests in flight at once
+  '''
+  token_bucket_class = AsyncTokenBucket
+
+  def __init__(self, config={}, max_connections=20):
+    self.max_connections = max_connections
+    self.in_flight = None
+    self.in_flight_loop = None
+    UserSession.__init__(self, config)
+
+  def _in_flight(self):
+    '''
+    Returns the running loop's semaphore capping requests at max_connections; requests past that wait here rather than in
+    the connection pool, whose queue gets slower the longer it is
+    '''
+    loop = asyncio.get_running_loop()
+    if self.in_flight_loop is not loop:
+      self.in_flight = asyncio.Semaphore(self.max_connections)
+      self.in_flight_loop = loop
+    return self.in_flight
+
+  def _open_session(self, new_token=False):
+    sync_session = new_session(self.config, new_token)
+    token_path = settings.token_path if hasattr(settings, 'token_path') else ''
+    async def update_token(token, *args, **kwargs):
+      write_token(token, token_path, self.token_created_at)
+    session = AsyncOAuth2Client(
+      self.config['api_key'],
+      client_secret = self.config['api_secret'],
+      token = sync_session.token,
+      token_endpoint = TOKEN_URL,
+      update_token = update_token,
+      leeway = 300,
+      http2 = importlib.util.find_spec('h2') != None,
+      limits = httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections))
+    sync_session.close()
+    return session
+
+  async def renew_token(self):
+    return await asyncio.get_running_loop().run_in_executor(None, UserSession.renew_token, self)
+
+  async def post(self, *args, **kwargs):
+    return await self.handle_request('POST', args, kwargs)
+      
+  async def get(self, *args, **kwargs):
+    return await self.handle_request('GET', args, kwargs)
+
+  async def put(self, *args, **kwargs):
+    return await self.handle_request('PUT', args, kwargs)
+
+  async def delete(self, *args, **kwargs):
+    return await self.handle_request('DELETE', args, kwargs)
+
+  async def aclose(self):
+    await self.session.aclose()
+
+  async def handle_request(self, http_method, args, kwargs):
+    if self.logged_in:
+      url = kwargs['url'] if 'url' in kwargs else ''
+      lane = self.token_bucket.resolve_lane()
+      for attempt in range(self.max_retries + 1):
+        start = time.monotonic()
+        await self.token_bucket.acquire(lane=lane)
+        token_version = self.token_version
+        try:
+          async with self._in_flight():
+            r = await self.session.request(http_method, *args, **kwargs, timeout=30)
+        except Exception as e:
+          retry = self._request_failed(e, attempt, http_method, url)
+          if retry == 'token' and await asyncio.get_running_loop().run_in_executor(None, self.wait_for_new_token, token_version):
+            continue
+          if retry == 'backoff':
+            await asyncio.sleep(self._backoff(attempt))
+            continue
+          raise
+        delay = self._response_retry_delay(r, lane, start, attempt)
+        if delay == None:
+          return r
+        await asyncio.sleep(delay)
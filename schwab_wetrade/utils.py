@@ -1,3 +1,10 @@
+import io
+import sys
+import time
+import heapq
+import queue
+import itertools
+import atexit
 import logging
 import pprint
 import threading
@@ -5,36 +12,280 @@ import asyncio
 import traceback
 import os
 import ast
-import google.cloud.logging
-from google.cloud import secretmanager
+from contextlib import suppress
+from concurrent.futures import ThreadPoolExecutor
 try: 
   import settings
 except ModuleNotFoundError:
   import schwab_wetrade.project_template.settings as settings
+try:
+  from orjson import loads as json_loads
+except ModuleNotFoundError:
+  from json import loads as json_loads
   
 
-def start_thread(func, name=None, args=[], kwargs={}):
-  threading.Thread(target=func, name=name, args=args, kwargs=kwargs).start()
+def start_thread(func, name=None, args=[], kwargs={}, daemon=None):
+  thread = threading.Thread(target=func, name=name, args=args, kwargs=kwargs, daemon=daemon)
+  thread.start()
+  return thread
+
+def call_later(delay, func, args=[], kwargs={}):
+  '''
+  Runs func(*args, **kwargs) after delay seconds without starting a thread per call; returns a handle with cancel()
+  '''
+  return get_scheduler().call_later(delay, func, args, kwargs)
+
+
+class ScheduledCall:
+  def __init__(self, when, func, args, kwargs):
+    self.when = when
+    self.func = func
+    self.args = args
+    self.kwargs = kwargs
+    self.cancelled = False
+
+  def cancel(self):
+    self.cancelled = True
+
+  def run(self):
+    if self.cancelled == False:
+      try:
+        self.func(*self.args, **self.kwargs)
+      except Exception as e:
+        log_in_background(
+          called_from = 'ScheduledCall.run',
+          tags = ['user-message'],
+          message = time.strftime('%H:%M:%S', time.localtime()) + f': Error in scheduled call to {getattr(self.func, "__qualname__", self.func)}, check logs',
+          e = e)
+
+
+class Scheduler:
+  '''
+  Runs delayed calls from one timer thread, handing due calls to a small thread pool so a slow call doesn't hold up the others
+
+  :param int max_workers: (optional) the most calls run at once
+  '''
+  def __init__(self, max_workers=4):
+    self.heap = [] # (when, sequence, ScheduledCall)
+    self.sequence = itertools.count()
+    self.condition = threading.Condition()
+    self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='Scheduler')
+    self.running = False
+
+  def call_later(self, delay, func, args=[], kwargs={}):
+    call = ScheduledCall(time.monotonic() + delay, func, args, kwargs)
+    with self.condition:
+      heapq.heappush(self.heap, (call.when, next(self.sequence), call))
+      start = self.running == False
+      self.running = True
+      self.condition.notify()
+    if start:
+      start_thread(self._run, name='Scheduler', daemon=True)
+    return call
+
+  def _run(self):
+    while True:
+      with self.condition:
+        while self.heap == [] or self.heap[0][0] > time.monotonic():
+          self.condition.wait(None if self.heap == [] else self.heap[0][0] - time.monotonic())
+        call = heapq.heappop(self.heap)[2]
+      if call.cancelled == False:
+        self.executor.submit(call.run)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler():
+  '''
+  Returns the Scheduler used by :func:`call_later`
+  '''
+  global _scheduler
+  if _scheduler == None:
+    with _scheduler_lock:
+      if _scheduler == None:
+        _scheduler = Scheduler()
+  return _scheduler
 
 def parse_response_data(r):
-  try:
-    return r.json()
-  except: # r.status_code == 204 (no content) and other non-parsable requests 
-    return str(r.content)  
+  return ParsedResponse.wrap(r).data
+
+
+class ParsedResponse:
+  '''
+  An API response whose body is decoded once (with orjson when it's installed) and shared by callers and loggers
+
+  :param r: an httpx.Response
+  '''
+  _unparsed = object()
+
+  def __init__(self, r):
+    self.response = r
+    self.status_code = r.status_code
+    self.url = str(r.url)
+    self.headers = r.headers
+    self._data = self._unparsed
+    self._is_error = None
+
+  @classmethod
+  def wrap(cls, r):
+    return r if isinstance(r, ParsedResponse) else cls(r)
+
+  @property
+  def data(self):
+    '''
+    The decoded JSON body, or the raw content as a string when it isn't JSON (e.g. 204 No Content)
+    '''
+    if self._data is self._unparsed:
+      try:
+        self._data = json_loads(self.response.content)
+      except Exception:
+        self._data = str(self.response.content)
+    return self._data
+
+  def json(self):
+    return self.data
+
+  @property
+  def is_error(self):
+    '''
+    Whether the body reports an error
+    '''
+    if self._is_error == None:
+      try:
+        self._is_error = 'Error' in self.data
+      except TypeError:
+        self._is_error = False
+    return self._is_error
   
 def log_in_background(called_from, r=None, url='', tags=[], account_key='', symbol='', message='', e=None):
-  start_thread(pretty_print, args=[called_from, r, url, tags, account_key, symbol, message, e])
-  if hasattr(settings, 'enable_logging') and settings.enable_logging == True:
-    start_thread(log, args=[called_from, r, url, tags, account_key, symbol, message, e])
+  get_log_queue().put((called_from, r, url, tags, account_key, symbol, message, e))
+
+
+class LogQueue:
+  '''
+  A bounded queue of log records written by one background thread, so logging on the hot path is a non-blocking put
+
+  The thread prints each batch of records to stdout with a single write and passes them to :func:`log` when
+  enable_logging is set in :ref:`settings.py <settings>`. Records left in the queue are written at exit
+
+  :param int maxsize: (optional) the most records waiting to be written
+  :param int batch_size: (optional) the most records written per batch
+  :param str overflow: (optional) what to do when the queue is full: 'drop_oldest' or 'drop_newest'
+  '''
+  def __init__(self, maxsize=10000, batch_size=100, overflow='drop_oldest'):
+    self.queue = queue.Queue(maxsize)
+    self.batch_size = batch_size
+    self.overflow = overflow
+    self.lock = threading.Lock()
+    self.counts = {'enqueued': 0, 'written': 0, 'dropped': 0, 'errors': 0}
+    self.running = True
+    self.thread = start_thread(self._run, name='LogQueue', daemon=True)
+    atexit.register(self.close)
+
+  def put(self, record):
+    with self.lock:
+      self.counts['enqueued'] += 1
+      try:
+        self.queue.put_nowait(record)
+        return True
+      except queue.Full:
+        self.counts['dropped'] += 1
+        if self.overflow == 'drop_newest':
+          return False
+        with suppress(queue.Empty):
+          self.queue.get_nowait()
+        self.queue.put_nowait(record)
+        return True
+
+  def _run(self):
+    while True:
+      batch = [self.queue.get()]
+      with suppress(queue.Empty):
+        while len(batch) < self.batch_size and batch[-1] != None:
+          batch.append(self.queue.get_nowait())
+      self._write(batch)
+      if batch[-1] == None: # close() queued this after every record it has to write
+        return
+
+  def _write(self, batch):
+    stream = io.StringIO()
+    cloud_logging = hasattr(settings, 'enable_logging') and settings.enable_logging == True
+    for record in batch:
+      if record == None: # wakes the thread on close
+        continue
+      try:
+        pretty_print(*record, stream=stream)
+        if cloud_logging:
+          log(*record)
+      except Exception:
+        with self.lock:
+          self.counts['errors'] += 1
+    if stream.tell() > 0:
+      sys.stdout.write(stream.getvalue())
+      sys.stdout.flush()
+    with self.lock:
+      self.counts['written'] += len([record for record in batch if record != None])
+
+  def flush(self):
+    '''
+    Writes every queued record from the calling thread
+    '''
+    batch = []
+    with suppress(queue.Empty):
+      while True:
+        batch.append(self.queue.get_nowait())
+    if batch != []:
+      self._write(batch)
+
+  def close(self, timeout=5.0):
+    '''
+    Waits up to timeout seconds for the writer thread to write every queued record and exit
+
+    :param float timeout: (optional) the most seconds to wait
+    '''
+    if self.running == False:
+      return
+    self.running = False
+    deadline = time.monotonic() + timeout
+    with suppress(queue.Full):
+      self.queue.put(None, timeout=timeout) # waits for room if the queue is full
+    self.thread.join(max(deadline - time.monotonic(), 0))
+    if not self.thread.is_alive():
+      self.flush() # records put after close, now that the thread can't be writing at the same time
+
+  def stats(self):
+    with self.lock:
+      return {**self.counts, 'queue_depth': self.queue.qsize()}
+
+
+_log_queue = None
+_log_queue_lock = threading.Lock()
+
+def get_log_queue():
+  '''
+  Returns the LogQueue used by :func:`log_in_background`
+  '''
+  global _log_queue
+  if _log_queue == None:
+    with _log_queue_lock:
+      if _log_queue == None:
+        _log_queue = LogQueue(
+          maxsize = settings.log_queue_size if hasattr(settings, 'log_queue_size') else 10000)
+        from schwab_wetrade.metrics import get_metrics
+        get_metrics().add_gauge('log_queue', _log_queue.stats)
+  return _log_queue
 
-def pretty_print(called_from, r=None, url='', tags=[], account_key='', symbol='', message='', e=None):
+def pretty_print(called_from, r=None, url='', tags=[], account_key='', symbol='', message='', e=None, stream=None):
+  stream = sys.stdout if stream == None else stream
   if message != '':
-    print(message)
+    print(message, file=stream)
   if e:
-    print('e', e)
+    print('e', e, file=stream)
     # traceback.print_exception(type(e), e, e.__traceback__)
   if r != None:
-    response = parse_response_data(r)
+    r = ParsedResponse.wrap(r)
+    response = r.data
     # pprint.pprint({
       # 'called_from': called_from,
       # 'tags': [*tags, 'response'],
@@ -44,7 +295,7 @@ def pretty_print(called_from, r=None, url='', tags=[], account_key='', symbol=''
       # 'url': url,
       # 'status_code': r.status_code, 
       # 'response': response})
-    if 'Error' in response:
+    if r.is_error:
       response_tags = ['response', 'error']
       pprint.pprint({
         'called_from': called_from,
@@ -54,12 +305,14 @@ def pretty_print(called_from, r=None, url='', tags=[], account_key='', symbol=''
         'symbol': symbol,
         'url': url,
         'status_code': r.status_code, 
-        'response': response})
+        'response': response},
+        stream = stream)
 
 def log(called_from, r=None, url='', tags=[], account_key='', symbol='', message='', e=None):
   if r != None:
-    response = parse_response_data(r)
-    log_level = 30 if 'Error' in response else 20
+    r = ParsedResponse.wrap(r)
+    response = r.data
+    log_level = 30 if r.is_error else 20
     response_tags = ['response'] if log_level == 20 else ['response', 'error']
     logging.log(
       log_level,
@@ -92,6 +345,7 @@ def log(called_from, r=None, url='', tags=[], account_key='', symbol='', message
     
 def setup_cloud_logging():
   if hasattr(settings, 'enable_logging') and settings.enable_logging == True:
+    import google.cloud.logging # loaded on first use to keep imports fast
     client = google.cloud.logging.Client()
     client.setup_logging()
 
@@ -103,6 +357,7 @@ def get_gcloud_secret(secret_id, version_id='latest'):
     gcloud_data = ast.literal_eval(data)
     project_id = gcloud_data['project_id']
     secret_name = f'projects/{project_id}/secrets/{secret_id}/versions/{version_id}'
+    from google.cloud import secretmanager
     client = secretmanager.SecretManagerServiceClient()
     response = client.access_secret_version(name=secret_name)
     return response.payload.data.decode('UTF-8')
\ No newline at end of file
@@ -21,6 +21,7 @@ setuptools.setup(
     'google-cloud-logging', 
     'google-cloud-storage', 
     'google-cloud-secret-manager',
+    'numpy',
     'polars', 
     'pandas', 
     'pyarrow'],
@@ -0,0 +1,71 @@
+import time
+import asyncio
+import threading
+import pytest
+from authlib.integrations.httpx_client import OAuth2Client
+import schwab_wetrade.user_session as user_session
+
+
+class StandInServer:
+  '''
+  A local HTTP/1.1 server standing in for the Schwab API: every request waits latency seconds, then gets respond(method, path)'s
+  (status, headers, body)
+  '''
+  def __init__(self, latency=.02, respond=None):
+    self.latency = latency
+    self.respond = respond if respond != None else lambda method, path: (200, {'Content-Type': 'application/json'}, b'{}')
+    self.requests = 0
+    self.ready = threading.Event()
+    self.thread = threading.Thread(target=asyncio.run, args=(self._serve(),), daemon=True)
+    self.thread.start()
+    self.ready.wait(5)
+    self.url = f'http://127.0.0.1:{self.port}'
+
+  async def _handle(self, reader, writer):
+    try:
+      while True:
+        request_line = await reader.readline()
+        if not request_line:
+          break
+        length = 0
+        while True:
+          header = await reader.readline()
+          if header in (b'\r\n', b''):
+            break
+          name, _, value = header.decode().partition(':')
+          if name.strip().lower() == 'content-length':
+            length = int(value)
+        if length:
+          await reader.readexactly(length)
+        method, path = request_line.decode().split()[:2]
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        status, headers, body = self.respond(method, path)
+        head = f'HTTP/1.1 {status} OK\r\nContent-Length: {len(body)}\r\n' + ''.join(f'{k}: {v}\r\n' for k, v in headers.items())
+        writer.write(head.encode() + b'\r\n' + body)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+      pass
+    writer.close()
+
+  async def _serve(self):
+    server = await asyncio.start_server(self._handle, '127.0.0.1', 0, backlog=1024)
+    self.port = server.sockets[0].getsockname()[1]
+    self.ready.set()
+    await server.serve_forever()
+
+
+@pytest.fixture
+def stand_in_server():
+  return StandInServer
+
+@pytest.fixture
+def offline_login(monkeypatch):
+  '''
+  Logs sessions in with a fake token, no token file and no background refresh
+  '''
+  token = {'access_token': 'token', 'refresh_token': 'refresh', 'token_type': 'Bearer', 'expires_at': time.time() + 3600}
+  monkeypatch.setattr(user_session, 'new_session', lambda config={}, new_token=False: OAuth2Client(config['api_key'], token=token))
+  monkeypatch.setattr(user_session.settings, 'token_path', '', raising=False)
+  monkeypatch.setattr(user_session.settings, 'refresh_token_in_background', False, raising=False)
+  return {'api_key': 'key', 'api_secret': 'secret'}
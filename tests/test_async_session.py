@@ -0,0 +1,38 @@
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from schwab_wetrade.user_session import UserSession, AsyncUserSession, TokenBucket, AsyncTokenBucket
+
+
+REQUESTS = 200
+LATENCY = .02
+
+def unlimited(session, bucket_class):
+  session.token_bucket = bucket_class(capacity=REQUESTS, refill_rate=REQUESTS) # measure the transport, not the rate limit
+  return session
+
+def test_async_session_against_threaded(stand_in_server, offline_login):
+  server = stand_in_server(latency=LATENCY)
+  url = server.url + '/marketdata/v1/quotes'
+  threaded = unlimited(UserSession(offline_login), TokenBucket)
+  with ThreadPoolExecutor(max_workers=50) as executor:
+    list(executor.map(lambda i: threaded.get(url), range(50))) # open the connections first
+    start = time.perf_counter()
+    threaded_statuses = [r.status_code for r in executor.map(lambda i: threaded.get(url), range(REQUESTS))]
+  threaded_seconds = time.perf_counter() - start
+  threaded.session.close()
+
+  session = unlimited(AsyncUserSession(offline_login), AsyncTokenBucket)
+  assert session.logged_in and session.token_version == 1 and session.session.token['access_token'] == 'token'
+  async def run():
+    await asyncio.gather(*[session.get(url) for i in range(50)])
+    start = time.perf_counter()
+    responses = await asyncio.gather(*[session.get(url) for i in range(REQUESTS)])
+    seconds = time.perf_counter() - start
+    await session.aclose()
+    return [r.status_code for r in responses], seconds
+  async_statuses, async_seconds = asyncio.run(run())
+  print(f'threaded (50 workers): {REQUESTS / threaded_seconds:.0f} req/s, async: {REQUESTS / async_seconds:.0f} req/s')
+
+  assert threaded_statuses == async_statuses == [200] * REQUESTS
+  assert async_seconds < REQUESTS * LATENCY / 4 # concurrent on one loop, not one round trip after another
@@ -0,0 +1,46 @@
+from schwab_wetrade.quote.bar_aggregator import BarAggregator
+
+
+def level_one(*quotes):
+  return {'service': 'LEVELONE_EQUITIES', 'timestamp': 1_700_000_000_000, 'content': [dict(quote) for quote in quotes]}
+
+def open_bar(aggregator, symbol='NVDA', interval='1m'):
+  return aggregator.open_bars[(symbol, interval)]
+
+def test_delta_without_price_counts_trade_at_last_price():
+  aggregator = BarAggregator(intervals=('1m',))
+  aggregator.handle_message(level_one({'key': 'NVDA', 'LAST_PRICE': 100.0, 'LAST_SIZE': 10, 'TRADE_TIME_MILLIS': 60_000, 'TOTAL_VOLUME': 1000}))
+  aggregator.handle_message(level_one({'key': 'NVDA', 'TRADE_TIME_MILLIS': 61_000, 'TOTAL_VOLUME': 1010}))
+  bar = open_bar(aggregator)
+  assert (bar['trades'], bar['volume'], bar['close']) == (2, 20, 100.0)
+  assert bar['notional'] == 2000.0
+
+def test_delta_without_size_keeps_last_size():
+  aggregator = BarAggregator(intervals=('1m',))
+  aggregator.handle_message(level_one({'key': 'NVDA', 'LAST_PRICE': 100.0, 'LAST_SIZE': 5, 'TRADE_TIME_MILLIS': 60_000}))
+  aggregator.handle_message(level_one({'key': 'NVDA', 'LAST_PRICE': 101.0, 'TRADE_TIME_MILLIS': 62_000}))
+  bar = open_bar(aggregator)
+  assert (bar['trades'], bar['volume'], bar['high'], bar['close']) == (2, 10, 101.0, 101.0)
+
+def test_volume_delta_sizes_the_trade():
+  aggregator = BarAggregator(intervals=('1m',))
+  aggregator.handle_message(level_one({'key': 'NVDA', 'LAST_PRICE': 100.0, 'LAST_SIZE': 5, 'TRADE_TIME_MILLIS': 60_000, 'TOTAL_VOLUME': 500}))
+  aggregator.handle_message(level_one({'key': 'NVDA', 'LAST_PRICE': 102.0, 'TOTAL_VOLUME': 530})) # trades at the same millisecond
+  bar = open_bar(aggregator)
+  assert (bar['trades'], bar['volume'], bar['close']) == (2, 35, 102.0)
+
+def test_quote_only_deltas_are_not_trades():
+  aggregator = BarAggregator(intervals=('1m',))
+  aggregator.handle_message(level_one({'key': 'NVDA', 'LAST_PRICE': 100.0, 'LAST_SIZE': 5, 'TRADE_TIME_MILLIS': 60_000, 'TOTAL_VOLUME': 500}))
+  aggregator.handle_message(level_one({'key': 'NVDA', 'BID_PRICE': 99.9, 'ASK_PRICE': 100.1}))
+  aggregator.handle_message(level_one({'key': 'NVDA', 'LAST_SIZE': 7}))
+  assert (open_bar(aggregator)['trades'], open_bar(aggregator)['volume']) == (1, 5)
+
+def test_symbols_keep_separate_state():
+  aggregator = BarAggregator(intervals=('1m',))
+  aggregator.handle_message(level_one(
+    {'key': 'NVDA', 'LAST_PRICE': 100.0, 'LAST_SIZE': 5, 'TRADE_TIME_MILLIS': 60_000},
+    {'key': 'AAPL', 'LAST_PRICE': 200.0, 'LAST_SIZE': 3, 'TRADE_TIME_MILLIS': 60_000}))
+  aggregator.handle_message(level_one({'key': 'AAPL', 'TRADE_TIME_MILLIS': 61_000}))
+  assert open_bar(aggregator, 'NVDA')['trades'] == 1
+  assert (open_bar(aggregator, 'AAPL')['trades'], open_bar(aggregator, 'AAPL')['close']) == (2, 200.0)
@@ -0,0 +1,49 @@
+import time
+import itertools
+import httpx
+from authlib.integrations.httpx_client import OAuth2Client
+from schwab_wetrade.api import APIClient
+from schwab_wetrade.account import Account
+from schwab_wetrade.user_session import UserSession, TokenBucket
+from schwab_wetrade.order import LimitOrder, BatchOrderSubmitter
+
+
+ORDERS = 100
+LATENCY = .05
+BURST = 10
+RATE = 100
+
+def stand_in_transport():
+  '''
+  Accepts every order after LATENCY seconds, except every 25th, which is rejected like Schwab does
+  '''
+  order_ids = itertools.count(1)
+  def handle(request):
+    time.sleep(LATENCY)
+    order_id = next(order_ids)
+    if order_id % 25 == 0:
+      return httpx.Response(400, json={'message': 'Insufficient buying power'})
+    return httpx.Response(201, headers={'Location': f'https://api.schwabapi.com/trader/v1/accounts/account/orders/{order_id}'})
+  return httpx.MockTransport(handle)
+
+def test_batch_approaches_rate_limit_floor(offline_login):
+  session = UserSession(offline_login)
+  session.session = OAuth2Client('key', token=session.session.token, transport=stand_in_transport())
+  session.token_bucket = TokenBucket(capacity=BURST, refill_rate=RATE)
+  client = APIClient(session)
+  account = Account(client, account_key='account')
+  orders = [LimitOrder(client, account, f'SYM{i}', 'BUY', 1, 10.0) for i in range(ORDERS)]
+  submitter = BatchOrderSubmitter(max_workers=16)
+  start = time.perf_counter()
+  results = submitter.submit(orders)
+  seconds = time.perf_counter() - start
+  submitter.close()
+  floor = (ORDERS - BURST) / RATE
+  print(f'batch {seconds:.2f}s, rate-limit floor {floor:.2f}s, sum of latencies {ORDERS * LATENCY:.2f}s')
+
+  assert [result['order'] for result in results] == orders
+  rejected = [result for result in results if not result['placed']]
+  assert len(rejected) == ORDERS // 25 and all(result['error'] == 'Insufficient buying power' for result in rejected)
+  assert all(result['order_id'] == result['order'].order_id != 0 for result in results if result['placed'])
+  assert len(account.orders) == ORDERS - len(rejected)
+  assert floor * .9 < seconds < floor * 1.3 + LATENCY # bounded by the rate limit, not ORDERS * LATENCY
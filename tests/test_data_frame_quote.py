@@ -0,0 +1,58 @@
+import time
+import threading
+from types import SimpleNamespace
+from schwab_wetrade.quote.data_frame_quote import DataFrameQuote
+
+
+def new_quote():
+  quote = DataFrameQuote(SimpleNamespace(), 'NVDA')
+  quote.market_hours = SimpleNamespace(market_has_closed=lambda: False)
+  return quote
+
+def tick(i):
+  return {'timestamp': 1_700_000_000_000 + i * 10, 'content': [{'key': 'NVDA', 'LAST_PRICE': 100.0 + i % 7, 'LAST_SIZE': 100, 'BID_PRICE': 99.9}]}
+
+def test_rolling_windows_match_trade_prices():
+  quote = new_quote()
+  name = quote.add_rolling_window(.05)
+  for i in range(20):
+    quote._handle_level_one(tick(i))
+  data = quote.data
+  assert name == '0.05s_average' and len(data) == 20
+  assert data[name][-1] == sum(100.0 + i % 7 for i in range(14, 20)) / 6 # ticks 10ms apart, window closed on both ends
+  assert quote.smoothed_price == data['10s_average'][-1]
+
+def test_add_rolling_window_while_streaming():
+  quote = new_quote()
+  errors = []
+  def stream():
+    try:
+      for i in range(20_000):
+        quote._handle_level_one(tick(i))
+    except Exception as e:
+      errors.append(e)
+  thread = threading.Thread(target=stream)
+  thread.start()
+  for seconds in range(1, 200):
+    quote.add_rolling_window(seconds / 10)
+  thread.join()
+  assert errors == []
+  assert len(quote.data.columns) == 13 + 199
+
+def test_tick_latency_flat_from_1k_to_1m_ticks():
+  quote = new_quote()
+  sample = 1000
+  latencies = {}
+  i = 0
+  for checkpoint in (1_000, 10_000, 100_000, 1_000_000):
+    while i < checkpoint - sample:
+      quote._handle_level_one(tick(i))
+      i += 1
+    start = time.perf_counter()
+    for _ in range(sample):
+      quote._handle_level_one(tick(i))
+      i += 1
+    latencies[checkpoint] = (time.perf_counter() - start) / sample
+  print(', '.join(f'{n:,} ticks: {seconds * 1e6:.1f}us/tick' for n, seconds in latencies.items()))
+  assert len(quote.ticks) == 1_000_000
+  assert latencies[1_000_000] < latencies[1_000] * 3 # constant work per tick, not a pass over the day's history
@@ -0,0 +1,24 @@
+import subprocess
+import sys
+
+
+HEAVY_MODULES = ('numpy', 'polars', 'pandas', 'playwright', 'google.cloud')
+
+def imported_modules():
+  '''
+  Returns the modules a fresh interpreter imports for ``import schwab_wetrade``, from -X importtime's report
+  '''
+  result = subprocess.run(
+    [sys.executable, '-X', 'importtime', '-c', 'import schwab_wetrade'],
+    capture_output=True, text=True, check=True)
+  modules = set()
+  for line in result.stderr.splitlines():
+    if line.startswith('import time:') and '|' in line:
+      modules.add(line.rsplit('|', 1)[1].strip())
+  return modules
+
+def test_import_skips_heavy_dependencies():
+  modules = imported_modules()
+  assert 'schwab_wetrade' in modules
+  loaded = [name for name in HEAVY_MODULES if any(module == name or module.startswith(name + '.') for module in modules)]
+  assert loaded == [], f'import schwab_wetrade loaded {loaded}; import them on first use instead'
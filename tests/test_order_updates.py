@@ -0,0 +1,73 @@
+import json
+import datetime
+from types import SimpleNamespace
+from schwab_wetrade.account import Account
+from schwab_wetrade.order.base_order import BaseOrder
+
+
+def number(value):
+  return {'lo': str(int(value * 1_000_000)), 'signScale': 12} if value else {'signScale': 12}
+
+def execution_message(order_id, quantity, price, leaves, execution_id):
+  leg = {'LegId': '1', 'ExecutionId': execution_id, 'Quantity': number(quantity), 'Price': number(price), 'LeavesQuantity': number(leaves)}
+  details = {'SchwabOrderID': order_id, 'BaseEvent': {'ExecutionCreatedEvent': {'ExecutionLeg': leg}}}
+  return {'content': [{'MESSAGE_TYPE': 'ExecutionCreated', 'MESSAGE_DATA': json.dumps(details)}]}
+
+def order_response(order_id, status, filled_quantity, executions):
+  return {
+    'orderId': order_id,
+    'status': status,
+    'filledQuantity': filled_quantity,
+    'orderActivityCollection': [{'executionLegs': [{'quantity': quantity, 'price': price} for quantity, price in executions]}]}
+
+def subscribed_order(quantity=100, price=10.5):
+  account = Account(client=None, account_key='account')
+  order = BaseOrder(client=None, account=account, symbol='NVDA', action='BUY', quantity=quantity, price=price)
+  order.order_id = '1'
+  account.orders.add_order(order)
+  account.subscribed_orders['1'] = order
+  return account, order
+
+def test_rest_partial_fill_then_stream_fill():
+  account, order = subscribed_order()
+  order.apply_order_response(order_response(1, 'WORKING', 50, [(50, 10.0)]))
+  assert (order.status, order.filled_quantity, order.fill_price, order.price) == ('WORKING', 50, 10.0, 10.5)
+  account.account_message_handler(execution_message('1', 50, 10.0, 0, 'E1'))
+  assert (order.status, order.filled_quantity, order.fill_price, order.price) == ('FILLED', 100, 10.0, 10.0)
+
+def test_rest_fill_averages_every_execution():
+  account, order = subscribed_order()
+  order.apply_order_response({
+    'orderId': 1,
+    'status': 'FILLED',
+    'filledQuantity': 100,
+    'orderActivityCollection': [
+      {'executionLegs': [{'quantity': 25, 'price': 10.0}, {'quantity': 25, 'price': 10.2}]},
+      {'executionLegs': [{'quantity': 50, 'price': 10.4}]}]})
+  assert order.status == 'FILLED'
+  assert abs(order.fill_price - 10.25) < 1e-9 and order.price == order.fill_price
+
+def test_repeated_stream_fill_applies_once():
+  account, order = subscribed_order(quantity=10)
+  for i in range(3):
+    account.account_message_handler(execution_message('1', 4, 60.5, 6, 'E1'))
+  assert (order.status, order.filled_quantity, order.price) == ('WORKING', 4, 10.5)
+  assert len(account.orders.get('1').fills) == 1
+
+def test_reconcile_bounds_orders_without_placement_time():
+  account, order = subscribed_order()
+  requests = []
+  def get_orders_for_account(**kwargs):
+    requests.append(kwargs)
+    return [], 200
+  account.client = SimpleNamespace(get_orders_for_account=get_orders_for_account)
+  account.reconcile_orders()
+  since = requests[0]['from_entered_datetime']
+  assert datetime.datetime.now(datetime.timezone.utc) - since < datetime.timedelta(days=1)
+
+def test_reconciler_stops_when_last_subscription_is_removed():
+  account, order = subscribed_order()
+  account.start_reconciler()
+  timer = account.reconcile_timer
+  account.remove_order_subscription('1')
+  assert account.reconciling == False and account.reconcile_timer == None and timer.cancelled